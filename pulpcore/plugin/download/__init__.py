@@ -1,4 +1,14 @@
-from .base import BaseDownloader, DownloadResult  # noqa
+from .base import BaseDownloader, DownloadResult, DownloadStream  # noqa
+from .concurrency import (  # noqa
+    AdaptiveSemaphore,
+    PRIORITY_AWAITED,
+    PRIORITY_BULK,
+    PRIORITY_METADATA,
+)
+from .decompress import DecompressingDownloaderMixin, decompressing_downloader_class  # noqa
 from .factory import DownloaderFactory  # noqa
 from .file import FileDownloader  # noqa
-from .http import http_giveup, HttpDownloader  # noqa
+from .http import http_giveup, HttpDownloader, timing_trace_config  # noqa
+from .ratelimit import TokenBucket  # noqa
+from .retry import CircuitBreaker  # noqa
+from .statistics import DownloadStatistics, DownloadTiming  # noqa
@@ -8,11 +8,15 @@ import tempfile
 from pulpcore.app.models import Artifact
 from pulpcore.exceptions import DigestValidationError, SizeValidationError
 
+from .statistics import DownloadTiming
+
 
 log = logging.getLogger(__name__)
 
 
-DownloadResult = namedtuple('DownloadResult', ['url', 'artifact_attributes', 'path', 'headers'])
+DownloadResult = namedtuple('DownloadResult',
+                            ['url', 'artifact_attributes', 'path', 'headers', 'timing'])
+DownloadResult.__new__.__defaults__ = (None,)
 """
 Args:
     url (str): The url corresponding with the download.
@@ -22,6 +26,8 @@ Args:
         along with size information.
     headers (aiohttp.multidict.MultiDict): HTTP response headers. The keys are header names. The
         values are header content. None when not using the HttpDownloader or sublclass.
+    timing (:class:`~pulpcore.plugin.download.DownloadTiming`): Timing data of the download. Set by
+        :meth:`~pulpcore.plugin.download.BaseDownloader.run`, so downloaders don't need to pass it.
 """
 
 
@@ -61,6 +67,8 @@ class BaseDownloader:
         expected_size (int): The number of bytes the download is expected to have.
         path (str): The full path to the file containing the downloaded data if no
             ``custom_file_object`` option was specified, otherwise None.
+        timing (:class:`~pulpcore.plugin.download.DownloadTiming`): Timing data of the download,
+            filled in while it runs.
     """
 
     def __init__(self, url, custom_file_object=None, expected_digests=None, expected_size=None,
@@ -77,7 +85,9 @@ class BaseDownloader:
                 value of the expected digest. e.g. {'md5': '912ec803b2ce49e4a541068d495ab570'}
             expected_size (int): The number of bytes the download is expected to have.
             semaphore (asyncio.Semaphore): A semaphore the downloader must acquire before running.
-                Useful for limiting the number of outstanding downloaders in various ways.
+                Useful for limiting the number of outstanding downloaders in various ways. If it is
+                an :class:`~pulpcore.plugin.download.AdaptiveSemaphore`, the downloader reports
+                its performance to it.
         """
         self.url = url
         if custom_file_object:
@@ -94,6 +104,9 @@ class BaseDownloader:
             self.semaphore = asyncio.Semaphore()  # This will always be acquired
         self._digests = {n: hashlib.new(n) for n in Artifact.DIGEST_FIELDS}
         self._size = 0
+        self._stream_queue = None
+        self._holds_semaphore = False
+        self.timing = DownloadTiming()
 
     async def handle_data(self, data):
         """
@@ -109,6 +122,28 @@ class BaseDownloader:
         """
         self._writer.write(data)
         self._record_size_and_digests_for_data(data)
+        await self._stream_data(data)
+
+    async def _stream_data(self, data):
+        """
+        Pass data to the consumer of :meth:`stream` if the download is streamed.
+
+        This waits while the consumer is behind by more than the stream's `maxsize` chunks. The
+        semaphore is released meanwhile, because the consumer may be waiting for another download.
+
+        Args:
+            data (bytes): The data to be passed on.
+        """
+        if self._stream_queue is None or not data:
+            return
+        if self._stream_queue.full() and self._holds_semaphore:
+            await self._release_semaphore()
+            try:
+                await self._stream_queue.put(data)
+            finally:
+                await self._acquire_semaphore()
+        else:
+            await self._stream_queue.put(data)
 
     async def finalize(self):
         """
@@ -144,6 +179,37 @@ class BaseDownloader:
         done, _ = asyncio.get_event_loop().run_until_complete(asyncio.wait([self.run()]))
         return done.pop().result()
 
+    def stream(self, extra_data=None, maxsize=16):
+        """
+        Run the download and iterate over the data chunks while they are downloaded.
+
+        The data is also handled as usual, i.e. written to the file object and digested. Validation
+        happens once all data has been received, so a validation error is raised by the iteration
+        after the last chunk was produced. Consumers must not rely on the data before the iteration
+        finished without an exception.
+
+        Examples:
+            Used in a first stage to parse metadata while it is downloaded::
+
+                parser = xml.etree.ElementTree.XMLPullParser(events=['end'])
+                downloader = remote.get_downloader(url=url, priority=PRIORITY_METADATA)
+                async with downloader.stream() as stream:
+                    async for chunk in stream:
+                        parser.feed(chunk)
+                        for event, element in parser.read_events():
+                            pass  # create and put DeclarativeContent
+                result = stream.result  # the DownloadResult
+
+        Args:
+            extra_data (dict): Extra data passed to the downloader.
+            maxsize (int): The number of chunks that can be buffered before the download waits for
+                the consumer.
+
+        Returns:
+            :class:`~pulpcore.plugin.download.DownloadStream`: An asynchronous iterator of chunks.
+        """
+        return DownloadStream(self, extra_data=extra_data, maxsize=maxsize)
+
     def _record_size_and_digests_for_data(self, data):
         """
         Record the size and digest for an available chunk of data.
@@ -198,18 +264,57 @@ class BaseDownloader:
         Run the downloader with concurrency restriction.
 
         This method acquires `self.semaphore` before calling the actual download implementation
-        contained in `_run()`. This ensures that the semaphore stays acquired even as the `backoff`
-        decorator on `_run()`, handles backoff-and-retry logic.
+        contained in `_run()`. This ensures that the semaphore stays acquired even as `_run()`
+        handles retry logic, except while a streamed download waits for its consumer. It also
+        records the time waiting for the semaphore, the total time and the size of the download in
+        :attr:`timing`.
 
         Args:
             extra_data (dict): Extra data passed to the downloader.
 
         Returns:
-            :class:`~pulpcore.plugin.download.DownloadResult` from `_run()`.
+            :class:`~pulpcore.plugin.download.DownloadResult` from `_run()`, with its `timing` set.
 
         """
-        async with self.semaphore:
-            return await self._run(extra_data=extra_data)
+        loop = asyncio.get_event_loop()
+        wait_start = loop.time()
+        await self._acquire_semaphore()
+        try:
+            start = loop.time()
+            self.timing.semaphore_wait = start - wait_start
+            result = await self._run(extra_data=extra_data)
+            self.timing.total = loop.time() - start
+            self.timing.size = self._size
+            if self.timing.transfer is None:
+                self.timing.transfer = self.timing.total
+            self._report_to_semaphore('record_success', self.timing.ttfb, self._size)
+            if isinstance(result, DownloadResult) and result.timing is None:
+                result = result._replace(timing=self.timing)
+            return result
+        finally:
+            await self._release_semaphore()
+
+    async def _acquire_semaphore(self):
+        await self.semaphore.__aenter__()
+        self._holds_semaphore = True
+
+    async def _release_semaphore(self):
+        if self._holds_semaphore:
+            self._holds_semaphore = False
+            await self.semaphore.__aexit__(None, None, None)
+
+    def _report_to_semaphore(self, event, *args):
+        """
+        Report a download event to `self.semaphore` if it adapts to them.
+
+        Args:
+            event (str): The name of the :class:`~pulpcore.plugin.download.AdaptiveSemaphore`
+                method to call, e.g. 'record_success' or 'congestion_detected'.
+            args (tuple): The positional arguments passed to that method.
+        """
+        handler = getattr(self.semaphore, event, None)
+        if handler is not None:
+            handler(*args)
 
     async def _run(self, extra_data=None):
         """
@@ -245,3 +350,71 @@ class BaseDownloader:
             :meth:`~pulpcore.plugin.download.BaseDownloader.finalize`.
         """
         raise NotImplementedError('Subclasses must define a _run() method that returns a coroutine')
+
+
+class DownloadStream:
+    """
+    An asynchronous iterator over the data chunks of a download while it is running.
+
+    Created by :meth:`~pulpcore.plugin.download.BaseDownloader.stream`. The download starts with
+    the first iteration step. Once the iteration is finished, :attr:`result` holds the
+    :class:`~pulpcore.plugin.download.DownloadResult`. Any exception of the download, including
+    validation errors, is raised by the iteration.
+
+    It can be used as an asynchronous context manager, which cancels the download if the consumer
+    stops iterating early.
+
+    Attributes:
+        result (:class:`~pulpcore.plugin.download.DownloadResult`): The result of the download, or
+            None until the iteration finished.
+    """
+
+    def __init__(self, downloader, extra_data=None, maxsize=16):
+        """
+        Args:
+            downloader (:class:`~pulpcore.plugin.download.BaseDownloader`): The downloader to run.
+            extra_data (dict): Extra data passed to the downloader.
+            maxsize (int): The number of chunks that can be buffered before the download waits for
+                the consumer.
+        """
+        self._downloader = downloader
+        self._extra_data = extra_data
+        self._queue = asyncio.Queue(maxsize=maxsize)
+        self._task = None
+        self.result = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._task is None:
+            self._downloader._stream_queue = self._queue
+            self._task = asyncio.ensure_future(self._downloader.run(extra_data=self._extra_data))
+        if self._queue.empty() and not self._task.done():
+            get_task = asyncio.ensure_future(self._queue.get())
+            try:
+                await asyncio.wait([get_task, self._task], return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                if not get_task.done():
+                    get_task.cancel()
+            if get_task.done() and not get_task.cancelled():
+                return get_task.result()
+        if not self._queue.empty():
+            return self._queue.get_nowait()
+        if self.result is None:
+            self.result = self._task.result()  # raises the download exceptions
+        raise StopAsyncIteration
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
+
+    async def aclose(self):
+        """
+        Cancel the download if it is still running.
+        """
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            await asyncio.wait([self._task])
@@ -0,0 +1,257 @@
+import asyncio
+import heapq
+import itertools
+import logging
+
+from gettext import gettext as _
+
+
+log = logging.getLogger(__name__)
+
+
+PRIORITY_METADATA = 0
+"""Priority of downloads that unblock a lot of other work, e.g. the metadata of a first stage."""
+
+PRIORITY_AWAITED = 1
+"""Priority of downloads something is waiting for, e.g. content with a future or not batching."""
+
+PRIORITY_BULK = 2
+"""Priority of all other downloads, e.g. the artifacts downloaded by the ArtifactDownloader."""
+
+
+class AdaptiveSemaphore:
+    """
+    A semaphore whose limit adapts to the observed download performance (AIMD).
+
+    The limit follows an additive-increase/multiplicative-decrease scheme. Downloaders report
+    finished downloads with :meth:`record_success` and overloaded servers (e.g. HTTP 429 or 503
+    responses) with :meth:`congestion_detected`. Completed downloads are grouped into windows with
+    as many downloads as the current limit. At the end of each window:
+
+        * If the average time to first byte rose above ``latency_tolerance`` times the best window
+          average seen so far, the limit is multiplied by ``decrease_factor``. The time to first
+          byte doesn't grow with the size of the downloads, so large files are not mistaken for
+          congestion. Downloads without a time to first byte, e.g. of local files, only count
+          towards the throughput.
+        * Otherwise, if the throughput improved compared to the previous window, the limit is
+          increased by one.
+
+    A congestion signal multiplies the limit by ``decrease_factor`` immediately, but at most once
+    per window, so a burst of errors from concurrently running downloads does not collapse the
+    limit to ``min_value`` at once.
+
+    The limit never drops below ``min_value`` and never exceeds ``max_value``. Lowering the limit
+    never interrupts downloads that already acquired the semaphore, it only delays new ones.
+
+    Waiting acquirers are served by priority first (lowest value first, see `PRIORITY_METADATA`,
+    `PRIORITY_AWAITED` and `PRIORITY_BULK`) and in order of arrival second. Use
+    :meth:`with_priority` to get a context manager acquiring with a given priority.
+
+    Usage:
+        >>> semaphore = AdaptiveSemaphore(10, max_value=40)
+        >>> async with semaphore.with_priority(PRIORITY_METADATA):
+        >>>     pass  # download something and report the result
+
+    Args:
+        value (int): The initial limit.
+        min_value (int): The lowest limit. Defaults to 1.
+        max_value (int): The highest limit. Defaults to `value`.
+        decrease_factor (float): The factor applied to the limit when decreasing it. Defaults to
+            0.5.
+        latency_tolerance (float): How many times the best window latency the average latency of
+            a window may reach before the limit is decreased. Defaults to 2.0.
+
+    Attributes:
+        limit (int): The current number of holders allowed at the same time.
+
+    Raises:
+        ValueError: When the limits are not consistent.
+    """
+
+    def __init__(self, value=1, min_value=1, max_value=None, decrease_factor=0.5,
+                 latency_tolerance=2.0):
+        if max_value is None:
+            max_value = value
+        if not 1 <= min_value <= value <= max_value:
+            raise ValueError(_('AdaptiveSemaphore requires 1 <= min_value <= value <= max_value.'))
+        self.limit = value
+        self.min_value = min_value
+        self.max_value = max_value
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self._in_use = 0
+        self._waiters = []
+        self._arrivals = itertools.count()
+        self._best_latency = None
+        self._last_throughput = None
+        self._congested = False
+        self._reset_window()
+
+    @property
+    def in_use(self):
+        """
+        The number of holders that currently acquired the semaphore.
+        """
+        return self._in_use
+
+    def locked(self):
+        """
+        Returns True if the semaphore cannot be acquired immediately.
+        """
+        return self._in_use >= self.limit
+
+    async def acquire(self, priority=PRIORITY_BULK):
+        """
+        Acquire the semaphore, waiting until the number of holders is below `limit`.
+
+        Args:
+            priority (int): The priority of this acquirer. Lower values are served first.
+
+        Returns:
+            True
+        """
+        if not self._waiters and not self.locked():
+            self._in_use += 1
+            return True
+        waiter = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._arrivals), waiter))
+        self._wake_up()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was handed over before the cancellation arrived, give it back
+                self.release()
+            raise
+        return True
+
+    def release(self):
+        """
+        Release the semaphore, handing the slot to the most important waiting acquirer.
+        """
+        self._in_use -= 1
+        self._wake_up()
+
+    def with_priority(self, priority):
+        """
+        Get a context manager acquiring this semaphore with `priority`.
+
+        It also provides all other attributes of this semaphore, so it can be passed to
+        downloaders as their `semaphore`.
+
+        Args:
+            priority (int): The priority to acquire with. Lower values are served first.
+
+        Returns:
+            A context manager acquiring and releasing this semaphore.
+        """
+        return _PrioritizedSemaphore(self, priority)
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+    def record_success(self, ttfb=None, size=0):
+        """
+        Record a successful download and adjust the limit at the end of a window.
+
+        Args:
+            ttfb (float): The number of seconds from sending the request until the response
+                headers arrived, or None if the downloader doesn't measure it.
+            size (int): The number of bytes downloaded.
+        """
+        self._window_count += 1
+        self._window_bytes += size
+        if ttfb is not None:
+            self._window_latency += ttfb
+            self._window_latency_count += 1
+        if self._window_count < self.limit:
+            return
+
+        elapsed = max(self._now() - self._window_start, 1e-6)
+        if self._window_bytes:
+            throughput = self._window_bytes / elapsed
+        else:
+            throughput = self._window_count / elapsed
+        latency = None
+        if self._window_latency_count:
+            latency = self._window_latency / self._window_latency_count
+            if self._best_latency is None or latency < self._best_latency:
+                self._best_latency = latency
+
+        if latency is not None and latency > self._best_latency * self.latency_tolerance:
+            self._decrease(_('latency increased'))
+        elif self._last_throughput is None or throughput > self._last_throughput:
+            self._increase()
+            self._last_throughput = throughput
+            self._reset_window()
+        else:
+            self._last_throughput = throughput
+            self._reset_window()
+
+    def congestion_detected(self):
+        """
+        Record that the server signalled overload, e.g. with a HTTP 429 or 503 response.
+        """
+        if not self._congested:
+            self._decrease(_('server signalled congestion'))
+            self._congested = True
+
+    def _increase(self):
+        if self.limit < self.max_value:
+            self.limit += 1
+            log.debug(_('Download concurrency increased to %(limit)d.'), {'limit': self.limit})
+            self._wake_up()
+
+    def _decrease(self, reason):
+        limit = max(self.min_value, int(self.limit * self.decrease_factor))
+        if limit < self.limit:
+            log.debug(_('Download concurrency decreased to %(limit)d: %(reason)s.'),
+                      {'limit': limit, 'reason': reason})
+            self.limit = limit
+        self._last_throughput = None
+        self._reset_window()
+
+    def _reset_window(self):
+        self._window_start = self._now()
+        self._window_count = 0
+        self._window_bytes = 0
+        self._window_latency = 0.0
+        self._window_latency_count = 0
+        self._congested = False
+
+    def _wake_up(self):
+        while self._waiters and not self.locked():
+            waiter = heapq.heappop(self._waiters)[-1]
+            if not waiter.done():  # skip cancelled acquirers
+                self._in_use += 1
+                waiter.set_result(None)
+
+    @staticmethod
+    def _now():
+        return asyncio.get_event_loop().time()
+
+
+class _PrioritizedSemaphore:
+    """
+    A view on an :class:`AdaptiveSemaphore` that acquires it with a fixed priority.
+
+    Args:
+        semaphore (:class:`AdaptiveSemaphore`): The semaphore to acquire.
+        priority (int): The priority to acquire with.
+    """
+
+    def __init__(self, semaphore, priority):
+        self._semaphore = semaphore
+        self.priority = priority
+
+    async def __aenter__(self):
+        await self._semaphore.acquire(priority=self.priority)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._semaphore.release()
+
+    def __getattr__(self, name):
+        return getattr(self._semaphore, name)
@@ -0,0 +1,269 @@
+import bz2
+import functools
+from gettext import gettext as _
+import hashlib
+import lzma
+import zlib
+
+from pulpcore.app.models import Artifact
+from pulpcore.exceptions import DigestValidationError, SizeValidationError
+
+
+DECOMPRESSORS = {
+    'gz': lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+    'bz2': bz2.BZ2Decompressor,
+    'xz': lzma.LZMADecompressor,
+}
+"""Decompressor factories keyed on the compression name, which is also the file extension."""
+
+
+def guess_compression(url):
+    """
+    Guess the compression of the data at `url` from its file extension.
+
+    Args:
+        url (str): The url to inspect.
+
+    Returns:
+        str: A key of `DECOMPRESSORS` or None if the data is not compressed.
+    """
+    path = url.split('?', 1)[0]
+    for compression in DECOMPRESSORS:
+        if path.endswith('.' + compression):
+            return compression
+    return None
+
+
+class DecompressingDownloaderMixin:
+    """
+    A mixin for downloaders that decompresses the data while it is downloaded.
+
+    The uncompressed data is written to the file object, and passed on by
+    :meth:`~pulpcore.plugin.download.BaseDownloader.stream`, so no extra pass over a compressed file
+    is needed before parsing it. Digests and size are computed for both the compressed data and the
+    uncompressed data:
+
+    * ``expected_digests`` and ``expected_size`` are validated against the compressed data, i.e.
+      the data as published by the remote.
+    * ``expected_uncompressed_digests`` and ``expected_uncompressed_size`` are validated against
+      the uncompressed data.
+    * :attr:`artifact_attributes` describe the uncompressed data, which is the file at ``path``.
+    * :attr:`compressed_attributes` describe the compressed data.
+
+    Concatenated streams, e.g. multi-member gzip files, are decompressed completely.
+
+    The data is decompressed in chunks of at most `DECOMPRESS_CHUNK_SIZE` bytes, so a small
+    compressed chunk inflating to a lot of data doesn't take a lot of memory. The download fails
+    with a :class:`~pulpcore.exceptions.SizeValidationError` as soon as the uncompressed data
+    exceeds ``expected_uncompressed_size`` or ``max_uncompressed_size``.
+
+    Use :func:`decompressing_downloader_class` to combine this mixin with a downloader class, or the
+    ``decompress`` option of :meth:`~pulpcore.plugin.download.DownloaderFactory.build`.
+
+    Attributes:
+        DECOMPRESS_CHUNK_SIZE (int): The maximum number of bytes decompressed at once.
+        compression (str): The compression of the downloaded data. One of 'gz', 'bz2', 'xz' or None
+            for uncompressed data.
+        expected_uncompressed_digests (dict): Keyed on the algorithm name provided by hashlib and
+            stores the value of the expected digest of the uncompressed data.
+        expected_uncompressed_size (int): The number of bytes the uncompressed data is expected
+            to have.
+        max_uncompressed_size (int): The number of bytes the uncompressed data may have at most.
+    """
+
+    DECOMPRESS_CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, url, compression=None, expected_uncompressed_digests=None,
+                 expected_uncompressed_size=None, max_uncompressed_size=None, **kwargs):
+        """
+        Args:
+            url (str): The url to download.
+            compression (str): One of 'gz', 'bz2' or 'xz'. Guessed from the file extension of `url`
+                if not specified. Data with an unknown extension is passed through unchanged.
+            expected_uncompressed_digests (dict): Keyed on the algorithm name provided by hashlib
+                and stores the value of the expected digest of the uncompressed data.
+            expected_uncompressed_size (int): The number of bytes the uncompressed data is expected
+                to have.
+            max_uncompressed_size (int): The number of bytes the uncompressed data may have at
+                most, unlimited by default.
+            kwargs (dict): This accepts the parameters of the downloader class combined with.
+
+        Raises:
+            ValueError: When `compression` is not supported.
+        """
+        if compression is None:
+            compression = guess_compression(url)
+        elif compression not in DECOMPRESSORS:
+            raise ValueError(_('Compression {c} is not supported.').format(c=compression))
+        self.compression = compression
+        self.expected_uncompressed_digests = expected_uncompressed_digests
+        self.expected_uncompressed_size = expected_uncompressed_size
+        self.max_uncompressed_size = max_uncompressed_size
+        self._decompressor = self._new_decompressor()
+        self._uncompressed_digests = {n: hashlib.new(n) for n in Artifact.DIGEST_FIELDS}
+        self._uncompressed_size = 0
+        super().__init__(url, **kwargs)
+
+    def _new_decompressor(self):
+        if self.compression:
+            return DECOMPRESSORS[self.compression]()
+        return None
+
+    async def handle_data(self, data):
+        """
+        A coroutine that decompresses data, writes it to the file object and computes digests.
+
+        Args:
+            data (bytes): The compressed data to be handled by the downloader.
+        """
+        self._record_size_and_digests_for_data(data)
+        if self._decompressor is None:
+            await self._handle_uncompressed_data(data)
+            return
+        while data:
+            if self._decompressor.eof:
+                # concatenated streams start over with a fresh decompressor
+                self._decompressor = self._new_decompressor()
+            data = await self._decompress(data)
+
+    async def _decompress(self, data):
+        """
+        Decompress data in chunks of at most `DECOMPRESS_CHUNK_SIZE` bytes and handle them.
+
+        Args:
+            data (bytes): The compressed data.
+
+        Returns:
+            bytes: The data following the end of the compressed stream, if it ended.
+        """
+        decompressor = self._decompressor
+        size = self.DECOMPRESS_CHUNK_SIZE
+        chunk = decompressor.decompress(data, size)
+        await self._handle_uncompressed_data(chunk)
+        while not decompressor.eof and (len(chunk) == size or self._has_pending(decompressor)):
+            # zlib keeps the input it didn't consume, bz2 and lzma buffer it internally
+            chunk = decompressor.decompress(getattr(decompressor, 'unconsumed_tail', b''), size)
+            await self._handle_uncompressed_data(chunk)
+        return decompressor.unused_data if decompressor.eof else b''
+
+    @staticmethod
+    def _has_pending(decompressor):
+        if hasattr(decompressor, 'needs_input'):
+            return not decompressor.needs_input
+        return bool(decompressor.unconsumed_tail)
+
+    async def _handle_uncompressed_data(self, data):
+        """
+        Write uncompressed data, record its size and digests and stream it if requested.
+
+        Args:
+            data (bytes): The uncompressed data.
+
+        Raises:
+            :class:`~pulpcore.exceptions.SizeValidationError`: When the uncompressed data exceeds
+                ``expected_uncompressed_size`` or ``max_uncompressed_size``.
+        """
+        if not data:
+            return
+        self._uncompressed_size += len(data)
+        for limit in (self.expected_uncompressed_size, self.max_uncompressed_size):
+            if limit and self._uncompressed_size > limit:
+                raise SizeValidationError()
+        self._writer.write(data)
+        for algorithm in self._uncompressed_digests.values():
+            algorithm.update(data)
+        await self._stream_data(data)
+
+    async def finalize(self):
+        """
+        A coroutine to check the compressed stream is complete before finalizing the download.
+
+        Raises:
+            EOFError: When the compressed data ended before the end-of-stream marker.
+        """
+        if self._decompressor is not None:
+            if hasattr(self._decompressor, 'flush'):
+                await self._handle_uncompressed_data(self._decompressor.flush())
+            if not self._decompressor.eof:
+                raise EOFError(_('Compressed file ended before the end-of-stream marker was '
+                                 'reached: {url}').format(url=self.url))
+        await super().finalize()
+
+    async def _run(self, extra_data=None):
+        """
+        Run the download and point the result to the uncompressed data.
+
+        Args:
+            extra_data (dict): Extra data passed to the downloader.
+
+        Returns:
+            :class:`~pulpcore.plugin.download.DownloadResult` with the `path` of the uncompressed
+            file.
+        """
+        result = await super()._run(extra_data=extra_data)
+        return result._replace(path=self.path)
+
+    @property
+    def artifact_attributes(self):
+        """
+        A dictionary with size and digest information of the uncompressed data.
+        """
+        attributes = {'size': self._uncompressed_size}
+        for algorithm in Artifact.DIGEST_FIELDS:
+            attributes[algorithm] = self._uncompressed_digests[algorithm].hexdigest()
+        return attributes
+
+    @property
+    def compressed_attributes(self):
+        """
+        A dictionary with size and digest information of the compressed data.
+        """
+        attributes = {'size': self._size}
+        for algorithm in Artifact.DIGEST_FIELDS:
+            attributes[algorithm] = self._digests[algorithm].hexdigest()
+        return attributes
+
+    def validate_digests(self):
+        """
+        Validate the compressed and the uncompressed digests if they are expected.
+
+        Raises:
+            :class:`~pulpcore.exceptions.DigestValidationError`: When any expected digest doesn't
+                match.
+        """
+        super().validate_digests()
+        if self.expected_uncompressed_digests:
+            for algorithm, expected_digest in self.expected_uncompressed_digests.items():
+                if expected_digest != self._uncompressed_digests[algorithm].hexdigest():
+                    raise DigestValidationError()
+
+    def validate_size(self):
+        """
+        Validate the compressed and the uncompressed size if they are expected.
+
+        Raises:
+            :class:`~pulpcore.exceptions.SizeValidationError`: When any expected size doesn't
+                match.
+        """
+        super().validate_size()
+        if self.expected_uncompressed_size:
+            if self._uncompressed_size != self.expected_uncompressed_size:
+                raise SizeValidationError()
+
+
+@functools.lru_cache(maxsize=None)
+def decompressing_downloader_class(download_class):
+    """
+    Combine :class:`DecompressingDownloaderMixin` with a downloader class.
+
+    Args:
+        download_class (subclass of :class:`~pulpcore.plugin.download.BaseDownloader`): The
+            downloader class to decompress the data of.
+
+    Returns:
+        A subclass of `download_class` decompressing the downloaded data.
+    """
+    if issubclass(download_class, DecompressingDownloaderMixin):
+        return download_class
+    name = 'Decompressing' + download_class.__name__
+    return type(name, (DecompressingDownloaderMixin, download_class), {})
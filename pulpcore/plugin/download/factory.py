@@ -1,4 +1,3 @@
-import asyncio
 import atexit
 import copy
 from gettext import gettext as _
@@ -7,8 +6,12 @@ from urllib.parse import urlparse
 
 import aiohttp
 
-from .http import HttpDownloader
+from .concurrency import AdaptiveSemaphore, PRIORITY_BULK
+from .decompress import decompressing_downloader_class
+from .http import HttpDownloader, timing_trace_config
 from .file import FileDownloader
+from .ratelimit import TokenBucket, worker_rate_limiter
+from .retry import CircuitBreaker
 
 
 PROTOCOL_MAP = {
@@ -23,7 +26,13 @@ class DownloaderFactory:
     A factory for creating downloader objects that are configured from with remote settings.
 
     The DownloadFactory correctly handles SSL settings, basic auth settings, proxy settings, and
-    connection limit settings.
+    connection limit settings. The connection limit adapts to the server behavior, starting at the
+    `download_concurrency` of the remote and never exceeding it unless `max_download_concurrency`
+    is passed. See :attr:`download_limit`.
+
+    The bandwidth of http and https downloads is limited by the `download_rate_limit` of the remote
+    (shared by all downloaders of this factory) and by the `DOWNLOAD_RATE_LIMIT` setting (shared by
+    all downloaders of the worker process). Both are in bytes per second and unlimited if unset.
 
     It supports handling urls with the `http`, `https`, and `file` protocols. The
     ``downloader_overrides`` option allows the caller to specify the download class to be used for
@@ -42,12 +51,14 @@ class DownloaderFactory:
     allow for an active download to be arbitrarily long, while still detecting dead or closed
     sessions even when TCPKeepAlive is disabled.
 
-    Also for http and https urls, even though HTTP 1.1 is used, the TCP connection is setup and
+    Also for http and https urls, all downloaders to the same host share a
+    :class:`~pulpcore.plugin.download.CircuitBreaker`, pausing them together while the host is
+    overloaded. Even though HTTP 1.1 is used, the TCP connection is setup and
     closed with each request. This is done for compatibility reasons due to various issues related
     to session continuation implementation in various servers.
     """
 
-    def __init__(self, remote, downloader_overrides=None):
+    def __init__(self, remote, downloader_overrides=None, max_download_concurrency=None):
         """
         Args:
             remote (:class:`~pulpcore.plugin.models.Remote`): The remote used to populate
@@ -55,6 +66,10 @@ class DownloaderFactory:
             downloader_overrides (dict): Keyed on a scheme name, e.g. 'https' or 'ftp' and the value
                 is the downloader class to be used for that scheme, e.g.
                 {'https': MyCustomDownloader}. These override the default values.
+            max_download_concurrency (int): The highest number of simultaneous downloads the
+                concurrency limit may adapt to. Defaults to the `download_concurrency` of the
+                remote, which is also the initial limit, so the limit only adapts downwards. A
+                plugin can pass a higher value to let the limit grow beyond the remote setting.
         """
         self._remote = remote
         self._download_class_map = copy.copy(PROTOCOL_MAP)
@@ -64,9 +79,33 @@ class DownloaderFactory:
         self._handler_map = {'https': self._http_or_https, 'http': self._http_or_https,
                              'file': self._generic}
         self._session = self._make_aiohttp_session_from_remote()
-        self._semaphore = asyncio.Semaphore(value=remote.download_concurrency)
+        if max_download_concurrency is None:
+            max_download_concurrency = remote.download_concurrency
+        self._semaphore = AdaptiveSemaphore(
+            value=remote.download_concurrency,
+            max_value=max(max_download_concurrency, remote.download_concurrency),
+        )
+        self._circuit_breakers = {}
+        remote_rate_limit = getattr(remote, 'download_rate_limit', None)
+        if remote_rate_limit:
+            self._rate_limiter = TokenBucket(remote_rate_limit)
+        else:
+            self._rate_limiter = None
         atexit.register(self._session.close)
 
+    @property
+    def download_limit(self):
+        """
+        The number of downloads currently allowed to run simultaneously.
+
+        The limit starts at the `download_concurrency` of the remote and adapts to the server
+        behavior. See :class:`~pulpcore.plugin.download.AdaptiveSemaphore` for details.
+
+        Returns:
+            int: The current download concurrency limit.
+        """
+        return self._semaphore.limit
+
     def _make_aiohttp_session_from_remote(self):
         """
         Build a :class:`aiohttp.ClientSession` from the remote's settings and timing settings.
@@ -110,16 +149,25 @@ class DownloaderFactory:
             )
 
         timeout = aiohttp.ClientTimeout(total=None, sock_connect=600, sock_read=600)
-        return aiohttp.ClientSession(connector=conn, timeout=timeout, **auth_options)
+        return aiohttp.ClientSession(connector=conn, timeout=timeout,
+                                     trace_configs=[timing_trace_config()], **auth_options)
 
-    def build(self, url, **kwargs):
+    def build(self, url, priority=PRIORITY_BULK, decompress=False, **kwargs):
         """
         Build a downloader which can optionally verify integrity using either digest or size.
 
-        The built downloader also provides concurrency restriction if specified by the remote.
+        The built downloader also provides concurrency restriction if specified by the remote. All
+        downloaders built by one factory share an adaptive concurrency limit. Waiting downloaders
+        with a more important `priority` get a free download slot first.
 
         Args:
             url (str): The download URL.
+            priority (int): One of :data:`~pulpcore.plugin.download.PRIORITY_METADATA`,
+                :data:`~pulpcore.plugin.download.PRIORITY_AWAITED` or
+                :data:`~pulpcore.plugin.download.PRIORITY_BULK` (default).
+            decompress (bool): If True, the downloader decompresses gz, bz2 or xz data while
+                downloading it. See :class:`~pulpcore.plugin.download.DecompressingDownloaderMixin`
+                for the additional kwargs accepted.
             kwargs (dict): All kwargs are passed along to the downloader. At a minimum, these
                 include the :class:`~pulpcore.plugin.download.BaseDownloader` parameters.
 
@@ -127,7 +175,7 @@ class DownloaderFactory:
             subclass of :class:`~pulpcore.plugin.download.BaseDownloader`: A downloader that
             is configured with the remote settings.
         """
-        kwargs['semaphore'] = self._semaphore
+        kwargs['semaphore'] = self._semaphore.with_priority(priority)
         scheme = urlparse(url).scheme.lower()
         try:
             builder = self._handler_map[scheme]
@@ -135,6 +183,8 @@ class DownloaderFactory:
         except KeyError:
             raise ValueError(_('URL: {u} not supported.'.format(u=url)))
         else:
+            if decompress:
+                download_class = decompressing_downloader_class(download_class)
             return builder(download_class, url, **kwargs)
 
     def _http_or_https(self, download_class, url, **kwargs):
@@ -152,7 +202,16 @@ class DownloaderFactory:
             :class:`~pulpcore.plugin.download.HttpDownloader`: A downloader that
             is configured with the remote settings.
         """
-        options = {'session': self._session}
+        host = urlparse(url).netloc.lower()
+        try:
+            circuit_breaker = self._circuit_breakers[host]
+        except KeyError:
+            circuit_breaker = self._circuit_breakers[host] = CircuitBreaker(host)
+        options = {
+            'session': self._session,
+            'rate_limiters': [self._rate_limiter, worker_rate_limiter()],
+            'circuit_breaker': circuit_breaker,
+        }
         if self._remote.proxy_url:
             options['proxy'] = self._remote.proxy_url
 
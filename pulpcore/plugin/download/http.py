@@ -1,17 +1,17 @@
+import asyncio
+from gettext import gettext as _
 import logging
 
 import aiohttp
-import backoff
 
 from .base import BaseDownloader, DownloadResult
+from .retry import parse_retry_after, retry_delay
+from .statistics import DownloadTiming
 
 
 log = logging.getLogger(__name__)
 
 
-logging.getLogger('backoff').addHandler(logging.StreamHandler())
-
-
 def http_giveup(exc):
     """
     Inspect a raised exception and determine if we should give up.
@@ -32,6 +32,41 @@ def http_giveup(exc):
     return exc.code not in [429, 502, 503, 504]
 
 
+CONGESTION_STATUS_CODES = (429, 503)
+"""HTTP status codes signalling that the server is overloaded."""
+
+
+def timing_trace_config():
+    """
+    Create an `aiohttp.TraceConfig` measuring the connection time of downloads.
+
+    Add it to the `trace_configs` of an `aiohttp.ClientSession` to have the `connect` time of
+    :class:`~pulpcore.plugin.download.DownloadTiming` measured by the
+    :class:`~pulpcore.plugin.download.HttpDownloader` objects using that session. Reused
+    connections take no time to establish.
+
+    Returns:
+        aiohttp.TraceConfig: The trace config.
+    """
+    async def on_request_start(session, context, params):
+        if isinstance(context.trace_request_ctx, DownloadTiming):
+            context.trace_request_ctx.connect = 0.0
+
+    async def on_connection_create_start(session, context, params):
+        context.connect_start = asyncio.get_event_loop().time()
+
+    async def on_connection_create_end(session, context, params):
+        if isinstance(context.trace_request_ctx, DownloadTiming):
+            elapsed = asyncio.get_event_loop().time() - context.connect_start
+            context.trace_request_ctx.connect = elapsed
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_connection_create_start.append(on_connection_create_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    return trace_config
+
+
 class HttpDownloader(BaseDownloader):
     """
     An HTTP/HTTPS Downloader built on `aiohttp`.
@@ -92,7 +127,19 @@ class HttpDownloader(BaseDownloader):
 
     The HTTPDownloaders contain automatic retry logic if the server responds with HTTP 429 response.
     The coroutine will automatically retry 10 times with exponential backoff before allowing a
-    final exception to be raised.
+    final exception to be raised. The backoff is jittered, and a `Retry-After` header sent by the
+    server is honored instead. HTTP 429 and 503 responses are also reported to an
+    :class:`~pulpcore.plugin.download.AdaptiveSemaphore` passed as `semaphore`, which then lowers
+    the download concurrency.
+
+    A :class:`~pulpcore.plugin.download.CircuitBreaker` shared by all downloaders of a host pauses
+    them together while the host is overloaded. The
+    :class:`~pulpcore.plugin.download.DownloaderFactory` provides one per host.
+
+    The time to first byte, the transfer time and the number of retries are recorded in `timing`.
+    The connection time is recorded too if the session traces requests with
+    :func:`~pulpcore.plugin.download.timing_trace_config`, which the sessions created by the
+    HttpDownloader and the :class:`~pulpcore.plugin.download.DownloaderFactory` do.
 
     Attributes:
         session (aiohttp.ClientSession): The session to be used by the downloader.
@@ -104,13 +151,19 @@ class HttpDownloader(BaseDownloader):
             as its argument. The callback will be called when the response headers are
             available. The dictionary passed has the header names as the keys and header values
             as its values. e.g. `{'Transfer-Encoding': 'chunked'}`. This can also be None.
+        rate_limiters (list): :class:`~pulpcore.plugin.download.TokenBucket` objects the
+            response data is drawn from while reading it. Can be empty.
+        circuit_breaker (:class:`~pulpcore.plugin.download.CircuitBreaker`): The breaker pausing
+            all downloads to the host of `url` together, or None.
+        max_tries (int): The number of attempts before a retryable error is raised.
 
     This downloader also has all of the attributes of
     :class:`~pulpcore.plugin.download.BaseDownloader`
     """
 
     def __init__(self, url, session=None, auth=None, proxy=None, proxy_auth=None,
-                 headers_ready_callback=None, **kwargs):
+                 headers_ready_callback=None, rate_limiters=None, circuit_breaker=None,
+                 max_tries=10, **kwargs):
         """
         Args:
             url (str): The url to download.
@@ -124,6 +177,14 @@ class HttpDownloader(BaseDownloader):
                 as its argument. The callback will be called when the response headers are
                 available. The dictionary passed has the header names as the keys and header values
                 as its values. e.g. `{'Transfer-Encoding': 'chunked'}`
+            rate_limiters (list): An optional list of
+                :class:`~pulpcore.plugin.download.TokenBucket` objects limiting the download rate,
+                e.g. one per remote and one per worker. Each chunk read must be drawn from all of
+                them.
+            circuit_breaker (:class:`~pulpcore.plugin.download.CircuitBreaker`): An optional
+                breaker shared by all downloaders of the host of `url`.
+            max_tries (int): The number of attempts before a retryable error is raised. Defaults
+                to 10.
             kwargs (dict): This accepts the parameters of
                 :class:`~pulpcore.plugin.download.BaseDownloader`.
         """
@@ -133,12 +194,16 @@ class HttpDownloader(BaseDownloader):
         else:
             timeout = aiohttp.ClientTimeout(total=None, sock_connect=600, sock_read=600)
             conn = aiohttp.TCPConnector({'force_close': True})
-            self.session = aiohttp.ClientSession(connector=conn, timeout=timeout)
+            self.session = aiohttp.ClientSession(connector=conn, timeout=timeout,
+                                                 trace_configs=[timing_trace_config()])
             self._close_session_on_finalize = True
         self.auth = auth
         self.proxy = proxy
         self.proxy_auth = proxy_auth
         self.headers_ready_callback = headers_ready_callback
+        self.rate_limiters = [limiter for limiter in rate_limiters or [] if limiter is not None]
+        self.circuit_breaker = circuit_breaker
+        self.max_tries = max_tries
         super().__init__(url, **kwargs)
 
     async def _handle_response(self, response):
@@ -154,24 +219,31 @@ class HttpDownloader(BaseDownloader):
         """
         if self.headers_ready_callback:
             await self.headers_ready_callback(response.headers)
+        chunk_size = 1048576  # 1 megabyte
+        for limiter in self.rate_limiters:
+            # smaller chunks keep rate limited downloads smooth
+            chunk_size = min(chunk_size, max(int(limiter.capacity), 1024))
+        transfer_start = asyncio.get_event_loop().time()
         while True:
-            chunk = await response.content.read(1048576)  # 1 megabyte
+            chunk = await response.content.read(chunk_size)
             if not chunk:
                 await self.finalize()
                 break  # the download is done
+            for limiter in self.rate_limiters:
+                await limiter.consume(len(chunk))
             await self.handle_data(chunk)
+        self.timing.transfer = asyncio.get_event_loop().time() - transfer_start
         return DownloadResult(path=self.path, artifact_attributes=self.artifact_attributes,
                               url=self.url, headers=response.headers)
 
-    @backoff.on_exception(backoff.expo, aiohttp.ClientResponseError,
-                          max_tries=10, giveup=http_giveup)
     async def _run(self, extra_data=None):
         """
         Download, validate, and compute digests on the `url`. This is a coroutine.
 
-        This method is decorated with a backoff-and-retry behavior to retry HTTP 429 and
-        some 5XX errors. It retries with exponential backoff 10 times before allowing
-        a final exception to be raised.
+        This method retries HTTP 429 and some 5XX errors. It waits as long as a `Retry-After`
+        header asks for, or with jittered exponential backoff otherwise, and makes `max_tries`
+        attempts before allowing a final exception to be raised. Failures are reported to the
+        `circuit_breaker`, which may pause all downloads to the host.
 
         This method provides the same return object type and documented in
         :meth:`~pulpcore.plugin.download.BaseDownloader._run`.
@@ -179,10 +251,53 @@ class HttpDownloader(BaseDownloader):
         Args:
             extra_data (dict): Extra data passed by the downloader.
         """
-        async with self.session.get(self.url) as response:
+        attempt = 0
+        while True:
+            attempt += 1
+            if self.circuit_breaker:
+                await self.circuit_breaker.wait()
+            try:
+                to_return = await self._request()
+            except aiohttp.ClientResponseError as exc:
+                if http_giveup(exc):
+                    raise
+                retry_after = parse_retry_after((getattr(exc, 'headers', None) or {}).get(
+                    'Retry-After'))
+                if self.circuit_breaker:
+                    self.circuit_breaker.record_failure(retry_after)
+                if attempt >= self.max_tries:
+                    raise
+                if self.circuit_breaker and self.circuit_breaker.is_open:
+                    continue  # the breaker makes us wait
+                delay = retry_delay(attempt, retry_after)
+                log.info(_('Retrying %(url)s in %(delay).1f seconds after HTTP %(code)d.'),
+                         {'url': self.url, 'delay': delay, 'code': exc.code})
+                await asyncio.sleep(delay)
+            else:
+                break
+        self.timing.retries = attempt - 1
+        if self.circuit_breaker:
+            self.circuit_breaker.record_success()
+        if self._close_session_on_finalize:
+            await self.session.close()
+        return to_return
+
+    async def _request(self):
+        """
+        Make one request to the `url` and handle its response.
+
+        Returns:
+             DownloadResult: Contains information about the result.
+
+        Raises:
+            aiohttp.ClientResponseError: When the server responds with a 400+ status code.
+        """
+        request_start = asyncio.get_event_loop().time()
+        async with self.session.get(self.url, trace_request_ctx=self.timing) as response:
+            self.timing.ttfb = asyncio.get_event_loop().time() - request_start
+            if response.status in CONGESTION_STATUS_CODES:
+                self._report_to_semaphore('congestion_detected')
             response.raise_for_status()
             to_return = await self._handle_response(response)
             await response.release()
-        if self._close_session_on_finalize:
-            await self.session.close()
         return to_return
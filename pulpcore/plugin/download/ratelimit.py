@@ -0,0 +1,79 @@
+import asyncio
+from gettext import gettext as _
+
+from django.conf import settings
+
+
+_worker_rate_limiter = None
+
+
+class TokenBucket:
+    """
+    A token bucket limiting the rate at which bytes are downloaded.
+
+    Tokens are added to the bucket at `rate` tokens per second, up to `capacity` tokens. Consuming
+    more tokens than available puts the bucket into debt and the consumer waits until the debt is
+    paid off. Later consumers wait for the debt of earlier ones too, so the combined rate of all
+    consumers sharing one bucket stays at `rate`.
+
+    Usage:
+        >>> bucket = TokenBucket(rate=1024 * 1024)  # 1 MiB/s
+        >>> await bucket.consume(len(chunk))
+
+    Args:
+        rate (int): The number of tokens (bytes) added per second.
+        capacity (int): The maximum number of tokens that can be saved up for a burst. Defaults to
+            `rate`, which allows for bursts of one second.
+
+    Raises:
+        ValueError: When `rate` or `capacity` is not positive.
+    """
+
+    def __init__(self, rate, capacity=None):
+        if rate <= 0:
+            raise ValueError(_('TokenBucket rate must be positive.'))
+        if capacity is None:
+            capacity = rate
+        if capacity <= 0:
+            raise ValueError(_('TokenBucket capacity must be positive.'))
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last_refill = None
+
+    def _refill(self):
+        now = asyncio.get_event_loop().time()
+        if self._last_refill is not None:
+            self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    async def consume(self, amount):
+        """
+        Take `amount` tokens from the bucket, waiting until they are available.
+
+        Args:
+            amount (int): The number of tokens (bytes) to take.
+        """
+        self._refill()
+        self._tokens -= amount
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self.rate)
+
+
+def worker_rate_limiter():
+    """
+    Return the :class:`TokenBucket` shared by all downloads of this worker process.
+
+    The rate is configured with the `DOWNLOAD_RATE_LIMIT` setting in bytes per second. If the
+    setting is missing or empty, downloads are not limited per worker.
+
+    Returns:
+        :class:`TokenBucket`: The bucket shared in this process, or None if not limited.
+    """
+    global _worker_rate_limiter
+    rate = getattr(settings, 'DOWNLOAD_RATE_LIMIT', None)
+    if not rate:
+        return None
+    if _worker_rate_limiter is None or _worker_rate_limiter.rate != rate:
+        _worker_rate_limiter = TokenBucket(rate)
+    return _worker_rate_limiter
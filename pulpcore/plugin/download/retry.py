@@ -0,0 +1,163 @@
+import asyncio
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from gettext import gettext as _
+import logging
+import random
+
+
+log = logging.getLogger(__name__)
+
+
+#: (float): The longest pause in seconds, no matter what a server asks for.
+MAX_RETRY_DELAY = 600
+
+
+def parse_retry_after(value):
+    """
+    Parse the value of a `Retry-After` HTTP header.
+
+    Args:
+        value (str): Either a number of seconds or an HTTP-date.
+
+    Returns:
+        float: The number of seconds to wait, capped to `MAX_RETRY_DELAY`, or None if `value` is
+        missing or malformed.
+    """
+    if not value:
+        return None
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            retry_at = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if retry_at.tzinfo is None:
+            retry_at = retry_at.replace(tzinfo=timezone.utc)
+        delay = (retry_at - datetime.now(timezone.utc)).total_seconds()
+    return min(max(delay, 0), MAX_RETRY_DELAY)
+
+
+def backoff_delay(attempt, base=1, cap=MAX_RETRY_DELAY):
+    """
+    Compute an exponential backoff delay with full jitter.
+
+    Args:
+        attempt (int): The number of the failed attempt, starting at 1.
+        base (float): The delay ceiling of the first attempt in seconds.
+        cap (float): The highest delay ceiling in seconds.
+
+    Returns:
+        float: A random number of seconds between 0 and `base * 2 ** (attempt - 1)`, but at most
+        `cap`.
+    """
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+def retry_delay(attempt, retry_after=None):
+    """
+    Compute the delay before retrying a failed request.
+
+    Args:
+        attempt (int): The number of the failed attempt, starting at 1.
+        retry_after (float): The number of seconds the server asked to wait, or None.
+
+    Returns:
+        float: `retry_after` plus up to one second of jitter if the server asked for a delay,
+        a jittered exponential backoff otherwise.
+    """
+    if retry_after is not None:
+        return retry_after + random.uniform(0, 1)
+    return backoff_delay(attempt)
+
+
+class CircuitBreaker:
+    """
+    Pause all downloads to one host together while it is overloaded.
+
+    Downloaders call :meth:`wait` before each request and report the outcome with
+    :meth:`record_success` or :meth:`record_failure`. The breaker opens, i.e. pauses all
+    downloaders waiting on it:
+
+        * for the time a server asked for with a `Retry-After` header, or
+        * after `failure_threshold` consecutive failures, for an exponentially growing, jittered
+          time.
+
+    A success resets the failure count and the backoff. Downloaders that waited are
+    released with up to `jitter` seconds of random delay, so they don't hit the host all at once.
+
+    Args:
+        host (str): The host this breaker guards. Used for logging only.
+        failure_threshold (int): The number of consecutive failures opening the breaker.
+            Defaults to 5.
+        jitter (float): The maximum random delay in seconds added for waiting downloaders.
+            Defaults to 1.
+    """
+
+    def __init__(self, host, failure_threshold=5, jitter=1):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.jitter = jitter
+        self._failures = 0
+        self._trips = 0
+        self._open_until = None
+
+    @property
+    def is_open(self):
+        """
+        True if downloads to the host are currently paused.
+        """
+        return self._open_until is not None and self._now() < self._open_until
+
+    async def wait(self):
+        """
+        Wait until the breaker is closed.
+        """
+        waited = False
+        while self.is_open:
+            waited = True
+            await asyncio.sleep(self._open_until - self._now())
+        if waited and self.jitter:
+            await asyncio.sleep(random.uniform(0, self.jitter))
+
+    def record_success(self):
+        """
+        Record a successful request, which resets the failure count and the backoff.
+        """
+        self._failures = 0
+        self._trips = 0
+
+    def record_failure(self, retry_after=None):
+        """
+        Record a failed request and open the breaker if necessary.
+
+        Args:
+            retry_after (float): The number of seconds the server asked to wait, or None.
+        """
+        self._failures += 1
+        if retry_after is not None:
+            self.open(retry_after)
+        elif self._failures >= self.failure_threshold:
+            self._trips += 1
+            self._failures = 0
+            self.open(backoff_delay(self._trips))
+
+    def open(self, delay):
+        """
+        Pause all downloads to the host for `delay` seconds.
+
+        An already open breaker stays open for the longer of both delays.
+
+        Args:
+            delay (float): The number of seconds to pause.
+        """
+        open_until = self._now() + delay
+        if self._open_until is None or open_until > self._open_until:
+            log.info(_('Pausing downloads from %(host)s for %(delay).1f seconds.'),
+                     {'host': self.host, 'delay': delay})
+            self._open_until = open_until
+
+    @staticmethod
+    def _now():
+        return asyncio.get_event_loop().time()
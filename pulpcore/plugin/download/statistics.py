@@ -0,0 +1,160 @@
+from collections import defaultdict
+from gettext import gettext as _
+import json
+from urllib.parse import urlparse
+
+from pulpcore.app.models import ProgressReport
+from pulpcore.constants import TASK_STATES
+
+
+class DownloadTiming:
+    """
+    Timing data of a single download.
+
+    Durations are in seconds and None if the downloader could not measure them.
+
+    Attributes:
+        semaphore_wait (float): Time spent waiting for the download semaphore.
+        connect (float): Time spent establishing the connection of the successful attempt.
+        ttfb (float): Time from sending the request of the successful attempt until the response
+            headers arrived.
+        transfer (float): Time spent receiving the data of the successful attempt.
+        total (float): Time from acquiring the semaphore until the download finished, including
+            retries.
+        size (int): The number of bytes downloaded.
+        retries (int): The number of failed attempts before the successful one.
+    """
+
+    __slots__ = ('semaphore_wait', 'connect', 'ttfb', 'transfer', 'total', 'size', 'retries')
+
+    def __init__(self):
+        self.semaphore_wait = None
+        self.connect = None
+        self.ttfb = None
+        self.transfer = None
+        self.total = None
+        self.size = 0
+        self.retries = 0
+
+    def as_dict(self):
+        """
+        Returns:
+            dict: The timing data keyed on the attribute names.
+        """
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class DownloadStatistics:
+    """
+    Aggregate :class:`DownloadTiming` data per remote and host.
+
+    Usage:
+        >>> statistics = DownloadStatistics()
+        >>> statistics.add(remote, download_result)
+        >>> statistics.summary()
+        {'my-remote': {'cdn.example.com': {'downloads': 1, 'bytes': 1024, ...}}}
+
+    Attributes:
+        DURATIONS (tuple): The :class:`DownloadTiming` durations averaged in the summary.
+    """
+
+    DURATIONS = ('semaphore_wait', 'connect', 'ttfb', 'transfer', 'total')
+
+    def __init__(self):
+        self._stats = defaultdict(self._new_stats)
+
+    def _new_stats(self):
+        stats = {'downloads': 0, 'bytes': 0, 'retries': 0}
+        for name in self.DURATIONS:
+            stats[name] = [0.0, 0]  # sum and number of measurements
+        return stats
+
+    def __bool__(self):
+        return bool(self._stats)
+
+    def add(self, remote, download_result):
+        """
+        Add the timing data of a download.
+
+        Results without :class:`DownloadTiming` data are ignored.
+
+        Args:
+            remote (:class:`~pulpcore.plugin.models.Remote`): The remote used for the download.
+            download_result (:class:`~pulpcore.plugin.download.DownloadResult`): The result of the
+                download.
+        """
+        timing = getattr(download_result, 'timing', None)
+        if not isinstance(timing, DownloadTiming):
+            return
+        host = urlparse(download_result.url).netloc or urlparse(download_result.url).scheme
+        stats = self._stats[(getattr(remote, 'name', str(remote)), host)]
+        stats['downloads'] += 1
+        stats['bytes'] += timing.size
+        stats['retries'] += timing.retries
+        for name in self.DURATIONS:
+            value = getattr(timing, name)
+            if value is not None:
+                stats[name][0] += value
+                stats[name][1] += 1
+
+    def summary(self):
+        """
+        Summarize the downloads per remote and host.
+
+        Returns:
+            dict: Keyed on the remote name, then the host. Each value holds the number of
+            `downloads`, `bytes` and `retries`, the average of each duration in `DURATIONS` and the
+            `throughput` in bytes per second of transfer time.
+        """
+        summary = defaultdict(dict)
+        for (remote_name, host), stats in self._stats.items():
+            host_summary = {
+                'downloads': stats['downloads'],
+                'bytes': stats['bytes'],
+                'retries': stats['retries'],
+            }
+            for name in self.DURATIONS:
+                total, count = stats[name]
+                host_summary[name] = total / count if count else None
+            transfer_total = stats['transfer'][0]
+            host_summary['throughput'] = stats['bytes'] / transfer_total if transfer_total else None
+            summary[remote_name][host] = host_summary
+        return dict(summary)
+
+    def save(self):
+        """
+        Save the summary with the current task, as one completed ProgressReport.
+
+        The `total` and `done` counts of the report are the number of downloads, and its `suffix`
+        holds the :meth:`summary` as JSON.
+        """
+        summary = self.summary()
+        downloads = sum(
+            host_summary['downloads'] for hosts in summary.values()
+            for host_summary in hosts.values()
+        )
+        ProgressReport(
+            message=_('Download statistics'),
+            state=TASK_STATES.COMPLETED,
+            total=downloads,
+            done=downloads,
+            suffix=json.dumps(summary, sort_keys=True),
+        ).save()
+
+    def log(self, logger):
+        """
+        Log the summary at INFO level, one message per remote and host.
+
+        Args:
+            logger (logging.Logger): The logger to log with.
+        """
+        for remote_name, hosts in self.summary().items():
+            for host, host_summary in hosts.items():
+                values = ', '.join(
+                    '{key}={value}'.format(
+                        key=key, value='{:.3f}'.format(value) if isinstance(value, float) else value
+                    )
+                    for key, value in host_summary.items()
+                )
+                logger.info(_('Download statistics for %(remote)s from %(host)s: %(values)s'),
+                            {'remote': remote_name, 'host': host, 'values': values})
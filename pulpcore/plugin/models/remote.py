@@ -23,6 +23,17 @@ class Remote(PlatformRemote):
     :class: `pulpcore.plugin.serializers.repository.RemoteSerializer`.
     """
 
+    #: (int): The maximum number of bytes per second to download from this remote, shared by all
+    #: downloaders of its DownloaderFactory. None means unlimited. Plugin writers may override this
+    #: with a Django field to make it configurable.
+    download_rate_limit = None
+
+    #: (str): Identifies the upstream state, the repository version created and the options of the
+    #: last sync from this remote, see :meth:`~pulpcore.plugin.stages.DeclarativeVersion.create`.
+    #: Syncs of an unchanged upstream are only skipped if plugin writers override this with a
+    #: Django field, e.g. ``models.TextField(null=True)``.
+    last_sync_fingerprint = None
+
     class Meta:
         abstract = True
 
@@ -61,7 +72,10 @@ class Remote(PlatformRemote):
                 download.
             url (str): The URL to download.
             kwargs (dict): This accepts the parameters of
-                :class:`~pulpcore.plugin.download.BaseDownloader`.
+                :class:`~pulpcore.plugin.download.BaseDownloader` and the `priority` of
+                :meth:`~pulpcore.plugin.download.DownloaderFactory.build`. Downloads default to the
+                lowest priority, meant for artifacts. Pass
+                :data:`~pulpcore.plugin.download.PRIORITY_METADATA` for metadata.
 
         Raises:
             ValueError: If neither remote_artifact and url are passed, or if both are passed.
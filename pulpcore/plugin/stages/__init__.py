@@ -1,4 +1,12 @@
-from .api import create_pipeline, EndStage, Stage  # noqa
+from .api import (  # noqa
+    BatchStage,
+    create_pipeline,
+    EndStage,
+    FanOut,
+    fuse_stages,
+    FusedStage,
+    Stage,
+)
 from .artifact_stages import (  # noqa
     ArtifactDownloader,
     ArtifactSaver,
@@ -7,10 +15,21 @@ from .artifact_stages import (  # noqa
 )
 from .association_stages import (  # noqa
     ContentAssociation,
+    ContentDeltaAssociation,
     ContentUnassociation,
     RemoveDuplicates
 )
+from .budget import BudgetedQueue, estimate_size, MemoryBudget  # noqa
 from .content_stages import ContentSaver, QueryExistingContents, ResolveContentFutures  # noqa
-from .declarative_version import DeclarativeVersion  # noqa
+from .declarative_version import (  # noqa
+    DeclarativeVersion,
+    MultiDeclarativeVersion,
+    RepositoryTarget,
+)
+from .distributed import DistributedArtifactDownloader, download_artifacts  # noqa
 from .models import DeclarativeArtifact, DeclarativeContent  # noqa
+from .plan import SyncPlan, SyncPlanner  # noqa
+from .progress import ProgressReporter  # noqa
+from .records import materialize, model_of, Record  # noqa
+from .spill import SpillQueue  # noqa
 from .profiler import ProfilingQueue, create_profile_db_and_connection  # noqa
@@ -5,7 +5,9 @@ from gettext import gettext as _
 
 from django.conf import settings
 
+from .budget import BudgetedQueue, MemoryBudget
 from .profiler import ProfilingQueue
+from .spill import SpillQueue
 
 
 log = logging.getLogger(__name__)
@@ -21,6 +23,7 @@ class Stage:
     def __init__(self):
         self._in_q = None
         self._out_q = None
+        self._pipeline_limits = {}
 
     def _connect(self, in_q, out_q):
         """
@@ -54,6 +57,24 @@ class Stage:
         """
         raise NotImplementedError(_('A plugin writer must implement this method'))
 
+    async def upstream_fingerprint(self):
+        """
+        Identify the state of the upstream this stage declares content from.
+
+        A first stage can implement this to let :class:`DeclarativeVersion` skip syncs of an
+        unchanged upstream, e.g. by returning the checksum or revision of the upstream metadata.
+        The fingerprint is stored in the
+        :attr:`~pulpcore.plugin.models.Remote.last_sync_fingerprint` field of the Remote, which the
+        plugin's Remote model needs to define. It is called before :meth:`run`, so it may keep the
+        metadata it downloaded for :meth:`run`.
+
+        Returns:
+            tuple: The :class:`~pulpcore.plugin.models.Remote` synced from and a string identifying
+            the upstream state, or None to always sync. The default is None.
+
+        """
+        return None
+
     async def items(self):
         """
         Asynchronous iterator yielding items of :class:`DeclarativeContent` from `self._in_q`.
@@ -163,7 +184,117 @@ class Stage:
         return '[{id}] {name}'.format(id=id(self), name=self.__class__.__name__)
 
 
-async def create_pipeline(stages, maxsize=100):
+class BatchStage(Stage):
+    """
+    The base class for stages handling one batch of items at a time and passing it on as a whole.
+
+    To make such a stage, inherit from this class and implement :meth:`handle_batch` on the
+    subclass. Consecutive instances are fused into one :class:`FusedStage` by
+    :func:`create_pipeline`, which passes each batch through all of them without a queue in
+    between. Subclasses overriding :meth:`run` are not fused.
+
+    Attributes:
+        BATCH_MINSIZE (int): The minimum batch size passed to :meth:`batches`.
+    """
+
+    BATCH_MINSIZE = 50
+
+    async def run(self):
+        """
+        The coroutine for this stage.
+
+        Returns:
+            The coroutine for this stage.
+        """
+        async for batch in self.batches(self.BATCH_MINSIZE):
+            await self.handle_batch(batch)
+            for d_content in batch:
+                await self.put(d_content)
+
+    async def handle_batch(self, batch):
+        """
+        Handle a batch of :class:`DeclarativeContent` objects.
+
+        The objects are passed on to the next stage after this coroutine returns.
+
+        Args:
+            batch (list): The :class:`DeclarativeContent` objects to handle.
+        """
+        raise NotImplementedError(_('A plugin writer must implement this method'))
+
+    @property
+    def fusable(self):
+        """
+        bool: Whether this stage can be fused with its neighbours, i.e. doesn't override `run()`.
+        """
+        return type(self).run is BatchStage.run
+
+
+class FusedStage(BatchStage):
+    """
+    A stage running consecutive :class:`BatchStage` instances on the same batches in order.
+
+    This saves the queues between the stages and the assembly of a batch in each of them. The
+    minimum batch size is the smallest one of the stages, so stages passing items on as soon as
+    possible, like :class:`~pulpcore.plugin.stages.ResolveContentFutures`, don't wait for larger
+    batches when fused.
+
+    Args:
+        stages (list): The :class:`BatchStage` instances to run.
+    """
+
+    def __init__(self, stages):
+        super().__init__()
+        self.stages = stages
+        self.BATCH_MINSIZE = min(stage.BATCH_MINSIZE for stage in stages)
+
+    async def handle_batch(self, batch):
+        """
+        Handle a batch with each of the fused stages.
+
+        Args:
+            batch (list): The :class:`DeclarativeContent` objects to handle.
+        """
+        for stage in self.stages:
+            await stage.handle_batch(batch)
+
+    def __str__(self):
+        return '[{id}] {name}({stages})'.format(
+            id=id(self),
+            name=self.__class__.__name__,
+            stages=', '.join(stage.__class__.__name__ for stage in self.stages),
+        )
+
+
+def fuse_stages(stages):
+    """
+    Fuse runs of consecutive fusable :class:`BatchStage` instances into :class:`FusedStage` ones.
+
+    Args:
+        stages (list): The stages of a pipeline.
+
+    Returns:
+        list: The stages with each run of more than one fusable stage replaced by a
+        :class:`FusedStage`.
+    """
+    fused = []
+    run = []
+    for stage in stages + [None]:
+        if isinstance(stage, BatchStage) and stage.fusable:
+            run.append(stage)
+            continue
+        if len(run) > 1:
+            fused.append(FusedStage(run))
+        else:
+            fused.extend(run)
+        run = []
+        if stage is not None:
+            fused.append(stage)
+    return fused
+
+
+async def create_pipeline(stages, maxsize=100, max_link_bytes=None, max_pipeline_bytes=None,
+                          spill_after=None, budget=None):
     """
     A coroutine that builds a Stages API linear pipeline from the list `stages` and runs it.
 
@@ -177,10 +308,37 @@ async def create_pipeline(stages, maxsize=100):
     >>>         async for d_content in self.items():  # Fetch items from the previous stage
     >>>             await self.put(d_content)  # Hand them over to the next stage
 
+    Consecutive :class:`BatchStage` instances are fused with :func:`fuse_stages` to run in one
+    coroutine, unless `PROFILE_STAGES_API` is set to measure each of them.
+
+    The queues can also be limited by the estimated memory of their items, see
+    :class:`~pulpcore.plugin.stages.BudgetedQueue`. This keeps the memory predictable when the
+    items vary a lot in size, e.g. units with thousands of Artifacts or large `extra_data`.
+    Pipelines nested in a stage, like the branches of a :class:`FanOut`, share the budget of the
+    enclosing pipeline.
+
+    With `spill_after`, the queue after the first stage is a
+    :class:`~pulpcore.plugin.stages.SpillQueue` that writes the items beyond that number to a file
+    in the working directory of the task instead of blocking the first stage, up to the
+    `PIPELINE_SPILL_MAX_BYTES` setting or 1 GiB. This suits first stages declaring millions of
+    units from metadata they hold in memory, which they can free once all units are declared. The
+    first stage must not change the items it put, because spilled items are read back as copies.
+    Pipelines nested in a stage, like the branches of a :class:`FanOut`, never spill.
+
     Args:
         stages (list of coroutines): A list of Stages API compatible coroutines.
         maxsize (int): The maximum amount of items a queue between two stages should hold. Optional
             and defaults to 100.
+        max_link_bytes (int): The estimated bytes the items in one queue may take. Optional and
+            defaults to the `PIPELINE_LINK_MEMORY_BUDGET` setting, no limit if that is unset.
+        max_pipeline_bytes (int): The estimated bytes the items in all queues may take together.
+            Optional and defaults to the `PIPELINE_MEMORY_BUDGET` setting, no limit if that is
+            unset.
+        spill_after (int): The number of items the queue after the first stage holds in memory
+            before spilling to disk. Optional and defaults to the `PIPELINE_SPILL_AFTER` setting,
+            no spilling if that is unset or 0. Ignored when `PROFILE_STAGES_API` is set.
+        budget (:class:`~pulpcore.plugin.stages.MemoryBudget`): The budget of an enclosing
+            pipeline to share instead of one of `max_pipeline_bytes`. Optional.
 
     Returns:
         A single coroutine that can be used to run, wait, or cancel the entire pipeline with.
@@ -190,13 +348,40 @@ async def create_pipeline(stages, maxsize=100):
     futures = []
     history = set()
     in_q = None
-    for i, stage in enumerate(stages):
+    if max_link_bytes is None:
+        max_link_bytes = getattr(settings, 'PIPELINE_LINK_MEMORY_BUDGET', None)
+    if max_pipeline_bytes is None:
+        max_pipeline_bytes = getattr(settings, 'PIPELINE_MEMORY_BUDGET', None)
+    pipeline_budget = budget
+    if pipeline_budget is None and max_pipeline_bytes:
+        pipeline_budget = MemoryBudget(max_pipeline_bytes)
+    for stage in stages:
         if stage in history:
             raise ValueError(_('Each stage instance must be unique.'))
         history.add(stage)
+        # for the pipelines nested in the stage, e.g. the branches of a FanOut
+        stage._pipeline_limits = {
+            'max_link_bytes': max_link_bytes,
+            'budget': pipeline_budget,
+            'spill_after': 0,
+        }
+    if not settings.PROFILE_STAGES_API:
+        stages = fuse_stages(stages)
+    if spill_after is None:
+        spill_after = getattr(settings, 'PIPELINE_SPILL_AFTER', None)
+    spill_queues = []
+    for i, stage in enumerate(stages):
         if i < len(stages) - 1:
             if settings.PROFILE_STAGES_API:
                 out_q = ProfilingQueue.make_and_record_queue(stages[i + 1], i + 1, maxsize)
+            elif i == 0 and spill_after:
+                out_q = SpillQueue(
+                    memory_items=spill_after,
+                    max_bytes=getattr(settings, 'PIPELINE_SPILL_MAX_BYTES', SpillQueue.MAX_BYTES),
+                )
+                spill_queues.append(out_q)
+            elif max_link_bytes or pipeline_budget:
+                out_q = BudgetedQueue(max_link_bytes, pipeline_budget, maxsize=maxsize)
             else:
                 out_q = asyncio.Queue(maxsize=maxsize)
         else:
@@ -218,6 +403,9 @@ async def create_pipeline(stages, maxsize=100):
         if pending:
             await asyncio.wait(pending, timeout=60)
         raise
+    finally:
+        for queue in spill_queues:
+            queue.close()
 
 
 class EndStage(Stage):
@@ -238,3 +426,129 @@ class EndStage(Stage):
         # We overwrite __call__ here to avoid trying to put None in `self._out_q`.
         async for _ in self.items():  # noqa
             pass
+
+
+class _Feed(Stage):
+    """
+    The first stage of a :class:`FanOut` branch, passing on the items put into `queue`.
+    """
+
+    def __init__(self, maxsize):
+        super().__init__()
+        self.queue = asyncio.Queue(maxsize=maxsize)
+
+    async def run(self):
+        """
+        The coroutine for this stage.
+
+        Returns:
+            The coroutine for this stage.
+        """
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                break
+            await self.put(item)
+
+
+class FanOut(Stage):
+    """
+    A Stages API stage passing each item to several branches of stages and on to the next stage.
+
+    Each branch is a list of stages run as a pipeline of its own with :func:`create_pipeline`,
+    which receives the items its filter accepts, in order. The branches must end with an
+    :class:`EndStage`. This lets one pipeline query, download and save content once and associate
+    it with several repository versions, see
+    :class:`~pulpcore.plugin.stages.MultiDeclarativeVersion`.
+
+    The queues of the branches count against the memory budget of the enclosing pipeline, see
+    :func:`create_pipeline`. The items are passed to the next stage once all branches accepted
+    them, so the slowest branch sets the pace. The stage finishes when all branches finished. If a
+    branch fails, the other branches are cancelled and the error is raised by this stage right
+    away. The branches are also cancelled if this stage is.
+
+    Args:
+        branches (list): Tuples of a filter and the list of stages of a branch. The filter is a
+            callable taking an item and returning whether the branch receives it, or None for a
+            branch receiving all items.
+        maxsize (int): The maximum amount of items a queue within a branch should hold. Optional
+            and defaults to 100.
+        args: unused positional arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
+        kwargs: unused keyword arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
+    """
+
+    def __init__(self, branches, maxsize=100, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.branches = branches
+        self.maxsize = maxsize
+
+    async def run(self):
+        """
+        The coroutine for this stage.
+
+        Returns:
+            The coroutine for this stage.
+        """
+        feeds = []
+        pipelines = []
+        for accepts, stages in self.branches:
+            feed = _Feed(self.maxsize)
+            feeds.append((accepts, feed.queue))
+            pipelines.append(
+                asyncio.ensure_future(create_pipeline([feed] + list(stages), maxsize=self.maxsize,
+                                                      **self._pipeline_limits))
+            )
+        feeding = asyncio.ensure_future(self._feed_branches(feeds, pipelines))
+        try:
+            # a failing branch stops the feeding and the other branches right away
+            done, pending = await asyncio.wait([feeding] + pipelines,
+                                               return_when=asyncio.FIRST_EXCEPTION)
+            for future in pipelines + [feeding]:
+                if future in done:
+                    future.result()
+        finally:
+            pending = [future for future in [feeding] + pipelines if not future.done()]
+            for future in pending:
+                future.cancel()
+            if pending:
+                await asyncio.wait(pending, timeout=60)
+
+    async def _feed_branches(self, feeds, pipelines):
+        """
+        Pass the items to the branches accepting them and on to the next stage.
+
+        Args:
+            feeds (list): Tuples of the filter and the queue of the first stage of each branch.
+            pipelines (list): The pipelines of the branches.
+        """
+        async for item in self.items():
+            for (accepts, queue), pipeline in zip(feeds, pipelines):
+                if accepts is None or accepts(item):
+                    await self._feed(queue, item, pipeline)
+            await self.put(item)
+        for (accepts, queue), pipeline in zip(feeds, pipelines):
+            await self._feed(queue, None, pipeline)
+
+    @staticmethod
+    async def _feed(queue, item, pipeline):
+        """
+        Put an item into the queue of a branch, raising the error of the branch if it failed.
+
+        Args:
+            queue (asyncio.Queue): The queue of the first stage of the branch.
+            item: The item to put.
+            pipeline (asyncio.Future): The pipeline of the branch.
+        """
+        if not queue.full():
+            queue.put_nowait(item)
+            return
+        put = asyncio.ensure_future(queue.put(item))
+        try:
+            await asyncio.wait([put, pipeline], return_when=asyncio.FIRST_COMPLETED)
+            if put.done():
+                return
+            pipeline.result()
+            raise RuntimeError(_('A branch finished before receiving all items.'))
+        finally:
+            if not put.done():
+                put.cancel()
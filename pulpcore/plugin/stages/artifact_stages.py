@@ -1,17 +1,22 @@
 import asyncio
+from collections import defaultdict
 from gettext import gettext as _
 import logging
 
-from django.db.models import Q, Prefetch, prefetch_related_objects
+import django
+from django.db.models import Prefetch, prefetch_related_objects
 
+from pulpcore.plugin.download import DownloadStatistics
 from pulpcore.plugin.models import Artifact, ContentArtifact, ProgressBar, RemoteArtifact
 
-from .api import Stage
+from .api import BatchStage, Stage
+from .progress import ProgressReporter
+from .records import materialize
 
 log = logging.getLogger(__name__)
 
 
-class QueryExistingArtifacts(Stage):
+class QueryExistingArtifacts(BatchStage):
     """
     A Stages API stage that replaces :attr:`DeclarativeContent.content` objects with already-saved
     :class:`~pulpcore.plugin.models.Artifact` objects.
@@ -30,35 +35,50 @@ class QueryExistingArtifacts(Stage):
     Each :class:`~pulpcore.plugin.stages.DeclarativeContent` is sent to `self._out_q` after all of
     its :class:`~pulpcore.plugin.stages.DeclarativeArtifact` objects have been handled.
 
-    This stage drains all available items from `self._in_q` and batches everything into one large
-    call to the db for efficiency.
+    This stage drains all available items from `self._in_q` and batches everything into one call to
+    the db per digest type for efficiency. Each unsaved Artifact is looked up by the strongest
+    digest it has, and the results are matched through a dictionary indexed by digest value.
     """
 
-    async def run(self):
+    async def handle_batch(self, batch):
         """
-        The coroutine for this stage.
+        Handle a batch of :class:`~pulpcore.plugin.stages.DeclarativeContent` objects.
+
+        Args:
+            batch (list): The :class:`~pulpcore.plugin.stages.DeclarativeContent` objects to
+                handle.
+        """
+        d_artifacts_by_digest = self._index_by_digest(batch)
+        for digest_name, d_artifacts_by_value in d_artifacts_by_digest.items():
+            query_kwargs = {'{name}__in'.format(name=digest_name): list(d_artifacts_by_value)}
+            for artifact in Artifact.objects.filter(**query_kwargs):
+                digest_value = getattr(artifact, digest_name)
+                for d_artifact in d_artifacts_by_value[digest_value]:
+                    d_artifact.artifact = artifact
+
+    @staticmethod
+    def _index_by_digest(batch):
+        """
+        Index the unsaved Artifacts of a batch by their strongest known digest.
+
+        Args:
+            batch (list): The :class:`~pulpcore.plugin.stages.DeclarativeContent` objects to index.
 
         Returns:
-            The coroutine for this stage.
+            dict: Keyed on the digest name, with dicts mapping each digest value to the list of
+            :class:`~pulpcore.plugin.stages.DeclarativeArtifact` objects with that digest.
         """
-        async for batch in self.batches():
-            all_artifacts_q = Q(_created=None)
-            for d_content in batch:
-                for d_artifact in d_content.d_artifacts:
-                    one_artifact_q = d_artifact.artifact.q()
-                    if one_artifact_q:
-                        all_artifacts_q |= one_artifact_q
-
-            for artifact in Artifact.objects.filter(all_artifacts_q):
-                for d_content in batch:
-                    for d_artifact in d_content.d_artifacts:
-                        for digest_name in artifact.DIGEST_FIELDS:
-                            digest_value = getattr(d_artifact.artifact, digest_name)
-                            if digest_value and digest_value == getattr(artifact, digest_name):
-                                d_artifact.artifact = artifact
-                                break
-            for d_content in batch:
-                await self.put(d_content)
+        d_artifacts_by_digest = defaultdict(lambda: defaultdict(list))
+        for d_content in batch:
+            for d_artifact in d_content.d_artifacts:
+                if not d_artifact.artifact._state.adding:
+                    continue
+                for digest_name in Artifact.DIGEST_FIELDS:
+                    digest_value = getattr(d_artifact.artifact, digest_name)
+                    if digest_value:
+                        d_artifacts_by_digest[digest_name][digest_value].append(d_artifact)
+                        break
+        return d_artifacts_by_digest
 
 
 class ArtifactDownloader(Stage):
@@ -76,22 +96,68 @@ class ArtifactDownloader(Stage):
     its :class:`~pulpcore.plugin.stages.DeclarativeArtifact` objects have been handled.
 
     This stage creates a ProgressBar named 'Downloading Artifacts' that counts the number of
-    downloads completed. Since it's a stream the total count isn't known until it's finished.
+    downloads completed. Since it's a stream the total count isn't known until it's finished. The
+    ProgressBar is saved through a :class:`~pulpcore.plugin.stages.ProgressReporter`.
+
+    The timing data of the downloads is aggregated per Remote and host in a
+    :class:`~pulpcore.plugin.download.DownloadStatistics`, which is logged and saved with the task
+    once all content has been handled.
 
     This stage drains all available items from `self._in_q` and starts as many downloaders as
-    possible (up to `download_concurrency` set on a Remote)
+    possible (up to the download limit of a Remote, see
+    :attr:`~pulpcore.plugin.download.DownloaderFactory.download_limit`)
 
     Args:
         max_concurrent_content (int): The maximum number of
             :class:`~pulpcore.plugin.stages.DeclarativeContent` instances to handle simultaneously.
-            Default is 200.
+            By default, it follows the current download limits of the Remotes seen so far,
+            allowing `CONTENT_PER_DOWNLOAD_SLOT` instances per download slot. Until a Remote is
+            seen, 200 is used.
         args: unused positional arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
         kwargs: unused keyword arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
     """
 
-    def __init__(self, max_concurrent_content=200, *args, **kwargs):
+    #: (int): Content units handled simultaneously for each download slot of the Remotes.
+    CONTENT_PER_DOWNLOAD_SLOT = 10
+
+    def __init__(self, max_concurrent_content=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.max_concurrent_content = max_concurrent_content
+        self._remotes = {}
+        self._statistics = DownloadStatistics()
+
+    def _max_concurrent_content(self):
+        """
+        The number of content units to handle simultaneously.
+
+        Returns:
+            int: `max_concurrent_content` if set, otherwise a value derived from the current
+            download limits of the Remotes seen so far.
+        """
+        if self.max_concurrent_content:
+            return self.max_concurrent_content
+        if not self._remotes:
+            return 200
+        download_slots = 0
+        for remote in self._remotes.values():
+            try:
+                download_slots += remote.download_factory.download_limit
+            except AttributeError:
+                download_slots += remote.download_concurrency
+        return download_slots * self.CONTENT_PER_DOWNLOAD_SLOT
+
+    def _record_remotes(self, d_content):
+        """
+        Remember the Remotes used by `d_content` to derive the content concurrency from.
+
+        Args:
+            d_content (:class:`~pulpcore.plugin.stages.DeclarativeContent`): The content unit
+                about to be handled.
+        """
+        if self.max_concurrent_content:
+            return
+        for d_artifact in d_content.d_artifacts:
+            self._remotes.setdefault(id(d_artifact.remote), d_artifact.remote)
 
     async def run(self):
         """
@@ -116,30 +182,35 @@ class ArtifactDownloader(Stage):
         #    Set to None if stage is shutdown.
         content_get_task = _add_to_pending(content_iterator.__anext__())
 
-        with ProgressBar(message='Downloading Artifacts') as pb:
+        with ProgressReporter(ProgressBar(message='Downloading Artifacts')) as progress:
             try:
                 while pending:
                     done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
                     for task in done:
                         if task is content_get_task:
                             try:
-                                _add_to_pending(self._handle_content_unit(task.result()))
+                                d_content = task.result()
                             except StopAsyncIteration:
                                 # previous stage is finished and we retrieved all
                                 # content instances: shutdown
                                 content_get_task = None
+                            else:
+                                self._record_remotes(d_content)
+                                _add_to_pending(self._handle_content_unit(d_content))
                         else:
-                            pb.done += task.result()  # download_count
-                            pb.save()
+                            progress.increment(task.result())  # download_count
 
                     if content_get_task and content_get_task not in pending:  # not yet shutdown
-                        if len(pending) < self.max_concurrent_content:
+                        if len(pending) < self._max_concurrent_content():
                             content_get_task = _add_to_pending(content_iterator.__anext__())
             except asyncio.CancelledError:
                 # asyncio.wait does not cancel its tasks when cancelled, we need to do this
                 for future in pending:
                     future.cancel()
                 raise
+        if self._statistics:
+            self._statistics.log(log)
+            self._statistics.save()
 
     async def _handle_content_unit(self, d_content):
         """Handle one content unit.
@@ -147,17 +218,22 @@ class ArtifactDownloader(Stage):
         Returns:
             The number of downloads
         """
-        downloaders_for_content = [
-            d_artifact.download() for d_artifact in d_content.d_artifacts
+        d_artifacts_to_download = [
+            d_artifact for d_artifact in d_content.d_artifacts
             if d_artifact.artifact._state.adding and not d_artifact.deferred_download
         ]
-        if downloaders_for_content:
-            await asyncio.gather(*downloaders_for_content)
+        if d_artifacts_to_download:
+            results = await asyncio.gather(*[
+                d_artifact.download(priority=d_content.download_priority)
+                for d_artifact in d_artifacts_to_download
+            ])
+            for d_artifact, result in zip(d_artifacts_to_download, results):
+                self._statistics.add(d_artifact.remote, result)
         await self.put(d_content)
-        return len(downloaders_for_content)
+        return len(d_artifacts_to_download)
 
 
-class ArtifactSaver(Stage):
+class ArtifactSaver(BatchStage):
     """
     A Stages API stage that saves any unsaved :attr:`DeclarativeArtifact.artifact` objects.
 
@@ -168,55 +244,89 @@ class ArtifactSaver(Stage):
 
     Any unsaved :class:`~pulpcore.plugin.models.Artifact` objects are saved. Each
     :class:`~pulpcore.plugin.stages.DeclarativeContent` is sent to `self._out_q` after all of its
-    :class:`~pulpcore.plugin.stages.DeclarativeArtifact` objects have been handled.
+    :class:`~pulpcore.plugin.stages.DeclarativeArtifact` objects have been handled. Units declared
+    as `removed` are passed on untouched.
 
     This stage drains all available items from `self._in_q` and batches everything into one large
     call to the db for efficiency.
     """
 
-    async def run(self):
+    async def handle_batch(self, batch):
         """
-        The coroutine for this stage.
+        Handle a batch of :class:`~pulpcore.plugin.stages.DeclarativeContent` objects.
 
-        Returns:
-            The coroutine for this stage.
+        Args:
+            batch (list): The :class:`~pulpcore.plugin.stages.DeclarativeContent` objects to
+                handle.
         """
-        async for batch in self.batches():
-            da_to_save = []
-            for d_content in batch:
-                for d_artifact in d_content.d_artifacts:
-                    if d_artifact.artifact._state.adding and not d_artifact.deferred_download:
-                        d_artifact.artifact.file = str(d_artifact.artifact.file)
-                        da_to_save.append(d_artifact)
-
-            if da_to_save:
-                for d_artifact, artifact in zip(da_to_save, Artifact.objects.bulk_get_or_create(
-                        d_artifact.artifact for d_artifact in da_to_save)):
-                    d_artifact.artifact = artifact
+        da_to_save = []
+        for d_content in batch:
+            if d_content.removed:
+                continue
+            for d_artifact in d_content.d_artifacts:
+                if d_artifact.artifact._state.adding and not d_artifact.deferred_download:
+                    d_artifact.artifact = materialize(d_artifact.artifact)
+                    d_artifact.artifact.file = str(d_artifact.artifact.file)
+                    da_to_save.append(d_artifact)
 
-            for d_content in batch:
-                await self.put(d_content)
+        if da_to_save:
+            for d_artifact, artifact in zip(da_to_save, Artifact.objects.bulk_get_or_create(
+                    d_artifact.artifact for d_artifact in da_to_save)):
+                d_artifact.artifact = artifact
 
 
-class RemoteArtifactSaver(Stage):
+class RemoteArtifactSaver(BatchStage):
     """
     A Stage that saves :class:`~pulpcore.plugin.models.RemoteArtifact` objects
 
     An :class:`~pulpcore.plugin.models.RemoteArtifact` object is saved for each
-    :class:`~pulpcore.plugin.stages.DeclarativeArtifact`.
+    :class:`~pulpcore.plugin.stages.DeclarativeArtifact`. Units declared as `removed` are passed on
+    untouched, their saved ContentArtifacts are not looked up.
+
+    With Django 2.2 or later, all :class:`~pulpcore.plugin.models.RemoteArtifact` objects of a batch
+    are inserted with one `INSERT ... ON CONFLICT DO NOTHING`, so the ones saved by earlier syncs
+    don't need to be queried. Otherwise the existing ones are prefetched and only the missing ones
+    are inserted.
     """
 
-    async def run(self):
+    #: (bool): Whether to insert with `ON CONFLICT DO NOTHING` instead of prefetching.
+    IGNORE_CONFLICTS = django.VERSION >= (2, 2)
+
+    async def handle_batch(self, batch):
         """
-        The coroutine for this stage.
+        Handle a batch of :class:`~pulpcore.plugin.stages.DeclarativeContent` objects.
 
-        Returns:
-            The coroutine for this stage.
+        Args:
+            batch (list): The :class:`~pulpcore.plugin.stages.DeclarativeContent` objects to
+                handle.
         """
-        async for batch in self.batches():
+        batch = [d_content for d_content in batch if not d_content.removed]
+        if not batch:
+            return
+        if self.IGNORE_CONFLICTS:
+            RemoteArtifact.objects.bulk_create(self._remote_artifacts(batch),
+                                               ignore_conflicts=True)
+        else:
             RemoteArtifact.objects.bulk_get_or_create(self._needed_remote_artifacts(batch))
-            for d_content in batch:
-                await self.put(d_content)
+
+    def _remote_artifacts(self, batch):
+        """
+        Build a list of all :class:`~pulpcore.plugin.models.RemoteArtifact` for the batch.
+
+        Args:
+            batch (list): List of :class:`~pulpcore.plugin.stages.DeclarativeContent`.
+
+        Returns:
+            List: Of :class:`~pulpcore.plugin.models.RemoteArtifact`.
+        """
+        prefetch_related_objects(
+            [d_c.content for d_c in batch],
+            Prefetch('contentartifact_set', to_attr='_remote_artifact_saver_cas'),
+        )
+        return [
+            self._create_remote_artifact(d_artifact, content_artifact)
+            for content_artifact, d_artifact in self._content_artifacts_with_d_artifacts(batch)
+        ]
 
     def _needed_remote_artifacts(self, batch):
         """
@@ -249,22 +359,41 @@ class RemoteArtifactSaver(Stage):
             ),
         )
         needed_ras = []
+        for content_artifact, d_artifact in self._content_artifacts_with_d_artifacts(batch):
+            remote_ids = {ra.remote_id for ra in content_artifact._remote_artifact_saver_ras}
+            if d_artifact.remote.pk not in remote_ids:
+                remote_artifact = self._create_remote_artifact(d_artifact, content_artifact)
+                needed_ras.append(remote_artifact)
+        return needed_ras
+
+    @staticmethod
+    def _content_artifacts_with_d_artifacts(batch):
+        """
+        Pair the prefetched ContentArtifacts of a batch with the DeclarativeArtifacts by path.
+
+        Args:
+            batch (list): List of :class:`~pulpcore.plugin.stages.DeclarativeContent` with
+                prefetched `_remote_artifact_saver_cas`.
+
+        Yields:
+            tuple: A :class:`~pulpcore.plugin.models.ContentArtifact` and the first
+            :class:`~pulpcore.plugin.stages.DeclarativeArtifact` with its relative path.
+
+        Raises:
+            ValueError: When no DeclarativeArtifact has the relative path of a ContentArtifact.
+        """
         for d_content in batch:
+            d_artifacts_by_path = {}
+            for d_artifact in d_content.d_artifacts:
+                d_artifacts_by_path.setdefault(d_artifact.relative_path, d_artifact)
             for content_artifact in d_content.content._remote_artifact_saver_cas:
-                for d_artifact in d_content.d_artifacts:
-                    if d_artifact.relative_path == content_artifact.relative_path:
-                        break
-                else:
+                try:
+                    d_artifact = d_artifacts_by_path[content_artifact.relative_path]
+                except KeyError:
                     msg = _('No declared artifact with relative path "{rp}" for content "{c}"')
                     raise ValueError(msg.format(rp=content_artifact.relative_path,
                                                 c=d_content.content))
-                for remote_artifact in content_artifact._remote_artifact_saver_ras:
-                    if remote_artifact.remote_id == d_artifact.remote.pk:
-                        break
-                else:
-                    remote_artifact = self._create_remote_artifact(d_artifact, content_artifact)
-                    needed_ras.append(remote_artifact)
-        return needed_ras
+                yield content_artifact, d_artifact
 
     @staticmethod
     def _create_remote_artifact(d_artifact, content_artifact):
@@ -1,26 +1,97 @@
-from django.db.models import Q
+from collections import defaultdict
+import uuid
 
-from pulpcore.plugin.models import Content, ProgressBar
+from pulpcore.exceptions import ResourceImmutableError
+from pulpcore.plugin.models import Content, ProgressBar, RepositoryContent
 
 from .api import Stage
+from .content_stages import natural_key_values, query_by_field_values
+from .progress import ProgressReporter
 
 
 class ContentAssociation(Stage):
     """
     A Stages API stage that associates content units with `new_version`.
 
-    This stage stores all content unit primary keys in memory before running. This is done to
-    compute the units already associated but not received from `self._in_q`. These units are passed
-    via `self._out_q` to the next stage as a :class:`django.db.models.query.QuerySet`.
+    This stage stores all content unit primary keys of `new_version` in memory before running. This
+    is done to compute the units already associated but not received from `self._in_q`. The keys
+    are streamed from the db into a compact sorted array, which takes 16 bytes and one bit per unit.
+    The units not received are passed via `self._out_q` to the next stage as
+    :class:`django.db.models.query.QuerySet` objects of at most `UNASSOCIATE_CHUNK_SIZE` units.
+    Units declared as `removed` are not associated, so they are unassociated like the units not
+    received.
 
     This stage creates a ProgressBar named 'Associating Content' that counts the number of units
-    associated. Since it's a stream the total count isn't known until it's finished.
+    associated. Since it's a stream the total count isn't known until it's finished. The ProgressBar
+    is saved through a :class:`~pulpcore.plugin.stages.ProgressReporter`.
 
     Args:
         new_version (:class:`~pulpcore.plugin.models.RepositoryVersion`): The repo version this
             stage associates content with.
         args: unused positional arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
         kwargs: unused keyword arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
+
+    Attributes:
+        UNASSOCIATE_CHUNK_SIZE (int): The maximum number of units in one QuerySet passed on.
+    """
+
+    UNASSOCIATE_CHUNK_SIZE = 10000
+
+    def __init__(self, new_version, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.new_version = new_version
+
+    async def run(self):
+        """
+        The coroutine for this stage.
+
+        Returns:
+            The coroutine for this stage.
+        """
+        with ProgressReporter(ProgressBar(message='Associating Content')) as progress:
+            to_delete = PkSet.from_queryset(self.new_version.content)
+            async for batch in self.batches():
+                to_add = set()
+                for d_content in batch:
+                    if d_content.removed:
+                        continue
+                    if not to_delete.discard(d_content.content.pk):
+                        to_add.add(d_content.content.pk)
+
+                if to_add:
+                    self.new_version.add_content(Content.objects.filter(pk__in=to_add))
+                    progress.increment(len(to_add))
+
+            chunk = []
+            for pk in to_delete:
+                chunk.append(pk)
+                if len(chunk) >= self.UNASSOCIATE_CHUNK_SIZE:
+                    await self.put(Content.objects.filter(pk__in=chunk))
+                    chunk = []
+            if chunk:
+                await self.put(Content.objects.filter(pk__in=chunk))
+
+
+class ContentDeltaAssociation(Stage):
+    """
+    A Stages API stage that applies the additions and removals declared to `new_version`.
+
+    Each :class:`~pulpcore.plugin.stages.DeclarativeContent` received is added to `new_version`,
+    or removed from it if its `removed` attribute is set. Units that should be removed but were not
+    found in Pulp by :class:`~pulpcore.plugin.stages.QueryExistingContents` are ignored. Other
+    units of `new_version` are left alone, so unlike
+    :class:`~pulpcore.plugin.stages.ContentAssociation`, the content of `new_version` is never
+    loaded and the cost depends on the number of units declared only.
+
+    This stage creates the ProgressBars named 'Associating Content' and 'Un-Associating Content'
+    counting the units declared to be added and the units removed. Each batch costs one query to
+    add and one to remove units. A unit declared both added and removed within a batch is kept.
+
+    Args:
+        new_version (:class:`~pulpcore.plugin.models.RepositoryVersion`): The repo version this
+            stage associates content with and unassociates content from.
+        args: unused positional arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
+        kwargs: unused keyword arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
     """
 
     def __init__(self, new_version, *args, **kwargs):
@@ -34,23 +105,164 @@ class ContentAssociation(Stage):
         Returns:
             The coroutine for this stage.
         """
-        with ProgressBar(message='Associating Content') as pb:
-            to_delete = set(self.new_version.content.values_list('pk', flat=True))
+        with ProgressReporter(ProgressBar(message='Associating Content')) as added, \
+                ProgressReporter(ProgressBar(message='Un-Associating Content')) as removed:
             async for batch in self.batches():
                 to_add = set()
+                to_remove = set()
                 for d_content in batch:
-                    try:
-                        to_delete.remove(d_content.content.pk)
-                    except KeyError:
+                    if not d_content.removed:
                         to_add.add(d_content.content.pk)
+                    elif not d_content.content._state.adding:
+                        to_remove.add(d_content.content.pk)
+                # a unit both added and removed in one delta is kept
+                to_remove -= to_add
 
                 if to_add:
                     self.new_version.add_content(Content.objects.filter(pk__in=to_add))
-                    pb.done = pb.done + len(to_add)
-                    pb.save()
+                    added.increment(len(to_add))
+                if to_remove:
+                    removed.increment(
+                        remove_content(self.new_version, Content.objects.filter(pk__in=to_remove))
+                    )
+
+                for d_content in batch:
+                    await self.put(d_content)
+
+
+class PkSet:
+    """
+    A compact set of UUID primary keys, supporting lookups and removal only.
+
+    The keys are stored as one sorted byte array of 16 bytes per key, and removals as a bitmap.
+    Lookups are binary searches. Compared to a Python `set` of `uuid.UUID` objects, this takes
+    about a tenth of the memory. The array is used as is, never copied.
+
+    Args:
+        data (bytearray): The concatenated 16-byte representations of the keys, sorted.
+    """
 
-            if to_delete:
-                await self.put(Content.objects.filter(pk__in=to_delete))
+    KEY_SIZE = 16
+
+    def __init__(self, data=b''):
+        self._data = data
+        self._keys = memoryview(data)
+        self._count = len(data) // self.KEY_SIZE
+        self._removed = bytearray((self._count + 7) // 8)
+        self._len = self._count
+
+    @classmethod
+    def from_queryset(cls, queryset, chunk_size=10000):
+        """
+        Create a set from the primary keys of a QuerySet, streaming them from the db.
+
+        Args:
+            queryset (:class:`django.db.models.query.QuerySet`): The objects to get the keys of.
+            chunk_size (int): The number of keys fetched from the db at once.
+
+        Returns:
+            PkSet: The set of keys.
+        """
+        data = bytearray()
+        in_order = True
+        previous = b''
+        pks = queryset.order_by('pk').values_list('pk', flat=True)
+        for pk in pks.iterator(chunk_size=chunk_size):
+            key = pk.bytes
+            if key <= previous:
+                in_order = False
+            previous = key
+            data += key
+        if not in_order:
+            # the db sorted the keys differently, so sort them here
+            cls._sort(data)
+        return cls(data)
+
+    @classmethod
+    def _sort(cls, data):
+        """
+        Sort the keys in a byte array in place, with a heapsort needing no memory of its own.
+
+        Args:
+            data (bytearray): The concatenated 16-byte representations of the keys.
+        """
+        size = cls.KEY_SIZE
+        view = memoryview(data)
+
+        def key(index):
+            return view[index * size:(index + 1) * size].tobytes()
+
+        def swap(a, b):
+            saved = key(a)
+            view[a * size:(a + 1) * size] = view[b * size:(b + 1) * size]
+            view[b * size:(b + 1) * size] = saved
+
+        def sift_down(root, end):
+            while 2 * root + 1 < end:
+                child = 2 * root + 1
+                if child + 1 < end and key(child) < key(child + 1):
+                    child += 1
+                if key(root) >= key(child):
+                    return
+                swap(root, child)
+                root = child
+
+        count = len(data) // size
+        for root in range(count // 2 - 1, -1, -1):
+            sift_down(root, count)
+        for end in range(count - 1, 0, -1):
+            swap(0, end)
+            sift_down(0, end)
+        view.release()
+
+    def _key(self, index):
+        size = self.KEY_SIZE
+        return self._keys[index * size:(index + 1) * size].tobytes()
+
+    def _index(self, pk):
+        key = pk.bytes
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._count and self._key(low) == key:
+            return low
+        return None
+
+    def _is_removed(self, index):
+        return self._removed[index // 8] & (1 << (index % 8))
+
+    def __contains__(self, pk):
+        index = self._index(pk)
+        return index is not None and not self._is_removed(index)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for index in range(self._count):
+            if not self._is_removed(index):
+                yield uuid.UUID(bytes=self._key(index))
+
+    def discard(self, pk):
+        """
+        Remove `pk` from the set if it is present.
+
+        Args:
+            pk (uuid.UUID): The key to remove.
+
+        Returns:
+            bool: True if `pk` was present, False otherwise.
+        """
+        index = self._index(pk)
+        if index is None or self._is_removed(index):
+            return False
+        self._removed[index // 8] |= 1 << (index % 8)
+        self._len -= 1
+        return True
 
 
 class ContentUnassociation(Stage):
@@ -58,7 +270,12 @@ class ContentUnassociation(Stage):
     A Stages API stage that unassociates content units from `new_version`.
 
     This stage creates a ProgressBar named 'Un-Associating Content' that counts the number of units
-    un-associated. Since it's a stream the total count isn't known until it's finished.
+    un-associated. Since it's a stream the total count isn't known until it's finished. The
+    ProgressBar is saved through a :class:`~pulpcore.plugin.stages.ProgressReporter`.
+
+    Each QuerySet received is unassociated with one UPDATE, which also yields the count, so the
+    QuerySet is evaluated once. :class:`~pulpcore.plugin.stages.ContentAssociation` passes the units
+    to unassociate in chunks of `UNASSOCIATE_CHUNK_SIZE`.
 
     Args:
         new_version (:class:`~pulpcore.plugin.models.RepositoryVersion`): The repo version this
@@ -78,21 +295,52 @@ class ContentUnassociation(Stage):
         Returns:
             The coroutine for this stage.
         """
-        with ProgressBar(message='Un-Associating Content') as pb:
+        with ProgressReporter(ProgressBar(message='Un-Associating Content')) as progress:
             async for queryset_to_unassociate in self.items():
-                self.new_version.remove_content(queryset_to_unassociate)
-                pb.done = pb.done + queryset_to_unassociate.count()
-                pb.save()
+                progress.increment(remove_content(self.new_version, queryset_to_unassociate))
 
                 await self.put(queryset_to_unassociate)
 
 
+def remove_content(version, content):
+    """
+    Remove content from a repository version and count the units removed.
+
+    This runs the same UPDATE as :meth:`~pulpcore.plugin.models.RepositoryVersion.remove_content`
+    of pulpcore 3.0.0b22, which doesn't return the number of units removed, so they don't need to
+    be counted with another query. The unit tests check that both still run the same queries.
+
+    Args:
+        version (:class:`~pulpcore.plugin.models.RepositoryVersion`): The version to remove the
+            content from.
+        content (:class:`django.db.models.query.QuerySet`): The Content to remove.
+
+    Returns:
+        int: The number of units that were in the version and are removed now.
+
+    Raises:
+        :class:`~pulpcore.exceptions.ResourceImmutableError`: If `version` is complete.
+    """
+    if version.complete:
+        raise ResourceImmutableError(version)
+    return RepositoryContent.objects.filter(
+        repository=version.repository,
+        content_id__in=content,
+        version_removed=None,
+    ).update(version_removed=version)
+
+
 class RemoveDuplicates(Stage):
     """
     Stage allows plugins to remove content that would break repository uniqueness constraints.
 
     This stage is expected to be added by the
     :class:`~pulpcore.plugin.stages.DeclarativeVersion`. See that class for example usage.
+
+    Each batch costs one query per 1000 distinct `field_names` values, matching them against
+    the content of `new_version` with a row value condition on PostgreSQL. A unit of the batch
+    already in `new_version` is kept unless another unit of the batch has the same values.
+    `remove_content()` is only called if duplicates were found.
     """
 
     def __init__(self, new_version, model, field_names):
@@ -117,18 +365,26 @@ class RemoveDuplicates(Stage):
             The coroutine for this stage.
         """
         async for batch in self.batches():
-            rm_q = Q()
+            pks_by_key = defaultdict(set)
             for d_content in batch:
-                if isinstance(d_content.content, self.model):
-                    unit_q_dict = {
-                        field: getattr(d_content.content, field) for field in self.field_names
-                    }
-                    # Don't remove *this* object if it is already in the repository version.
-                    not_this = ~Q(pk=d_content.content.pk)
-                    dupe = Q(**unit_q_dict)
-                    rm_q |= Q(dupe & not_this)
-            queryset_to_unassociate = self.model.objects.filter(rm_q)
-            self.new_version.remove_content(queryset_to_unassociate)
+                if isinstance(d_content.content, self.model) and not d_content.removed:
+                    key = natural_key_values(d_content.content, self.field_names)
+                    pks_by_key[key].add(d_content.content.pk)
+            if pks_by_key:
+                version_content = self.model.objects.filter(
+                    pk__in=self.new_version.content
+                ).only('pk', *self.field_names)
+                duplicates = query_by_field_values(version_content, self.field_names,
+                                                   list(pks_by_key))
+                # Don't remove *this* unit if it is already in the repository version, unless
+                # another unit of the batch has the same values.
+                duplicate_pks = [
+                    duplicate.pk for duplicate in duplicates
+                    if pks_by_key.get(natural_key_values(duplicate, self.field_names)) !=
+                    {duplicate.pk}
+                ]
+                if duplicate_pks:
+                    self.new_version.remove_content(self.model.objects.filter(pk__in=duplicate_pks))
 
             for d_content in batch:
                 await self.put(d_content)
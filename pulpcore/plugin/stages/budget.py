@@ -0,0 +1,185 @@
+import asyncio
+from collections import deque
+import sys
+
+from .models import DeclarativeContent
+
+
+#: (int): The estimated bytes of a DeclarativeContent with an unsaved unit, without `extra_data`.
+CONTENT_SIZE = 2048
+
+#: (int): The estimated bytes of a DeclarativeArtifact with an unsaved Artifact, without the url
+#: and `extra_data`.
+ARTIFACT_SIZE = 1536
+
+#: (int): The estimated bytes of other items passed between stages, e.g. QuerySets.
+OTHER_SIZE = 512
+
+
+def estimate_size(item, max_depth=4):
+    """
+    Estimate the memory taken by an item passed between stages.
+
+    The estimate of a :class:`~pulpcore.plugin.stages.DeclarativeContent` grows with the number of
+    its :class:`~pulpcore.plugin.stages.DeclarativeArtifact` objects and the size of the
+    `extra_data` of both.
+
+    Args:
+        item: The item, usually a :class:`~pulpcore.plugin.stages.DeclarativeContent`.
+        max_depth (int): The depth up to which nested containers in `extra_data` are measured.
+
+    Returns:
+        int: The estimated number of bytes.
+    """
+    if item is None:
+        return 0
+    if not isinstance(item, DeclarativeContent):
+        return OTHER_SIZE
+    size = CONTENT_SIZE + _data_size(item.extra_data, max_depth)
+    for d_artifact in item.d_artifacts:
+        size += ARTIFACT_SIZE + len(d_artifact.url) + _data_size(d_artifact.extra_data, max_depth)
+    return size
+
+
+def _data_size(data, depth):
+    size = sys.getsizeof(data)
+    if depth <= 0:
+        return size
+    if isinstance(data, dict):
+        for key, value in data.items():
+            size += _data_size(key, depth - 1) + _data_size(value, depth - 1)
+    elif isinstance(data, (list, tuple, set, frozenset)):
+        for value in data:
+            size += _data_size(value, depth - 1)
+    return size
+
+
+class MemoryBudget:
+    """
+    A number of bytes shared by the items waiting in one or more queues.
+
+    Args:
+        max_bytes (int): The number of bytes the items may take together.
+
+    Attributes:
+        used (int): The estimated bytes of the items currently charged.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self._waiters = []
+
+    def fits(self, size):
+        """
+        Args:
+            size (int): The estimated bytes of an item.
+
+        Returns:
+            bool: Whether the item can be charged without exceeding the budget.
+        """
+        return self.used + size <= self.max_bytes
+
+    def charge(self, size):
+        """
+        Add the bytes of an item entering a queue.
+
+        Args:
+            size (int): The estimated bytes of the item.
+        """
+        self.used += size
+
+    def release(self, size):
+        """
+        Remove the bytes of an item leaving a queue, and wake up the puts waiting for room.
+
+        Args:
+            size (int): The estimated bytes of the item.
+        """
+        self.used -= size
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def add_waiter(self, waiter):
+        """
+        Args:
+            waiter (:class:`asyncio.Future`): A future to resolve on the next release.
+        """
+        self._waiters.append(waiter)
+
+
+class BudgetedQueue(asyncio.Queue):
+    """
+    A queue between two stages limiting the estimated memory of its items besides their number.
+
+    A put waits until the item fits into the budget of this queue and the budget shared by all
+    queues of the pipeline. It is admitted into an empty queue regardless of the budgets, so a
+    single large item or a full pipeline budget never stop the pipeline: every stage can always
+    hand items on once its downstream stage caught up.
+
+    The sizes are estimated with :func:`estimate_size`.
+
+    Args:
+        max_bytes (int): The budget of this queue in bytes, or None for no limit.
+        pipeline_budget (:class:`MemoryBudget`): The budget shared by the queues of the pipeline,
+            or None for no limit.
+        args: positional arguments passed along to :class:`asyncio.Queue`.
+        kwargs: keyword arguments passed along to :class:`asyncio.Queue`.
+    """
+
+    def __init__(self, max_bytes=None, pipeline_budget=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._budgets = [MemoryBudget(max_bytes)] if max_bytes else []
+        if pipeline_budget is not None:
+            self._budgets.append(pipeline_budget)
+        self._sizes = deque()
+        self._estimates = {}
+
+    async def put(self, item):
+        """
+        Put an item into the queue, waiting for room in its budgets first.
+
+        Args:
+            item: The item to put.
+        """
+        size = estimate_size(item)
+        while not (self.empty() or all(budget.fits(size) for budget in self._budgets)):
+            waiter = asyncio.get_event_loop().create_future()
+            for budget in self._budgets:
+                budget.add_waiter(waiter)
+            await waiter
+        self._estimates[id(item)] = size
+        try:
+            await super().put(item)
+        finally:
+            self._estimates.pop(id(item), None)
+
+    def put_nowait(self, item):
+        """
+        Put an item into the queue and charge its estimated bytes to the budgets.
+
+        Args:
+            item: The item to put.
+        """
+        super().put_nowait(item)
+        size = self._estimates.pop(id(item), None)
+        if size is None:
+            size = estimate_size(item)
+        self._sizes.append(size)
+        for budget in self._budgets:
+            budget.charge(size)
+
+    def get_nowait(self):
+        """
+        Get an item from the queue and release its estimated bytes from the budgets.
+
+        Returns:
+            The item.
+        """
+        item = super().get_nowait()
+        size = self._sizes.popleft()
+        for budget in self._budgets:
+            budget.release(size)
+        return item
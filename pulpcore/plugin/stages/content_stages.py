@@ -1,14 +1,19 @@
 from collections import defaultdict
+from functools import reduce
+from gettext import gettext as _
+import operator
 
-from django.db import IntegrityError, transaction
+from django.db import connections, IntegrityError, router, transaction
 from django.db.models import Q
+from django.db.models.expressions import RawSQL
 
-from pulpcore.plugin.models import ContentArtifact
+from pulpcore.plugin.models import Content, ContentArtifact
 
-from .api import Stage
+from .api import BatchStage
+from .records import materialize, model_of
 
 
-class QueryExistingContents(Stage):
+class QueryExistingContents(BatchStage):
     """
     A Stages API stage that saves :attr:`DeclarativeContent.content` objects and saves its related
     :class:`~pulpcore.plugin.models.ContentArtifact` objects too.
@@ -26,42 +31,238 @@ class QueryExistingContents(Stage):
     been handled.
 
     This stage drains all available items from `self._in_q` and batches everything into one large
-    call to the db for efficiency.
+    call to the db per content type for efficiency. Units are looked up by their natural key with
+    one indexed query per `QUERY_CHUNK_SIZE` units, see :func:`query_by_field_values`, and the
+    results are matched through a dictionary indexed by natural key.
+
+    Attributes:
+        QUERY_CHUNK_SIZE (int): The maximum number of natural keys looked up in one query.
     """
 
-    async def run(self):
+    QUERY_CHUNK_SIZE = 1000
+
+    async def handle_batch(self, batch):
         """
-        The coroutine for this stage.
+        Handle a batch of :class:`~pulpcore.plugin.stages.DeclarativeContent` objects.
 
-        Returns:
-            The coroutine for this stage.
+        Args:
+            batch (list): The :class:`~pulpcore.plugin.stages.DeclarativeContent` objects to
+                handle.
         """
-        async for batch in self.batches():
-            content_q_by_type = defaultdict(lambda: Q(_created=None))
-            for d_content in batch:
-                model_type = type(d_content.content)
-                unit_q = d_content.content.q()
-                content_q_by_type[model_type] = content_q_by_type[model_type] | unit_q
-
-            for model_type in content_q_by_type.keys():
-                for result in model_type.objects.filter(content_q_by_type[model_type]):
-                    for d_content in batch:
-                        if type(d_content.content) is not model_type:
-                            continue
-                        not_same_unit = False
-                        for field in result.natural_key_fields():
-                            in_memory_digest_value = getattr(d_content.content, field)
-                            if in_memory_digest_value != getattr(result, field):
-                                not_same_unit = True
-                                break
-                        if not_same_unit:
-                            continue
-                        d_content.content = result
-            for d_content in batch:
-                await self.put(d_content)
+        d_contents_by_type = defaultdict(lambda: defaultdict(list))
+        for d_content in batch:
+            if not d_content.content._state.adding:
+                continue
+            model_type = model_of(d_content.content)
+            key = natural_key_values(d_content.content)
+            d_contents_by_type[model_type][key].append(d_content)
+
+        for model_type, d_contents_by_key in d_contents_by_type.items():
+            keys = list(d_contents_by_key)
+            for result in query_by_natural_key(model_type, keys, self.QUERY_CHUNK_SIZE):
+                for d_content in d_contents_by_key.get(natural_key_values(result), []):
+                    d_content.content = result
+
+
+def query_by_natural_key(model_type, keys, chunk_size=1000):
+    """
+    Query the saved units of one content type with the given natural keys.
 
+    Args:
+        model_type (type): The :class:`~pulpcore.plugin.models.Content` subclass to query.
+        keys (list): The natural keys to look up, as returned by :func:`natural_key_values`.
+        chunk_size (int): The maximum number of keys looked up in one query.
 
-class ContentSaver(Stage):
+    Returns:
+        generator: The saved units of `model_type` having one of `keys`.
+    """
+    return query_by_field_values(model_type.objects, model_type.natural_key_fields(), keys,
+                                 chunk_size)
+
+
+def query_by_field_values(queryset, field_names, keys, chunk_size=1000):
+    """
+    Query the objects of a QuerySet whose fields have one of the given combinations of values.
+
+    Keys are looked up with one query per `chunk_size` keys. A single field is matched with
+    `field__in`. On PostgreSQL, several fields of the table of the model itself are matched with a
+    row value condition, `(field1, field2) IN (VALUES ...)`, which can use the index of a
+    `unique_together` constraint. Otherwise, e.g. on other databases or for fields of a parent
+    table, one condition per key is OR-ed. Keys containing None are always matched by such
+    conditions, since SQL `IN` never matches NULL.
+
+    Args:
+        queryset (:class:`django.db.models.query.QuerySet`): The objects to query, or a manager.
+        field_names (list): The names of the fields to match.
+        keys (list): Tuples of values, in the order of `field_names`. Related objects are given by
+            their primary key.
+        chunk_size (int): The maximum number of keys looked up in one query.
+
+    Returns:
+        generator: The objects of `queryset` matching one of `keys`.
+    """
+    model_type = queryset.model
+    fields = [model_type._meta.get_field(name) for name in field_names]
+    if not fields:
+        return
+    connection = connections[router.db_for_read(model_type)]
+    row_values = connection.vendor == 'postgresql' and all(
+        field in model_type._meta.local_concrete_fields for field in fields
+    )
+    for start in range(0, len(keys), chunk_size):
+        chunk = keys[start:start + chunk_size]
+        conditions = []
+        if len(fields) == 1 or row_values:
+            complete_keys = [key for key in chunk if None not in key]
+            chunk = [key for key in chunk if None in key]
+        else:
+            complete_keys = []
+        if complete_keys and len(fields) == 1:
+            lookup = '{name}__in'.format(name=fields[0].attname)
+            conditions.append(Q(**{lookup: [key[0] for key in complete_keys]}))
+        elif complete_keys:
+            conditions.append(Q(pk__in=_row_values_query(model_type, fields, complete_keys,
+                                                         connection)))
+        conditions.extend(
+            Q(**{field.attname: value for field, value in zip(fields, key)}) for key in chunk
+        )
+        yield from queryset.filter(reduce(operator.or_, conditions))
+
+
+def _row_values_query(model_type, fields, keys, connection):
+    """
+    Select the primary keys of the rows of a table with one of the given combinations of values.
+
+    Args:
+        model_type (type): The model whose table holds `fields`.
+        fields (list): The fields to match.
+        keys (list): Tuples of values, in the order of `fields`, none of them None.
+        connection: The PostgreSQL connection to build the query for.
+
+    Returns:
+        :class:`django.db.models.expressions.RawSQL`: The query, to use as `pk__in` condition.
+    """
+    quote_name = connection.ops.quote_name
+    table = quote_name(model_type._meta.db_table)
+    columns = ', '.join(
+        '{table}.{column}'.format(table=table, column=quote_name(field.column)) for field in fields
+    )
+    # the casts give the VALUES list the types of the columns
+    row = '({values})'.format(values=', '.join(
+        '%s::{type}'.format(type=field.cast_db_type(connection)) for field in fields
+    ))
+    sql = 'SELECT {table}.{pk} FROM {table} WHERE ({columns}) IN (VALUES {rows})'.format(
+        table=table,
+        pk=quote_name(model_type._meta.pk.column),
+        columns=columns,
+        rows=', '.join([row] * len(keys)),
+    )
+    params = [
+        field.get_db_prep_value(value, connection) for key in keys
+        for field, value in zip(fields, key)
+    ]
+    return RawSQL(sql, params)
+
+
+def natural_key_values(content, field_names=None):
+    """
+    Get the natural key of a content unit as a hashable tuple of database values.
+
+    Related objects are represented by their primary key, so the key can be computed for unsaved
+    units and compared with the key of saved ones.
+
+    Args:
+        content (:class:`~pulpcore.plugin.models.Content`): The content unit.
+        field_names (list): The names of the fields making up the key. Defaults to the natural key
+            fields of the unit.
+
+    Returns:
+        tuple: The values of the key fields.
+    """
+    if field_names is None:
+        field_names = content.natural_key_fields()
+    return tuple(getattr(content, content._meta.get_field(name).attname) for name in field_names)
+
+
+def bulk_insert(model_type, contents, batch_size=500):
+    """
+    Insert unsaved units of a content type with bulk inserts into both of their tables.
+
+    Django's `bulk_create()` does not support multi-table inheritance, which all content types use.
+    This bulk creates the rows of the :class:`~pulpcore.plugin.models.Content` table with their
+    primary keys assigned beforehand, then inserts the rows of `model_type` linked to them with one
+    query per `batch_size` units too. As with `bulk_create()`, `save()` is not called and no
+    `pre_save` or `post_save` signals are sent. The `pre_save()` of the fields is still used, so
+    e.g. `auto_now` fields are set.
+
+    The units are only marked as saved once all rows are inserted. If an insert fails they still
+    link to their rows of the parent table, which :func:`reset_unsaved` clears.
+
+    Args:
+        model_type (type): The :class:`~pulpcore.plugin.models.Content` subclass to insert. It
+            must inherit from exactly one concrete model.
+        contents (list): Unsaved units of `model_type`.
+        batch_size (int): The maximum number of rows inserted with one query.
+
+    Raises:
+        ValueError: When `model_type` doesn't inherit from exactly one concrete model.
+        django.db.IntegrityError: When a unit violates a constraint, e.g. because it already
+            exists. Nothing is inserted then if called within a transaction.
+    """
+    parents = model_type._meta.get_parent_list()
+    if len(parents) != 1:
+        raise ValueError(_('{model} does not inherit from exactly one concrete model.').format(
+            model=model_type.__name__))
+    parent = parents[0]
+    using = router.db_for_write(model_type)
+    link = model_type._meta.get_ancestor_link(parent)
+    parent_fields = parent._meta.concrete_fields
+    parent_rows = []
+    for content in contents:
+        if not content._type:
+            # as set by MasterModel.save()
+            content._type = '{app_label}.{type}'.format(app_label=content._meta.app_label,
+                                                        type=content.TYPE)
+        parent_rows.append(
+            parent(**{field.attname: getattr(content, field.attname) for field in parent_fields})
+        )
+    parent._base_manager.db_manager(using).bulk_create(parent_rows, batch_size=batch_size)
+    for content, parent_row in zip(contents, parent_rows):
+        for field in parent_fields:
+            # e.g. the auto_now fields set by bulk_create()
+            setattr(content, field.attname, getattr(parent_row, field.attname))
+        setattr(content, link.attname, getattr(parent_row, parent._meta.pk.attname))
+    manager = model_type._base_manager.db_manager(using)
+    fields = model_type._meta.local_concrete_fields
+    for start in range(0, len(contents), batch_size):
+        # the insert calls pre_save() of the fields, like save() does
+        manager._insert(contents[start:start + batch_size], fields=fields, using=using)
+    for content in contents:
+        content._state.adding = False
+        content._state.db = using
+
+
+def reset_unsaved(model_type, contents):
+    """
+    Mark units as unsaved again after :func:`bulk_insert` failed within a rolled back transaction.
+
+    The link to the row of the parent table is cleared, so it is not taken for a saved unit.
+
+    Args:
+        model_type (type): The :class:`~pulpcore.plugin.models.Content` subclass of `contents`.
+        contents (list): The units passed to :func:`bulk_insert`.
+    """
+    for parent in model_type._meta.get_parent_list():
+        link = model_type._meta.get_ancestor_link(parent)
+        if link is not None:
+            for content in contents:
+                setattr(content, link.attname, None)
+    for content in contents:
+        content._state.adding = True
+        content._state.db = None
+
+
+class ContentSaver(BatchStage):
     """
     A Stages API stage that saves :attr:`DeclarativeContent.content` objects and saves its related
     :class:`~pulpcore.plugin.models.ContentArtifact` objects too.
@@ -72,53 +273,132 @@ class ContentSaver(Stage):
     :class:`~pulpcore.plugin.models.Artifact`.
 
     Each "unsaved" Content objects is saved and a :class:`~pulpcore.plugin.models.ContentArtifact`
-    objects too.
+    objects too. Units declared as `removed` are never saved. Units declared as
+    :class:`~pulpcore.plugin.stages.Record` objects are turned into model instances first.
 
     Each :class:`~pulpcore.plugin.stages.DeclarativeContent` is sent to after it has been handled.
 
     This stage drains all available items from `self._in_q` and batches everything into one large
-    call to the db for efficiency.
+    call to the db for efficiency. The Content rows of the new units of each content type are
+    inserted with one bulk insert per table, see :func:`bulk_insert`. If that conflicts with units
+    saved in the meantime, e.g. by another sync, the existing units are looked up by natural key and
+    the remaining ones inserted again. Units within a batch sharing a natural key are saved once.
+
+    Content types overriding `save()` or inheriting from more than one concrete model are saved one
+    by one, so their `save()` keeps being called. Bulk inserted units don't send the `pre_save` and
+    `post_save` signals, as with `bulk_create()`.
     """
 
-    async def run(self):
+    async def handle_batch(self, batch):
+        """
+        Handle a batch of :class:`~pulpcore.plugin.stages.DeclarativeContent` objects.
+
+        Args:
+            batch (list): The :class:`~pulpcore.plugin.stages.DeclarativeContent` objects to
+                handle.
+        """
+        content_artifact_bulk = []
+        with transaction.atomic():
+            for d_content in batch:
+                if not d_content.removed:
+                    d_content.content = materialize(d_content.content)
+            await self._pre_save(batch)
+            d_contents_by_type = defaultdict(list)
+            for d_content in batch:
+                # Are we saving to the database for the first time?
+                if d_content.content._state.adding and not d_content.removed:
+                    d_contents_by_type[type(d_content.content)].append(d_content)
+            for model_type, d_contents in d_contents_by_type.items():
+                if model_type.save is Content.save and \
+                        len(model_type._meta.get_parent_list()) == 1:
+                    created = self._bulk_save(model_type, d_contents)
+                else:
+                    created = self._save_one_by_one(d_contents)
+                for d_content in created:
+                    for d_artifact in d_content.d_artifacts:
+                        if not d_artifact.artifact._state.adding:
+                            artifact = d_artifact.artifact
+                        else:
+                            # set to None for lazy synced artifacts
+                            artifact = None
+                        content_artifact = ContentArtifact(
+                            content=d_content.content,
+                            artifact=artifact,
+                            relative_path=d_artifact.relative_path
+                        )
+                        content_artifact_bulk.append(content_artifact)
+            ContentArtifact.objects.bulk_get_or_create(content_artifact_bulk)
+            await self._post_save(batch)
+
+    def _bulk_save(self, model_type, d_contents):
         """
-        The coroutine for this stage.
+        Save the unsaved units of one content type with bulk inserts.
+
+        Args:
+            model_type (type): The :class:`~pulpcore.plugin.models.Content` subclass to save.
+            d_contents (list): The :class:`~pulpcore.plugin.stages.DeclarativeContent` objects with
+                unsaved units of `model_type`.
 
         Returns:
-            The coroutine for this stage.
+            list: The :class:`~pulpcore.plugin.stages.DeclarativeContent` objects whose unit was
+            created. The other ones got the unit saved by another one of `d_contents` or found in
+            the db.
         """
-        async for batch in self.batches():
-            content_artifact_bulk = []
+        d_contents_by_key = defaultdict(list)
+        for d_content in d_contents:
+            key = natural_key_values(d_content.content)
+            if not key:
+                key = id(d_content)  # without a natural key no units are the same
+            d_contents_by_key[key].append(d_content)
+        created = [group[0] for group in d_contents_by_key.values()]
+
+        try:
             with transaction.atomic():
-                await self._pre_save(batch)
-                for d_content in batch:
-                    # Are we saving to the database for the first time?
-                    content_already_saved = not d_content.content._state.adding
-                    if not content_already_saved:
-                        try:
-                            with transaction.atomic():
-                                d_content.content.save()
-                        except IntegrityError:
-                            d_content.content = \
-                                d_content.content.__class__.objects.get(
-                                    d_content.content.q())
-                            continue
-                        for d_artifact in d_content.d_artifacts:
-                            if not d_artifact.artifact._state.adding:
-                                artifact = d_artifact.artifact
-                            else:
-                                # set to None for lazy synced artifacts
-                                artifact = None
-                            content_artifact = ContentArtifact(
-                                content=d_content.content,
-                                artifact=artifact,
-                                relative_path=d_artifact.relative_path
-                            )
-                            content_artifact_bulk.append(content_artifact)
-                ContentArtifact.objects.bulk_get_or_create(content_artifact_bulk)
-                await self._post_save(batch)
-            for declarative_content in batch:
-                await self.put(declarative_content)
+                bulk_insert(model_type, [d_content.content for d_content in created])
+        except IntegrityError:
+            reset_unsaved(model_type, [d_content.content for d_content in created])
+            # some units were saved meanwhile, use them and insert the others
+            keys = [key for key in d_contents_by_key if isinstance(key, tuple)]
+            for existing in query_by_natural_key(model_type, keys):
+                for d_content in d_contents_by_key.pop(natural_key_values(existing), []):
+                    d_content.content = existing
+            created = [group[0] for group in d_contents_by_key.values()]
+            try:
+                with transaction.atomic():
+                    bulk_insert(model_type, [d_content.content for d_content in created])
+            except IntegrityError:
+                reset_unsaved(model_type, [d_content.content for d_content in created])
+                created = self._save_one_by_one(created)
+
+        for group in d_contents_by_key.values():
+            for d_content in group[1:]:
+                d_content.content = group[0].content
+        return created
+
+    def _save_one_by_one(self, d_contents):
+        """
+        Save unsaved units one by one, using existing units if they are already saved.
+
+        Args:
+            d_contents (list): The :class:`~pulpcore.plugin.stages.DeclarativeContent` objects with
+                unsaved units.
+
+        Returns:
+            list: The :class:`~pulpcore.plugin.stages.DeclarativeContent` objects whose unit was
+            created.
+        """
+        created = []
+        for d_content in d_contents:
+            try:
+                with transaction.atomic():
+                    d_content.content.save()
+            except IntegrityError:
+                d_content.content = \
+                    d_content.content.__class__.objects.get(
+                        d_content.content.q())
+            else:
+                created.append(d_content)
+        return created
 
     async def _pre_save(self, batch):
         """
@@ -147,7 +427,7 @@ class ContentSaver(Stage):
         pass
 
 
-class ResolveContentFutures(Stage):
+class ResolveContentFutures(BatchStage):
     """
     This stage resolves the futures in :class:`~pulpcore.plugin.stages.DeclarativeContent`.
 
@@ -168,16 +448,22 @@ class ResolveContentFutures(Stage):
 
     This creates a "looping" pattern, of sorts, where downloaded content at the end of the pipeline
     can introduce new additional to-be-downloaded content at the beginning of the pipeline.
+
+    The futures are resolved as soon as the items are available, without waiting for a batch to
+    fill up. The futures of units declared as `removed` resolve to the saved unit if it exists,
+    otherwise to the declared one, which is never saved.
     """
 
-    async def run(self):
+    BATCH_MINSIZE = 1
+
+    async def handle_batch(self, batch):
         """
-        The coroutine for this stage.
+        Handle a batch of :class:`~pulpcore.plugin.stages.DeclarativeContent` objects.
 
-        Returns:
-            The coroutine for this stage.
+        Args:
+            batch (list): The :class:`~pulpcore.plugin.stages.DeclarativeContent` objects to
+                handle.
         """
-        async for d_content in self.items():
+        for d_content in batch:
             if d_content.future is not None:
                 d_content.future.set_result(d_content.content)
-            await self.put(d_content)
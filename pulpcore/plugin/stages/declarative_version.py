@@ -1,22 +1,56 @@
 import asyncio
+from contextlib import ExitStack
+from gettext import gettext as _
+import hashlib
+import logging
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist, ObjectDoesNotExist
+from django.db import transaction
 
 from pulpcore.plugin.models import RepositoryVersion
 from pulpcore.plugin.tasking import WorkingDirectory
 
-from .api import create_pipeline, EndStage
+from .api import create_pipeline, EndStage, FanOut
 from .artifact_stages import (
     ArtifactDownloader,
     ArtifactSaver,
     QueryExistingArtifacts,
     RemoteArtifactSaver,
 )
-from .association_stages import ContentAssociation, ContentUnassociation, RemoveDuplicates
+from .association_stages import (
+    ContentAssociation,
+    ContentDeltaAssociation,
+    ContentUnassociation,
+    RemoveDuplicates,
+)
 from .content_stages import ContentSaver, QueryExistingContents, ResolveContentFutures
+from .distributed import DistributedArtifactDownloader
+from .plan import SyncPlanner
+
+log = logging.getLogger(__name__)
+
+
+def artifact_downloader():
+    """
+    Make the stage downloading Artifacts in the default pipelines.
+
+    Returns:
+        :class:`~pulpcore.plugin.stages.Stage`: A
+        :class:`~pulpcore.plugin.stages.DistributedArtifactDownloader` with shards of the
+        `DISTRIBUTED_DOWNLOAD_SHARD_SIZE` setting if that is set, otherwise an
+        :class:`~pulpcore.plugin.stages.ArtifactDownloader`.
+    """
+    shard_size = getattr(settings, 'DISTRIBUTED_DOWNLOAD_SHARD_SIZE', None)
+    if shard_size:
+        return DistributedArtifactDownloader(shard_size=shard_size)
+    return ArtifactDownloader()
 
 
 class DeclarativeVersion:
 
-    def __init__(self, first_stage, repository, mirror=False, remove_duplicates=None):
+    def __init__(self, first_stage, repository, mirror=False, remove_duplicates=None,
+                 delta=False):
         """
         A pipeline that creates a new :class:`~pulpcore.plugin.models.RepositoryVersion` from a
         stream of :class:`~pulpcore.plugin.stages.DeclarativeContent` objects.
@@ -33,7 +67,9 @@ class DeclarativeVersion:
         3. Query existing artifacts to determine which are already local to Pulp with
            :class:`~pulpcore.plugin.stages.QueryExistingArtifacts`
         4. Download any undownloaded :class:`~pulpcore.plugin.models.Artifact` objects with
-           :class:`~pulpcore.plugin.stages.ArtifactDownloader`
+           :class:`~pulpcore.plugin.stages.ArtifactDownloader`, or on other workers with
+           :class:`~pulpcore.plugin.stages.DistributedArtifactDownloader` if the
+           `DISTRIBUTED_DOWNLOAD_SHARD_SIZE` setting is set
         5. Save the newly downloaded :class:`~pulpcore.plugin.models.Artifact` objects with
            :class:`~pulpcore.plugin.stages.ArtifactSaver`
         6. Query for Content units already present in Pulp with
@@ -54,6 +90,9 @@ class DeclarativeVersion:
         12. Unassociate any content units not declared in the stream (only when mirror=True)
             with :class:`~pulpcore.plugin.stages.ContentUnassociation`
 
+        With `delta=True`, steps 11 and 12 are replaced by applying the declared additions and
+        removals with :class:`~pulpcore.plugin.stages.ContentDeltaAssociation`.
+
         To do this, the plugin writer should subclass the
         :class:`~pulpcore.plugin.stages.Stage` class and define its
         :meth:`run()` interface which returns a coroutine. This coroutine should
@@ -67,7 +106,7 @@ class DeclarativeVersion:
         >>>         self.remote = remote
         >>>
         >>>     async def run(self):
-        >>>         downloader = remote.get_downloader(url=remote.url)
+        >>>         downloader = remote.get_downloader(url=remote.url, priority=PRIORITY_METADATA)
         >>>         result = await downloader.run()
         >>>         for entry in read_my_metadata_file_somehow(result.path)
         >>>             unit = MyContent(entry)  # make the content unit in memory-only
@@ -97,6 +136,28 @@ class DeclarativeVersion:
         >>> remove_dupes = [{'model': FileContent, 'field_names': ['relative_path']}]
         >>> DeclarativeVersion(first_stage, repository, remove_duplicates=remove_dupes).create()
 
+        Example using delta:
+
+        # The first stage declares the changes since the previous sync only, e.g. from an upstream
+        # changelog, with removals declared by natural key.
+        >>> await self.put(DeclarativeContent(content=MyContent(name='old'), removed=True))
+        >>> DeclarativeVersion(first_stage, repository, delta=True).create()
+
+        To estimate the cost of a sync before running it, call
+        :meth:`~pulpcore.plugin.stages.DeclarativeVersion.plan` instead of
+        :meth:`~pulpcore.plugin.stages.DeclarativeVersion.create`:
+
+        >>> plan = DeclarativeVersion(first_stage, repository, mirror=True).plan()
+        >>> plan.units_to_add, plan.units_to_remove, plan.download_bytes
+
+        If the first stage implements :meth:`~pulpcore.plugin.stages.Stage.upstream_fingerprint`
+        and the model of its Remote has a `last_sync_fingerprint` field, see
+        :attr:`~pulpcore.plugin.models.Remote.last_sync_fingerprint`, the fingerprint is stored on
+        the Remote after each sync. A later sync is skipped without creating a version if the last
+        sync from the Remote had the same fingerprint, created the latest version of the repository,
+        used the same `mirror`, `remove_duplicates` and `delta` options, and the Remote still has
+        the same `url` and download `policy`.
+
         Args:
             first_stage (:class:`~pulpcore.plugin.stages.Stage`): The first stage to receive
                 :class:`~pulpcore.plugin.stages.DeclarativeContent` from.
@@ -115,12 +176,24 @@ class DeclarativeVersion:
                 pipeline. Each dict should have 2 keys, `model`, which is a subclass of
                 :class:`pulpcore.plugin.models.Content` and `field_names` which is a list of
                 strings corresponding to fields on the provided model.
+            delta (bool): 'True' applies only the changes declared in the
+                :class:`~pulpcore.plugin.stages.DeclarativeVersion` stream: units are added, or
+                removed if declared with `removed=True`, and all other units of the
+                :class:`~pulpcore.plugin.models.RepositoryVersion` are kept. The first stage is
+                responsible for declaring the changes relative to the state of the upstream last
+                synced into the repository. 'False' is the default.
+
+        Raises:
+            ValueError: If both `mirror` and `delta` are set.
 
         """
+        if mirror and delta:
+            raise ValueError(_("A DeclarativeVersion can't both mirror and apply a delta"))
         self.first_stage = first_stage
         self.repository = repository
         self.mirror = mirror
         self.remove_duplicates = remove_duplicates or []
+        self.delta = delta
 
     def pipeline_stages(self, new_version):
         """
@@ -141,7 +214,7 @@ class DeclarativeVersion:
         pipeline = [
             self.first_stage,
             QueryExistingArtifacts(),
-            ArtifactDownloader(),
+            artifact_downloader(),
             ArtifactSaver(),
             QueryExistingContents(),
             ContentSaver(),
@@ -158,12 +231,273 @@ class DeclarativeVersion:
         Perform the work. This is the long-blocking call where all syncing occurs.
         """
         with WorkingDirectory():
+            loop = asyncio.get_event_loop()
+            fingerprint = loop.run_until_complete(self.first_stage.upstream_fingerprint())
+            if fingerprint and not self._stores_fingerprint(fingerprint[0]):
+                fingerprint = None
+            latest_version = RepositoryVersion.latest(self.repository)
+            if fingerprint and latest_version:
+                remote = fingerprint[0]
+                key = self._fingerprint_key(fingerprint, latest_version)
+                if type(remote).objects.filter(pk=remote.pk, last_sync_fingerprint=key).exists():
+                    log.info(_('Upstream of {repository} is unchanged since the sync creating '
+                               'version {number}, skipping the sync.').format(
+                        repository=self.repository.name, number=latest_version.number))
+                    return
+
             with RepositoryVersion.create(self.repository) as new_version:
-                loop = asyncio.get_event_loop()
                 stages = self.pipeline_stages(new_version)
-                stages.append(ContentAssociation(new_version))
+                if self.delta:
+                    stages.append(ContentDeltaAssociation(new_version))
+                else:
+                    stages.append(ContentAssociation(new_version))
                 if self.mirror:
                     stages.append(ContentUnassociation(new_version))
                 stages.append(EndStage())
                 pipeline = create_pipeline(stages)
                 loop.run_until_complete(pipeline)
+
+            if fingerprint:
+                remote = fingerprint[0]
+                type(remote).objects.filter(pk=remote.pk).update(
+                    last_sync_fingerprint=self._fingerprint_key(fingerprint, new_version)
+                )
+
+    def plan(self):
+        """
+        Estimate the changes of a sync without downloading or writing anything.
+
+        Only the first stage, :class:`~pulpcore.plugin.stages.QueryExistingArtifacts`,
+        :class:`~pulpcore.plugin.stages.QueryExistingContents` and
+        :class:`~pulpcore.plugin.stages.ResolveContentFutures` are run, followed by a
+        :class:`~pulpcore.plugin.stages.SyncPlanner` counting the changes against the latest
+        version. No version is created. Futures resolve to the unsaved units of new content. Custom
+        stages of :meth:`pipeline_stages` and `remove_duplicates` are not taken into account.
+
+        Returns:
+            :class:`~pulpcore.plugin.stages.SyncPlan`: The estimated changes.
+        """
+        with WorkingDirectory():
+            loop = asyncio.get_event_loop()
+            planner = SyncPlanner(RepositoryVersion.latest(self.repository), mirror=self.mirror,
+                                  delta=self.delta)
+            stages = [
+                self.first_stage,
+                QueryExistingArtifacts(),
+                QueryExistingContents(),
+                ResolveContentFutures(),
+                planner,
+                EndStage(),
+            ]
+            loop.run_until_complete(create_pipeline(stages))
+        return planner.plan
+
+    @staticmethod
+    def _stores_fingerprint(remote):
+        """
+        Args:
+            remote (:class:`~pulpcore.plugin.models.Remote`): The Remote synced from.
+
+        Returns:
+            bool: True if the model of `remote` has a `last_sync_fingerprint` field.
+        """
+        try:
+            remote._meta.get_field('last_sync_fingerprint')
+        except FieldDoesNotExist:
+            return False
+        return True
+
+    def _fingerprint_key(self, fingerprint, version):
+        """
+        Identify a sync by the upstream state, the version it created, its options and the url
+        and download policy of the Remote.
+
+        Args:
+            fingerprint (tuple): The Remote and fingerprint returned by
+                :meth:`~pulpcore.plugin.stages.Stage.upstream_fingerprint`.
+            version (:class:`~pulpcore.plugin.models.RepositoryVersion`): The version created by
+                the sync.
+
+        Returns:
+            str: A sha256 hex digest identifying the sync.
+        """
+        remote, value = fingerprint
+        remove_duplicates = sorted(
+            (duplicates['model']._meta.label, list(duplicates['field_names']))
+            for duplicates in self.remove_duplicates
+        )
+        key = repr((str(remote.pk), remote.url, remote.policy, str(version.pk), self.mirror,
+                    remove_duplicates, self.delta, value))
+        return hashlib.sha256(key.encode()).hexdigest()
+
+
+class RepositoryTarget:
+    """
+    A repository receiving a new version from a :class:`MultiDeclarativeVersion`.
+
+    Args:
+        repository (:class:`~pulpcore.plugin.models.Repository`): The repository receiving the
+            new version.
+        filter (callable): Takes a :class:`~pulpcore.plugin.stages.DeclarativeContent` and
+            returns whether it is declared for this repository. Optional, all content is declared
+            for the repository by default.
+        mirror (bool): Like the `mirror` of :class:`DeclarativeVersion`. Units not declared for
+            this repository, including the ones rejected by `filter`, are removed.
+        remove_duplicates (list): Like the `remove_duplicates` of :class:`DeclarativeVersion`.
+        delta (bool): Like the `delta` of :class:`DeclarativeVersion`.
+
+    Raises:
+        ValueError: If both `mirror` and `delta` are set.
+    """
+
+    def __init__(self, repository, filter=None, mirror=False, remove_duplicates=None,
+                 delta=False):
+        if mirror and delta:
+            raise ValueError(_("A RepositoryTarget can't both mirror and apply a delta"))
+        self.repository = repository
+        self.filter = filter
+        self.mirror = mirror
+        self.remove_duplicates = remove_duplicates or []
+        self.delta = delta
+
+    def association_stages(self, new_version):
+        """
+        Build the stages associating the declared content with the new version of the repository.
+
+        Args:
+            new_version (:class:`~pulpcore.plugin.models.RepositoryVersion`): The new version of
+                the repository.
+
+        Returns:
+            list: List of :class:`~pulpcore.plugin.stages.Stage` instances, ending with an
+            :class:`~pulpcore.plugin.stages.EndStage`.
+        """
+        stages = [
+            RemoveDuplicates(new_version, **dupe_query_dict)
+            for dupe_query_dict in self.remove_duplicates
+        ]
+        if self.delta:
+            stages.append(ContentDeltaAssociation(new_version))
+        else:
+            stages.append(ContentAssociation(new_version))
+        if self.mirror:
+            stages.append(ContentUnassociation(new_version))
+        stages.append(EndStage())
+        return stages
+
+
+class MultiDeclarativeVersion:
+
+    def __init__(self, first_stage, targets):
+        """
+        A pipeline that creates new versions of several repositories from one stream of
+        :class:`~pulpcore.plugin.stages.DeclarativeContent` objects.
+
+        This is like a :class:`DeclarativeVersion` for each repository, except that the content is
+        queried, downloaded and saved once. Only the stages of
+        :meth:`RepositoryTarget.association_stages` run for each repository, in a branch of a
+        :class:`~pulpcore.plugin.stages.FanOut` receiving the content accepted by the `filter` of
+        the target.
+
+        >>> targets = [
+        >>>     RepositoryTarget(stable, filter=lambda d_content: d_content.content.stable),
+        >>>     RepositoryTarget(everything, mirror=True),
+        >>> ]
+        >>> MultiDeclarativeVersion(MyFirstStage(remote), targets).create()
+
+        The versions are created together: if the sync of any repository fails, the other
+        branches are cancelled and none of the versions is kept. The versions are completed in one
+        transaction. Upstream fingerprints are not used to skip syncs.
+
+        Args:
+            first_stage (:class:`~pulpcore.plugin.stages.Stage`): The first stage to receive
+                :class:`~pulpcore.plugin.stages.DeclarativeContent` from.
+            targets (list): The :class:`RepositoryTarget` objects of the repositories receiving
+                the new versions.
+
+        Raises:
+            ValueError: If a repository is targeted more than once.
+
+        """
+        repositories = [target.repository.pk for target in targets]
+        if len(set(repositories)) != len(repositories):
+            raise ValueError(_('Each repository can only be targeted once.'))
+        self.first_stage = first_stage
+        self.targets = targets
+
+    def pipeline_stages(self):
+        """
+        Build the list of pipeline stages shared by all repositories, feeding into the FanOut stage.
+
+        Plugin-writers may override this method to build a custom pipeline, like
+        :meth:`DeclarativeVersion.pipeline_stages`.
+
+        Returns:
+            list: List of :class:`~pulpcore.plugin.stages.Stage` instances
+
+        """
+        return [
+            self.first_stage,
+            QueryExistingArtifacts(),
+            artifact_downloader(),
+            ArtifactSaver(),
+            QueryExistingContents(),
+            ContentSaver(),
+            RemoteArtifactSaver(),
+            ResolveContentFutures(),
+        ]
+
+    def create(self):
+        """
+        Perform the work. This is the long-blocking call where all syncing occurs.
+
+        Returns:
+            list: The new :class:`~pulpcore.plugin.models.RepositoryVersion` objects, in the order
+            of the targets.
+        """
+        with WorkingDirectory():
+            # deletes all new versions if the sync fails
+            with ExitStack() as stack:
+                new_versions = [
+                    stack.enter_context(RepositoryVersion.create(target.repository))
+                    for target in self.targets
+                ]
+                branches = [
+                    (target.filter, target.association_stages(new_version))
+                    for target, new_version in zip(self.targets, new_versions)
+                ]
+                stages = self.pipeline_stages()
+                stages.extend([FanOut(branches), EndStage()])
+                loop = asyncio.get_event_loop()
+                loop.run_until_complete(create_pipeline(stages))
+                completions = stack.pop_all()
+            try:
+                with transaction.atomic():
+                    completions.close()
+            except Exception:
+                for new_version in new_versions:
+                    self._discard(new_version)
+                raise
+        return new_versions
+
+    @staticmethod
+    def _discard(new_version):
+        """
+        Delete a new version whose completion was rolled back, unless it is already deleted.
+
+        The version is reloaded first, so it is deleted as the incomplete version it is in the
+        database. Errors are logged, to keep the error that rolled back the completion.
+
+        Args:
+            new_version (:class:`~pulpcore.plugin.models.RepositoryVersion`): The version.
+        """
+        try:
+            if new_version.pk is None:
+                return
+            new_version.refresh_from_db()
+            new_version.delete()
+        except ObjectDoesNotExist:
+            pass
+        except Exception:
+            log.exception(_('Failed to delete the new version %(version)s.'),
+                          {'version': new_version})
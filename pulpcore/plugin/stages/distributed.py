@@ -0,0 +1,421 @@
+import asyncio
+from collections import defaultdict
+from gettext import gettext as _
+import logging
+import uuid
+
+from rq import Queue
+
+from pulpcore.app.models import Remote, ReservedResource, Task, Worker
+from pulpcore.constants import TASK_FINAL_STATES, TASK_STATES
+from pulpcore.plugin.download import PRIORITY_AWAITED
+from pulpcore.plugin.models import Artifact, ProgressBar
+from pulpcore.plugin.tasking import WorkingDirectory
+from pulpcore.tasking import connection
+from pulpcore.tasking.tasks import _release_resources, TASK_TIMEOUT
+from pulpcore.tasking.util import cancel
+
+from .api import Stage
+from .models import DeclarativeArtifact
+from .progress import ProgressReporter
+
+
+log = logging.getLogger(__name__)
+
+
+def download_artifacts(remote_pk, downloads):
+    """
+    The task downloading and saving a shard of Artifacts for a
+    :class:`DistributedArtifactDownloader`.
+
+    Args:
+        remote_pk (str): The pk of the :class:`~pulpcore.plugin.models.Remote` to download with.
+        downloads (list): A dict for each Artifact, with its `url`, `extra_data`, declared `size`
+            and the declared `digests` keyed on the digest names.
+
+    Returns:
+        list: The pks of the saved :class:`~pulpcore.plugin.models.Artifact` objects, in the order
+        of `downloads`.
+    """
+    remote = Remote.objects.get(pk=remote_pk).cast()
+    with WorkingDirectory():
+        d_artifacts = [
+            DeclarativeArtifact(
+                Artifact(size=download['size'], **download['digests']),
+                download['url'],
+                download['url'],
+                remote,
+                download['extra_data'],
+            )
+            for download in downloads
+        ]
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(
+            asyncio.gather(*[d_artifact.download() for d_artifact in d_artifacts])
+        )
+        for d_artifact in d_artifacts:
+            d_artifact.artifact.file = str(d_artifact.artifact.file)
+        artifacts = Artifact.objects.bulk_get_or_create(
+            d_artifact.artifact for d_artifact in d_artifacts
+        )
+    return [artifact.pk for artifact in artifacts]
+
+
+class DistributedArtifactDownloader(Stage):
+    """
+    A Stages API stage downloading :class:`~pulpcore.plugin.models.Artifact` files on other workers.
+
+    This stage can replace :class:`~pulpcore.plugin.stages.ArtifactDownloader` in large syncs, to
+    use the bandwidth and CPU of several hosts for downloading and hashing. The Artifacts to
+    download are grouped by Remote into shards of `shard_size`. Each shard is downloaded and
+    saved by a :func:`download_artifacts` task. It is put straight into the queue of a worker that
+    is idle at that moment, with a reservation of its own so no other task is dispatched to the
+    worker meanwhile. The resource manager is not involved, so a shard never waits for a busy
+    installation and several syncs can distribute their downloads at the same time. Once the task
+    completed, the saved Artifacts are looked up by their strongest declared digest and replace
+    the unsaved ones in the :class:`~pulpcore.plugin.stages.DeclarativeArtifact` objects.
+    Each :class:`~pulpcore.plugin.stages.DeclarativeContent` is sent to `self._out_q` once all of
+    its Artifacts are downloaded. The last shards are dispatched once the previous stage finished.
+
+    Content something waits for, see
+    :attr:`~pulpcore.plugin.stages.DeclarativeContent.download_priority`, is downloaded by this
+    worker right away instead, and so is content with an Artifact declaring none of the
+    :attr:`~pulpcore.plugin.models.Artifact.RELIABLE_DIGEST_FIELDS`, which couldn't be looked up.
+
+    At most `max_shards` shards are downloaded at a time. The stage polls the state of their tasks
+    every `poll_interval` seconds, fails if one of them fails, and cancels them if it is cancelled.
+    A shard is downloaded by this worker instead if no other worker is idle when it is dispatched,
+    or if its task didn't start within `start_timeout` seconds or finish within `task_timeout`
+    seconds, in which case the task is cancelled and removed from the queue of its worker. Unlike
+    :class:`~pulpcore.plugin.stages.ArtifactDownloader`, it doesn't record download statistics.
+    The workers need to share the storage of Artifacts.
+
+    This stage creates a ProgressBar named 'Downloading Artifacts' that counts the number of
+    downloads completed.
+
+    Args:
+        shard_size (int): The number of Artifacts downloaded by one task. Optional and defaults
+            to 500.
+        max_shards (int): The maximum number of tasks running at a time. Optional and defaults
+            to 4.
+        poll_interval (float): The seconds between checks of the state of the tasks. Optional and
+            defaults to 1.
+        start_timeout (float): The seconds a task may wait for its worker before its shard is
+            downloaded by this worker instead. Optional and defaults to 30.
+        task_timeout (float): The seconds a task may take before its shard is downloaded by this
+            worker instead. Optional and defaults to 3600, None for no limit.
+        args: unused positional arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
+        kwargs: unused keyword arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
+    """
+
+    def __init__(self, shard_size=500, max_shards=4, poll_interval=1, start_timeout=30,
+                 task_timeout=3600, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.shard_size = shard_size
+        self.max_shards = max_shards
+        self.poll_interval = poll_interval
+        self.start_timeout = start_timeout
+        self.task_timeout = task_timeout
+        self._remaining = {}
+
+    async def run(self):
+        """
+        The coroutine for this stage.
+
+        Returns:
+            The coroutine for this stage.
+        """
+        slots = asyncio.Semaphore(self.max_shards)
+        shards = {}
+        pending = set()
+
+        async def dispatch(shard):
+            await slots.acquire()
+            pending.add(asyncio.ensure_future(self._run_shard(shard, slots, progress)))
+
+        with ProgressReporter(ProgressBar(message='Downloading Artifacts')) as progress:
+            try:
+                async for d_content in self.items():
+                    to_download = [
+                        d_artifact for d_artifact in d_content.d_artifacts
+                        if d_artifact.artifact._state.adding and not d_artifact.deferred_download
+                    ]
+                    if not to_download:
+                        await self.put(d_content)
+                    elif d_content.download_priority == PRIORITY_AWAITED or not all(
+                        self._reliable_digest(d_artifact.artifact) for d_artifact in to_download
+                    ):
+                        pending.add(asyncio.ensure_future(
+                            self._download_here(d_content, to_download, progress)
+                        ))
+                    else:
+                        self._remaining[id(d_content)] = len(to_download)
+                        for d_artifact in to_download:
+                            shard = shards.setdefault(id(d_artifact.remote), [])
+                            shard.append((d_content, d_artifact))
+                            if len(shard) >= self.shard_size:
+                                await dispatch(shards.pop(id(d_artifact.remote)))
+                    pending = self._check(pending)
+                for shard in shards.values():
+                    await dispatch(shard)
+                await asyncio.gather(*pending)
+            except (asyncio.CancelledError, Exception):
+                for future in pending:
+                    future.cancel()
+                if pending:
+                    await asyncio.wait(pending, timeout=60)
+                raise
+
+    @staticmethod
+    def _check(pending):
+        """
+        Raise the error of a failed shard or local download.
+
+        Args:
+            pending (set): The futures of the shards and local downloads.
+
+        Returns:
+            set: The futures not done yet.
+        """
+        done = {future for future in pending if future.done()}
+        for future in done:
+            future.result()
+        return pending - done
+
+    async def _download_here(self, d_content, d_artifacts, progress):
+        """
+        Download the Artifacts of a content unit in this worker.
+
+        Args:
+            d_content (:class:`~pulpcore.plugin.stages.DeclarativeContent`): The content unit.
+            d_artifacts (list): Its :class:`~pulpcore.plugin.stages.DeclarativeArtifact` objects
+                to download.
+            progress (:class:`~pulpcore.plugin.stages.ProgressReporter`): The progress of the
+                downloads.
+        """
+        await asyncio.gather(*[
+            d_artifact.download(priority=d_content.download_priority)
+            for d_artifact in d_artifacts
+        ])
+        progress.increment(len(d_artifacts))
+        await self.put(d_content)
+
+    async def _run_shard(self, shard, slots, progress):
+        """
+        Download a shard of Artifacts in a task, and pass on the content units completed.
+
+        The shard is downloaded by this worker if no other worker is idle or the task timed out.
+
+        Args:
+            shard (list): Tuples of a :class:`~pulpcore.plugin.stages.DeclarativeContent` and one
+                of its :class:`~pulpcore.plugin.stages.DeclarativeArtifact` objects, all with the
+                same Remote.
+            slots (asyncio.Semaphore): The semaphore to release when the shard is downloaded.
+            progress (:class:`~pulpcore.plugin.stages.ProgressReporter`): The progress of the
+                downloads.
+
+        Raises:
+            RuntimeError: If the task failed or was canceled.
+        """
+        try:
+            if not await self._download_in_task(shard):
+                await asyncio.gather(*[d_artifact.download() for d_content, d_artifact in shard])
+        finally:
+            slots.release()
+
+        for d_content, d_artifact in shard:
+            self._remaining[id(d_content)] -= 1
+            if not self._remaining[id(d_content)]:
+                del self._remaining[id(d_content)]
+                await self.put(d_content)
+        progress.increment(len(shard))
+
+    async def _download_in_task(self, shard):
+        """
+        Download a shard of Artifacts in a task, and replace them with the saved Artifacts.
+
+        Args:
+            shard (list): Tuples of a :class:`~pulpcore.plugin.stages.DeclarativeContent` and one
+                of its :class:`~pulpcore.plugin.stages.DeclarativeArtifact` objects, all with the
+                same Remote.
+
+        Returns:
+            bool: Whether the task completed, False if no worker was idle or the task timed out and
+            was canceled.
+
+        Raises:
+            RuntimeError: If the task failed or was canceled, or didn't save all Artifacts.
+        """
+        remote = shard[0][1].remote
+        downloads = [self._describe(d_artifact) for d_content, d_artifact in shard]
+        task_id = self._enqueue(str(remote.pk), downloads)
+        if task_id is None:
+            log.debug(_('%(name)s - no worker is idle, downloading %(count)d Artifacts here.'),
+                      {'name': self, 'count': len(downloads)})
+            return False
+        log.debug(_('%(name)s - dispatched task %(task)s downloading %(count)d Artifacts.'),
+                  {'name': self, 'task': task_id, 'count': len(downloads)})
+        try:
+            completed = await self._wait_for(task_id)
+        except asyncio.CancelledError:
+            cancel(task_id)
+            raise
+        if not completed:
+            cancel(task_id)
+            log.info(_('The task %(task)s downloading %(count)d Artifacts timed out, downloading '
+                       'them here.'), {'task': task_id, 'count': len(downloads)})
+            return False
+        self._replace_with_saved(task_id, [d_artifact for d_content, d_artifact in shard])
+        return True
+
+    @staticmethod
+    def _enqueue(remote_pk, downloads):
+        """
+        Dispatch a :func:`download_artifacts` task straight to the queue of an idle worker.
+
+        The worker is reserved for the task like the resource manager does, and released by a
+        job enqueued after it. If another task reserved the worker meanwhile, the task is dropped.
+
+        Args:
+            remote_pk (str): The pk of the Remote to download with.
+            downloads (list): The descriptions of the downloads, see :meth:`_describe`.
+
+        Returns:
+            str: The pk of the task, or None if no worker is idle.
+        """
+        try:
+            worker = Worker.objects.get_unreserved_worker()
+        except Worker.DoesNotExist:
+            return None
+        task_id = str(uuid.uuid4())
+        task = Task.objects.create(
+            pk=task_id,
+            state=TASK_STATES.WAITING,
+            name='{module}.{name}'.format(module=download_artifacts.__module__,
+                                          name=download_artifacts.__name__),
+            parent=Task.current(),
+            worker=worker,
+        )
+        worker.lock_resources(task, ['download-artifacts:{id}'.format(id=task_id)])
+        if ReservedResource.objects.filter(worker=worker).count() > 1:
+            task.release_resources()
+            task.delete()
+            return None
+        queue = Queue(worker.name, connection=connection.get_redis_connection())
+        try:
+            queue.enqueue(download_artifacts, args=(remote_pk, downloads), job_id=task_id,
+                          timeout=TASK_TIMEOUT)
+        finally:
+            queue.enqueue(_release_resources, args=(task_id,))
+        return task_id
+
+    def _replace_with_saved(self, task_id, d_artifacts):
+        """
+        Replace unsaved Artifacts with the saved ones with their strongest declared digest.
+
+        Args:
+            task_id (str): The pk of the task that saved the Artifacts.
+            d_artifacts (list): The :class:`~pulpcore.plugin.stages.DeclarativeArtifact` objects
+                with the unsaved Artifacts.
+
+        Raises:
+            RuntimeError: If an Artifact wasn't saved.
+        """
+        d_artifacts_by_digest = defaultdict(lambda: defaultdict(list))
+        for d_artifact in d_artifacts:
+            digest_name = self._reliable_digest(d_artifact.artifact)
+            digest_value = getattr(d_artifact.artifact, digest_name)
+            d_artifacts_by_digest[digest_name][digest_value].append(d_artifact)
+        for digest_name, d_artifacts_by_value in d_artifacts_by_digest.items():
+            query_kwargs = {'{name}__in'.format(name=digest_name): list(d_artifacts_by_value)}
+            for artifact in Artifact.objects.filter(**query_kwargs):
+                for d_artifact in d_artifacts_by_value.pop(getattr(artifact, digest_name), []):
+                    d_artifact.artifact = artifact
+            if d_artifacts_by_value:
+                raise RuntimeError(
+                    _('The task {id} did not save the Artifacts with the {name} digests '
+                      '{values}.').format(id=task_id, name=digest_name,
+                                          values=', '.join(d_artifacts_by_value))
+                )
+
+    async def _wait_for(self, task_id):
+        """
+        Wait for a task to start within `start_timeout` and finish within `task_timeout` seconds.
+
+        Args:
+            task_id (str): The pk of the task.
+
+        Returns:
+            bool: Whether the task completed, False if it timed out.
+
+        Raises:
+            RuntimeError: If the task failed or was canceled.
+        """
+        loop = asyncio.get_event_loop()
+        start_deadline = loop.time() + self.start_timeout
+        deadline = None
+        if self.task_timeout is not None:
+            deadline = loop.time() + self.task_timeout
+        while True:
+            state, error = self._task_state(task_id)
+            if state in TASK_FINAL_STATES:
+                break
+            now = loop.time()
+            if state == TASK_STATES.WAITING and now >= start_deadline:
+                return False
+            if deadline is not None and now >= deadline:
+                return False
+            await asyncio.sleep(self.poll_interval)
+        if state != TASK_STATES.COMPLETED:
+            description = (error or {}).get('description', state)
+            raise RuntimeError(_('The task {id} downloading Artifacts did not complete: '
+                                 '{description}').format(id=task_id, description=description))
+        return True
+
+    @staticmethod
+    def _reliable_digest(artifact):
+        """
+        Args:
+            artifact (:class:`~pulpcore.plugin.models.Artifact`): An unsaved Artifact.
+
+        Returns:
+            str: The name of the strongest reliable digest the Artifact declares, or None.
+        """
+        for digest_name in Artifact.RELIABLE_DIGEST_FIELDS:
+            if getattr(artifact, digest_name):
+                return digest_name
+        return None
+
+    @staticmethod
+    def _task_state(task_id):
+        """
+        Args:
+            task_id (str): The pk of a task.
+
+        Returns:
+            tuple: The state and the error of the task.
+        """
+        return Task.objects.filter(pk=task_id).values_list('state', 'error').get()
+
+    @staticmethod
+    def _describe(d_artifact):
+        """
+        Args:
+            d_artifact (:class:`~pulpcore.plugin.stages.DeclarativeArtifact`): An Artifact to
+                download.
+
+        Returns:
+            dict: The description of the download passed to :func:`download_artifacts`.
+        """
+        artifact = d_artifact.artifact
+        digests = {}
+        for digest_name in Artifact.DIGEST_FIELDS:
+            digest_value = getattr(artifact, digest_name)
+            if digest_value:
+                digests[digest_name] = digest_value
+        return {
+            'url': d_artifact.url,
+            'extra_data': d_artifact.extra_data,
+            'size': artifact.size,
+            'digests': digests,
+        }
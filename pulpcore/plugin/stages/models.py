@@ -2,8 +2,11 @@ from gettext import gettext as _
 
 import asyncio
 
+from pulpcore.plugin.download import PRIORITY_AWAITED, PRIORITY_BULK
 from pulpcore.plugin.models import Artifact
 
+from .records import model_of
+
 
 class DeclarativeArtifact:
     """
@@ -19,7 +22,8 @@ class DeclarativeArtifact:
     Attributes:
         artifact (:class:`~pulpcore.plugin.models.Artifact`): An
             :class:`~pulpcore.plugin.models.Artifact` either saved or unsaved. If unsaved, it
-            may have partial digest information attached to it.
+            may have partial digest information attached to it, and may be declared as a
+            :class:`~pulpcore.plugin.stages.Record`.
         url (str): the url to fetch the :class:`~pulpcore.plugin.models.Artifact` from.
         relative_path (str): the relative_path this :class:`~pulpcore.plugin.models.Artifact`
             should be published at for any Publication.
@@ -52,10 +56,15 @@ class DeclarativeArtifact:
         self.extra_data = extra_data or {}
         self.deferred_download = deferred_download
 
-    async def download(self):
+    async def download(self, priority=PRIORITY_BULK):
         """
         Download content and update the associated Artifact.
 
+        Args:
+            priority (int): The download priority, see
+                :meth:`~pulpcore.plugin.download.DownloaderFactory.build`. Defaults to
+                :data:`~pulpcore.plugin.download.PRIORITY_BULK`.
+
         Returns:
             Returns the :class:`~pulpcore.plugin.download.DownloadResult` of the Artifact.
         """
@@ -72,6 +81,7 @@ class DeclarativeArtifact:
             validation_kwargs['expected_size'] = expected_size
         downloader = self.remote.get_downloader(
             url=self.url,
+            priority=priority,
             **validation_kwargs
         )
         # Custom downloaders may need extra information to complete the request.
@@ -95,7 +105,7 @@ class DeclarativeContent:
 
     Attributes:
         content (subclass of :class:`~pulpcore.plugin.models.Content`): A Content unit, possibly
-            unsaved
+            unsaved. Unsaved units may be declared as a :class:`~pulpcore.plugin.stages.Record`.
         d_artifacts (list): A list of zero or more
             :class:`~pulpcore.plugin.stages.DeclarativeArtifact` objects associated with `content`.
         extra_data (dict): A dictionary available for additional data to be stored in.
@@ -105,21 +115,29 @@ class DeclarativeContent:
             :class:`~pulpcore.plugin.models.Content` in the
             :class:`~pulpcore.plugin.stages.ResolveContentFutures` stage. See the
             :class:`~pulpcore.plugin.stages.ResolveContentFutures` stage for example usage.
+        removed (bool): If `True`, `content` is removed from the repository version instead of
+            added. Only honored by a :class:`~pulpcore.plugin.stages.DeclarativeVersion` with
+            `delta=True`. The natural key fields of `content` are enough to identify it, the unit
+            is never saved. Defaults to `False`.
 
     Raises:
-        ValueError: If `content` is not specified.
+        ValueError: If `content` is not specified, or `removed` is set with `d_artifacts`.
     """
 
-    __slots__ = ('content', 'd_artifacts', 'extra_data', 'does_batch', 'future')
+    __slots__ = ('content', 'd_artifacts', 'extra_data', 'does_batch', 'future', 'removed')
 
-    def __init__(self, content=None, d_artifacts=None, extra_data=None, does_batch=True):
+    def __init__(self, content=None, d_artifacts=None, extra_data=None, does_batch=True,
+                 removed=False):
         if not content:
             raise ValueError(_("DeclarativeContent must have a 'content'"))
+        if removed and d_artifacts:
+            raise ValueError(_("A removed DeclarativeContent can't have 'd_artifacts'"))
         self.content = content
         self.d_artifacts = d_artifacts or []
         self.extra_data = extra_data or {}
         self.does_batch = does_batch
         self.future = None
+        self.removed = removed
 
     def get_or_create_future(self):
         """
@@ -137,5 +155,18 @@ class DeclarativeContent:
             self.future = asyncio.get_event_loop().create_future()
         return self.future
 
+    @property
+    def download_priority(self):
+        """
+        The priority to download the artifacts of this content unit with.
+
+        Content something waits for, i.e. with a future or not batching, is downloaded with
+        :data:`~pulpcore.plugin.download.PRIORITY_AWAITED`, everything else with
+        :data:`~pulpcore.plugin.download.PRIORITY_BULK`.
+        """
+        if self.future is not None or not self.does_batch:
+            return PRIORITY_AWAITED
+        return PRIORITY_BULK
+
     def __str__(self):
-        return str(self.content.__class__.__name__)
+        return str(model_of(self.content).__name__)
@@ -0,0 +1,154 @@
+from pulpcore.plugin.models import Artifact
+
+from .api import BatchStage
+from .content_stages import natural_key_values
+from .records import model_of
+
+
+class SyncPlan:
+    """
+    The estimated changes of a sync, as computed by :meth:`DeclarativeVersion.plan`.
+
+    Attributes:
+        units_to_add (int): The number of units that would be added to the repository version.
+        units_to_remove (int): The number of units that would be removed from the repository
+            version.
+        new_units (int): The number of units to add that are not in Pulp yet.
+        artifacts_to_download (int): The number of Artifacts that are not in Pulp yet and would be
+            downloaded immediately.
+        download_bytes (int): The sum of the declared sizes of `artifacts_to_download`.
+        artifacts_of_unknown_size (int): The number of `artifacts_to_download` declared without a
+            size, which are missing from `download_bytes`.
+    """
+
+    __slots__ = ('units_to_add', 'units_to_remove', 'new_units', 'artifacts_to_download',
+                 'download_bytes', 'artifacts_of_unknown_size')
+
+    def __init__(self):
+        self.units_to_add = 0
+        self.units_to_remove = 0
+        self.new_units = 0
+        self.artifacts_to_download = 0
+        self.download_bytes = 0
+        self.artifacts_of_unknown_size = 0
+
+    def as_dict(self):
+        """
+        Returns:
+            dict: The estimates keyed on the attribute names.
+        """
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class SyncPlanner(BatchStage):
+    """
+    A Stages API stage that counts the changes the declared content would make to a version.
+
+    This stage expects :class:`~pulpcore.plugin.stages.DeclarativeContent` units from `self._in_q`
+    after :class:`~pulpcore.plugin.stages.QueryExistingArtifacts` and
+    :class:`~pulpcore.plugin.stages.QueryExistingContents` replaced the known ones with saved
+    objects. It writes nothing, and accumulates the counts in a :class:`SyncPlan`.
+
+    Units and Artifacts declared more than once are counted once. Units are the same if they have
+    the same natural key, Artifacts if they have the same strongest digest or, without digests,
+    the same url. Each batch costs one query to find which saved units are in `version`.
+
+    Args:
+        version (:class:`~pulpcore.plugin.models.RepositoryVersion`): The version the changes are
+            computed against, or None for an empty repository.
+        mirror (bool): Whether units of `version` that are not declared would be removed.
+        delta (bool): Whether units declared as `removed` would be removed.
+        args: unused positional arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
+        kwargs: unused keyword arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
+
+    Attributes:
+        plan (:class:`SyncPlan`): The counts so far, complete once the stage finished.
+    """
+
+    def __init__(self, version, mirror=False, delta=False, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.version = version
+        self.mirror = mirror
+        self.delta = delta
+        self.plan = SyncPlan()
+        self._new_keys = set()
+        self._added = set()
+        self._present = set()
+        self._removed = set()
+        self._artifact_keys = set()
+
+    async def run(self):
+        """
+        The coroutine for this stage.
+
+        Returns:
+            The coroutine for this stage.
+        """
+        await super().run()
+        if self.mirror and self.version is not None:
+            self.plan.units_to_remove = self.version.content.count() - len(self._present)
+
+    async def handle_batch(self, batch):
+        """
+        Count the changes of a batch of :class:`~pulpcore.plugin.stages.DeclarativeContent` objects.
+
+        Args:
+            batch (list): The :class:`~pulpcore.plugin.stages.DeclarativeContent` objects to
+                count.
+        """
+        saved_pks = {
+            d_content.content.pk for d_content in batch if not d_content.content._state.adding
+        }
+        in_version = set()
+        if self.version is not None and saved_pks:
+            in_version = set(
+                self.version.content.filter(pk__in=saved_pks).values_list('pk', flat=True)
+            )
+
+        for d_content in batch:
+            content = d_content.content
+            if d_content.removed:
+                if self.delta and content.pk in in_version and content.pk not in self._removed:
+                    self._removed.add(content.pk)
+                    self.plan.units_to_remove += 1
+                continue
+            if content._state.adding:
+                key = (model_of(content), natural_key_values(content) or id(content))
+                if key not in self._new_keys:
+                    self._new_keys.add(key)
+                    self.plan.new_units += 1
+                    self.plan.units_to_add += 1
+            elif content.pk in in_version:
+                if self.mirror:
+                    self._present.add(content.pk)
+            elif content.pk not in self._added:
+                self._added.add(content.pk)
+                self.plan.units_to_add += 1
+            for d_artifact in d_content.d_artifacts:
+                self._count_artifact(d_artifact)
+
+    def _count_artifact(self, d_artifact):
+        """
+        Count a declared Artifact if it would be downloaded.
+
+        Args:
+            d_artifact (:class:`~pulpcore.plugin.stages.DeclarativeArtifact`): The declared
+                Artifact.
+        """
+        artifact = d_artifact.artifact
+        if not artifact._state.adding or d_artifact.deferred_download:
+            return
+        key = ('url', d_artifact.url)
+        for digest_name in Artifact.DIGEST_FIELDS:
+            digest_value = getattr(artifact, digest_name)
+            if digest_value:
+                key = (digest_name, digest_value)
+                break
+        if key in self._artifact_keys:
+            return
+        self._artifact_keys.add(key)
+        self.plan.artifacts_to_download += 1
+        if artifact.size is None:
+            self.plan.artifacts_of_unknown_size += 1
+        else:
+            self.plan.download_bytes += artifact.size
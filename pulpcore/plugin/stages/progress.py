@@ -0,0 +1,84 @@
+import time
+
+
+class ProgressReporter:
+    """
+    Collect progress increments of a stage and save them to a ProgressBar in batches.
+
+    Stages handle many items per second, and saving the ProgressBar for each of them would issue one
+    UPDATE per item from the event loop. The reporter adds increments to the ProgressBar right away,
+    but saves it only when `interval` seconds passed since the last save, or when `max_items`
+    increments are pending. The final count is always saved when leaving the context manager.
+
+    Any stage can report its progress through a reporter:
+
+        >>> async def run(self):
+        >>>     with ProgressReporter(ProgressBar(message='Saving Things')) as progress:
+        >>>         async for batch in self.batches():
+        >>>             save_things(batch)
+        >>>             progress.increment(len(batch))
+
+    Args:
+        progress_bar (:class:`~pulpcore.plugin.models.ProgressBar`): The unsaved ProgressBar to
+            report to. It is entered as a context manager along with the reporter.
+        interval (float): The minimum number of seconds between two saves. Defaults to
+            `DEFAULT_INTERVAL`.
+        max_items (int): The number of pending increments that trigger a save before `interval`
+            passed. Defaults to None, which saves by time only.
+
+    Attributes:
+        DEFAULT_INTERVAL (float): The default minimum number of seconds between two saves.
+        progress_bar (:class:`~pulpcore.plugin.models.ProgressBar`): The ProgressBar reported to,
+            once the reporter was entered.
+    """
+
+    DEFAULT_INTERVAL = 2.0
+
+    def __init__(self, progress_bar, interval=None, max_items=None):
+        self._progress_bar = progress_bar
+        self.progress_bar = None
+        self.interval = self.DEFAULT_INTERVAL if interval is None else interval
+        self.max_items = max_items
+        self._pending = 0
+        self._last_flush = None
+
+    def __enter__(self):
+        self.progress_bar = self._progress_bar.__enter__()
+        self._last_flush = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._pending = 0
+        return self._progress_bar.__exit__(exc_type, exc, tb)
+
+    @property
+    def done(self):
+        """
+        The number of items reported so far, including the ones not saved yet.
+        """
+        return self.progress_bar.done
+
+    def increment(self, count=1):
+        """
+        Report `count` more items done and save the ProgressBar if a save is due.
+
+        Args:
+            count (int): The number of items done.
+        """
+        if not count:
+            return
+        self.progress_bar.done = self.progress_bar.done + count
+        self._pending += count
+        if self.max_items and self._pending >= self.max_items:
+            self.flush()
+        elif time.monotonic() - self._last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Save the ProgressBar if increments are pending.
+        """
+        if self._pending:
+            self.progress_bar.save()
+            self._pending = 0
+        self._last_flush = time.monotonic()
@@ -0,0 +1,147 @@
+import inspect
+
+
+class _Unsaved:
+    """
+    The `_state` of every :class:`Record`, telling stages it is not saved like a new instance.
+    """
+
+    __slots__ = ()
+
+    adding = True
+    db = None
+
+
+_fields_by_attname_cache = {}
+
+
+def _fields_by_attname(model):
+    try:
+        return _fields_by_attname_cache[model]
+    except KeyError:
+        fields = {field.attname: field for field in model._meta.concrete_fields}
+        _fields_by_attname_cache[model] = fields
+        return fields
+
+
+class Record:
+    """
+    The field values of an unsaved model instance, without the cost of creating the instance.
+
+    A first stage can declare a :class:`~pulpcore.plugin.models.Content` unit or an
+    :class:`~pulpcore.plugin.models.Artifact` as a record instead of an unsaved instance:
+
+        >>> unit = Record(MyContent, name=entry.name, version=entry.version)
+        >>> artifact = Record(Artifact, sha256=entry.sha256, size=entry.size)
+        >>> d_artifact = DeclarativeArtifact(artifact, url, entry.relative_path, self.remote)
+        >>> await self.put(DeclarativeContent(content=unit, d_artifacts=[d_artifact]))
+
+    Records take a fraction of the memory and CPU time of model instances. The builtin stages
+    handle them like unsaved instances: their `_state.adding` is True, and their field values and
+    `pk` are attributes. Fields without a value have their default, and callable defaults are only
+    called once. The class constants and class methods of the model, e.g. `TYPE` and
+    `natural_key_fields()`, are attributes too. Other attributes, like methods, raise an
+    AttributeError, the instance made by :meth:`materialize` has them. Records of saved objects
+    are replaced by the saved instances by :class:`~pulpcore.plugin.stages.QueryExistingArtifacts`
+    and :class:`~pulpcore.plugin.stages.QueryExistingContents`. Only the ones that need saving are
+    turned into model instances with :meth:`materialize`.
+
+    Args:
+        model (type): The model class of the instance.
+        values: The field values of the instance, as passed to the model class. Fields without
+            a value have their default.
+    """
+
+    __slots__ = ('_model', '_values')
+
+    _state = _Unsaved()
+
+    def __init__(self, model, **values):
+        self._model = model
+        self._values = values
+
+    def __getattr__(self, name):
+        if name in Record.__slots__:
+            raise AttributeError(name)
+        values = self._values
+        if name in values:
+            return values[name]
+        field = _fields_by_attname(self._model).get(name)
+        if field is None:
+            if name == 'pk':
+                return getattr(self, self._model._meta.pk.attname)
+            return self._class_attribute(name)
+        if field.name in values:
+            # the attname of a relation given as an object
+            related = values[field.name]
+            return None if related is None else related.pk
+        value = field.get_default()
+        if callable(field.default) and not field.is_relation:
+            # e.g. a uuid4 primary key keeps its value, like on an instance
+            values[field.name] = value
+        return value
+
+    def _class_attribute(self, name):
+        """
+        Args:
+            name (str): The name of an attribute of the model class.
+
+        Returns:
+            The attribute if it is a class constant or a class method of the model.
+
+        Raises:
+            AttributeError: For other attributes, e.g. methods and descriptors, which need an
+                instance.
+        """
+        try:
+            attribute = inspect.getattr_static(self._model, name)
+        except AttributeError:
+            attribute = None
+        if isinstance(attribute, (classmethod, staticmethod)):
+            return getattr(self._model, name)
+        if attribute is None or callable(attribute) or hasattr(attribute, '__get__'):
+            msg = "'{model}' record has no attribute '{name}'"
+            raise AttributeError(msg.format(model=self._model.__name__, name=name))
+        return attribute
+
+    def materialize(self):
+        """
+        Returns:
+            The unsaved model instance with the field values of this record.
+        """
+        return self._model(**self._values)
+
+    def __getstate__(self):
+        return self._model, self._values
+
+    def __setstate__(self, state):
+        self._model, self._values = state
+
+    def __repr__(self):
+        return '<Record: {model}>'.format(model=self._model.__name__)
+
+
+def model_of(obj):
+    """
+    Args:
+        obj: A model instance or a :class:`Record`.
+
+    Returns:
+        type: The model class of `obj`.
+    """
+    if isinstance(obj, Record):
+        return obj._model
+    return type(obj)
+
+
+def materialize(obj):
+    """
+    Args:
+        obj: A model instance or a :class:`Record`.
+
+    Returns:
+        `obj` if it is a model instance, otherwise the unsaved instance made from the record.
+    """
+    if isinstance(obj, Record):
+        return obj.materialize()
+    return obj
@@ -0,0 +1,145 @@
+import asyncio
+from collections import deque
+import logging
+import pickle
+import tempfile
+
+from pulpcore.app.models import Remote
+from pulpcore.plugin.tasking import WorkingDirectory
+
+
+log = logging.getLogger(__name__)
+
+
+class _SpillPickler(pickle.Pickler):
+
+    def __init__(self, file, shared):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.shared = shared
+
+    def persistent_id(self, obj):
+        if isinstance(obj, (Remote, asyncio.Future)):
+            self.shared[id(obj)] = obj
+            return id(obj)
+        return None
+
+
+class _SpillUnpickler(pickle.Unpickler):
+
+    def __init__(self, file, shared):
+        super().__init__(file)
+        self.shared = shared
+
+    def persistent_load(self, pid):
+        return self.shared[pid]
+
+
+class SpillQueue(asyncio.Queue):
+    """
+    A queue between two stages that keeps overflowing items in a file instead of blocking.
+
+    The first `memory_items` items are kept in memory. Further items are pickled to a temporary
+    file in `directory`, and read back in order once the items in memory were taken. The file is
+    emptied whenever all spilled items were read. A put doesn't block until the file reaches
+    `max_bytes`, so the stage before this queue can finish and free its own state while the stages
+    after it catch up. Once the file reached `max_bytes`, puts wait until all spilled items were
+    read.
+
+    Spilled items are read back as copies. Remotes and futures are not pickled but kept in memory,
+    so the items read back still refer to the same objects, but other changes made to an item
+    after putting it are lost.
+
+    Args:
+        memory_items (int): The number of items kept in memory before spilling to disk.
+        max_bytes (int): The size the file may reach before puts wait. Optional and defaults to
+            `MAX_BYTES`, None for no limit.
+        directory (str): The directory of the file. Optional and defaults to the
+            :class:`~pulpcore.plugin.tasking.WorkingDirectory` of the current task.
+        args: positional arguments passed along to :class:`asyncio.Queue`.
+        kwargs: keyword arguments passed along to :class:`asyncio.Queue`. `maxsize` is ignored.
+
+    Attributes:
+        MAX_BYTES (int): The default size the file may reach, 1 GiB.
+
+    Raises:
+        RuntimeError: When no `directory` is given outside of a task.
+    """
+
+    MAX_BYTES = 1024 ** 3
+
+    def __init__(self, memory_items=100, max_bytes=MAX_BYTES, directory=None, *args, **kwargs):
+        self.memory_items = memory_items
+        self.max_bytes = max_bytes
+        self.directory = directory if directory is not None else WorkingDirectory().path
+        kwargs['maxsize'] = 0
+        super().__init__(*args, **kwargs)
+
+    def _init(self, maxsize):
+        self._queue = deque()
+        self._file = None
+        self._read_position = 0
+        self._write_position = 0
+        self._spilled = 0
+        self._shared = {}
+
+    def _put(self, item):
+        if not self._spilled and len(self._queue) < self.memory_items:
+            self._queue.append(item)
+            return
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(dir=self.directory, prefix='spill-')
+            log.debug('Spilling queue items to disk.')
+        self._file.seek(self._write_position)
+        _SpillPickler(self._file, self._shared).dump(item)
+        self._write_position = self._file.tell()
+        self._spilled += 1
+
+    def _get(self):
+        if self._queue:
+            return self._queue.popleft()
+        self._file.seek(self._read_position)
+        item = _SpillUnpickler(self._file, self._shared).load()
+        self._read_position = self._file.tell()
+        self._spilled -= 1
+        if not self._spilled:
+            self._file.seek(0)
+            self._file.truncate()
+            self._read_position = self._write_position = 0
+            self._shared.clear()
+        return item
+
+    def full(self):
+        """
+        Returns:
+            bool: Whether the file reached `max_bytes`.
+        """
+        return self.max_bytes is not None and self._write_position >= self.max_bytes
+
+    def qsize(self):
+        """
+        Returns:
+            int: The number of items in memory and on disk.
+        """
+        return len(self._queue) + self._spilled
+
+    def empty(self):
+        """
+        Returns:
+            bool: Whether there are no items in memory or on disk.
+        """
+        return not self.qsize()
+
+    @property
+    def spilled(self):
+        """
+        int: The number of items currently on disk.
+        """
+        return self._spilled
+
+    def close(self):
+        """
+        Remove the file of the spilled items.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,103 @@
+import asyncio
+
+import asynctest
+
+from pulpcore.plugin.download import (
+    AdaptiveSemaphore,
+    PRIORITY_AWAITED,
+    PRIORITY_BULK,
+    PRIORITY_METADATA,
+)
+
+
+class TestAdaptiveSemaphore(asynctest.ClockedTestCase):
+
+    async def hold(self, semaphore, duration):
+        async with semaphore:
+            await asyncio.sleep(duration)
+            semaphore.record_success(duration)
+
+    async def test_limit_is_enforced(self):
+        semaphore = AdaptiveSemaphore(2, max_value=2)
+        tasks = [self.loop.create_task(self.hold(semaphore, 1)) for i in range(5)]
+        await self.advance(0.5)
+        self.assertEqual(semaphore.in_use, 2)
+        await self.advance(1)
+        self.assertEqual(semaphore.in_use, 2)
+        await self.advance(2)
+        self.assertTrue(all(task.done() for task in tasks))
+        self.assertEqual(semaphore.in_use, 0)
+
+    async def test_increase_while_throughput_improves(self):
+        semaphore = AdaptiveSemaphore(2, max_value=4)
+        tasks = [self.loop.create_task(self.hold(semaphore, 1)) for i in range(20)]
+        await self.advance(1.5)
+        self.assertEqual(semaphore.limit, 3)
+        await self.advance(10)
+        self.assertEqual(semaphore.limit, 4)
+        self.assertTrue(all(task.done() for task in tasks))
+
+    async def test_congestion_decreases_once_per_window(self):
+        semaphore = AdaptiveSemaphore(8, max_value=8)
+        semaphore.congestion_detected()
+        semaphore.congestion_detected()
+        self.assertEqual(semaphore.limit, 4)
+        for i in range(4):
+            semaphore.record_success(1)
+        semaphore.congestion_detected()
+        self.assertEqual(semaphore.limit, 2)
+
+    async def test_never_below_min_value(self):
+        semaphore = AdaptiveSemaphore(2, min_value=2, max_value=4)
+        semaphore.congestion_detected()
+        self.assertEqual(semaphore.limit, 2)
+
+    async def test_rising_latency_decreases(self):
+        semaphore = AdaptiveSemaphore(2, max_value=2)
+        semaphore.record_success(1)
+        semaphore.record_success(1)
+        semaphore.record_success(5)
+        semaphore.record_success(5)
+        self.assertEqual(semaphore.limit, 1)
+
+    async def test_large_downloads_are_not_congestion(self):
+        semaphore = AdaptiveSemaphore(2, max_value=2)
+        semaphore.record_success(0.1, size=10)
+        semaphore.record_success(0.1, size=10)
+        semaphore.record_success(0.1, size=10 ** 9)
+        semaphore.record_success(None, size=10 ** 9)
+        self.assertEqual(semaphore.limit, 2)
+
+    async def test_priority_order(self):
+        semaphore = AdaptiveSemaphore(1)
+        order = []
+
+        async def download(name, priority):
+            async with semaphore.with_priority(priority):
+                order.append(name)
+                await asyncio.sleep(1)
+
+        self.loop.create_task(download('bulk-1', PRIORITY_BULK))
+        await self.advance(0.5)
+        for name, priority in [('bulk-2', PRIORITY_BULK), ('awaited', PRIORITY_AWAITED),
+                               ('metadata', PRIORITY_METADATA)]:
+            self.loop.create_task(download(name, priority))
+        await self.advance(4)
+        self.assertEqual(order, ['bulk-1', 'metadata', 'awaited', 'bulk-2'])
+
+    async def test_cancelled_waiter_frees_its_turn(self):
+        semaphore = AdaptiveSemaphore(1)
+        first = self.loop.create_task(self.hold(semaphore, 1))
+        await self.advance(0.5)
+        cancelled = self.loop.create_task(self.hold(semaphore, 1))
+        last = self.loop.create_task(self.hold(semaphore, 1))
+        await self.advance(0.1)
+        cancelled.cancel()
+        await self.advance(2)
+        self.assertTrue(first.done() and last.done())
+        self.assertTrue(cancelled.cancelled())
+        self.assertEqual(semaphore.in_use, 0)
+
+    def test_invalid_limits(self):
+        with self.assertRaises(ValueError):
+            AdaptiveSemaphore(2, max_value=1)
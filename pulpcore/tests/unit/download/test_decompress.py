@@ -0,0 +1,93 @@
+import bz2
+import gzip
+import hashlib
+import lzma
+import os
+import tempfile
+
+import asynctest
+
+from pulpcore.exceptions import DigestValidationError, SizeValidationError
+from pulpcore.plugin.download import decompressing_downloader_class, FileDownloader
+
+
+DATA = b'<metadata>\n' + b'<package name="foo"/>\n' * 10000 + b'</metadata>\n'
+
+
+class TestDecompressingDownloader(asynctest.TestCase):
+
+    def setUp(self):
+        self.working_dir = tempfile.TemporaryDirectory()
+        self.old_cwd = os.getcwd()
+        os.chdir(self.working_dir.name)
+
+    def tearDown(self):
+        os.chdir(self.old_cwd)
+        self.working_dir.cleanup()
+
+    def write_source(self, name, compressed):
+        path = os.path.join(self.working_dir.name, name)
+        with open(path, 'wb') as f:
+            f.write(compressed)
+        return 'file://' + path
+
+    async def download(self, url, **kwargs):
+        downloader = decompressing_downloader_class(FileDownloader)(url, **kwargs)
+        return downloader, await downloader.run()
+
+    async def test_formats(self):
+        for name, compress in [('primary.xml.gz', gzip.compress), ('primary.xml.bz2', bz2.compress),
+                               ('primary.xml.xz', lzma.compress), ('primary.xml', bytes)]:
+            compressed = compress(DATA)
+            url = self.write_source(name, compressed)
+            downloader, result = await self.download(
+                url,
+                expected_digests={'sha256': hashlib.sha256(compressed).hexdigest()},
+                expected_uncompressed_size=len(DATA),
+            )
+            with open(result.path, 'rb') as f:
+                self.assertEqual(f.read(), DATA)
+            self.assertEqual(result.artifact_attributes['sha256'], hashlib.sha256(DATA).hexdigest())
+            self.assertEqual(downloader.compressed_attributes['size'], len(compressed))
+
+    async def test_concatenated_streams(self):
+        url = self.write_source('primary.xml.gz', gzip.compress(DATA) + gzip.compress(DATA))
+        downloader, result = await self.download(url)
+        self.assertEqual(result.artifact_attributes['size'], 2 * len(DATA))
+
+    async def test_decompression_is_chunked_and_capped(self):
+        bomb = b'\0' * (10 * 1024 * 1024)
+        for name, compress in [('bomb.gz', gzip.compress), ('bomb.bz2', bz2.compress),
+                               ('bomb.xz', lzma.compress)]:
+            url = self.write_source(name, compress(bomb))
+            downloader_class = decompressing_downloader_class(FileDownloader)
+            chunks = []
+            with asynctest.patch.object(downloader_class, 'DECOMPRESS_CHUNK_SIZE', 4096):
+                downloader = downloader_class(url)
+                handle = downloader._handle_uncompressed_data
+
+                async def record(data):
+                    chunks.append(len(data))
+                    await handle(data)
+
+                downloader._handle_uncompressed_data = record
+                result = await downloader.run()
+            self.assertEqual(result.artifact_attributes['size'], len(bomb))
+            self.assertLessEqual(max(chunks), 4096)
+
+            with self.assertRaises(SizeValidationError):
+                await self.download(url, max_uncompressed_size=1024 * 1024)
+
+    async def test_uncompressed_digest_validation(self):
+        url = self.write_source('primary.xml.xz', lzma.compress(DATA))
+        with self.assertRaises(DigestValidationError):
+            await self.download(url, expected_uncompressed_digests={'sha256': 'invalid'})
+
+    async def test_truncated_data(self):
+        url = self.write_source('primary.xml.bz2', bz2.compress(DATA)[:-10])
+        with self.assertRaises(EOFError):
+            await self.download(url)
+
+    def test_unsupported_compression(self):
+        with self.assertRaises(ValueError):
+            decompressing_downloader_class(FileDownloader)('file:///foo', compression='zip')
@@ -0,0 +1,30 @@
+import io
+
+import asynctest
+from unittest import mock
+
+from pulpcore.plugin.download import DownloaderFactory, PRIORITY_BULK, PRIORITY_METADATA
+
+
+class TestDownloaderFactory(asynctest.TestCase):
+
+    def setUp(self):
+        remote = mock.Mock(download_concurrency=5, download_rate_limit=None, proxy_url=None,
+                           username=None, password=None)
+        for name in ('ssl_ca_certificate', 'ssl_client_key', 'ssl_client_certificate'):
+            getattr(remote, name).name = ''
+        self.factory = DownloaderFactory(remote)
+
+    async def tearDown(self):
+        await self.factory._session.close()
+
+    def test_limit_defaults_to_download_concurrency(self):
+        self.assertEqual(self.factory.download_limit, 5)
+        self.assertEqual(self.factory._semaphore.max_value, 5)
+
+    def test_priority_defaults_to_bulk(self):
+        downloader = self.factory.build('http://example.com/a', custom_file_object=io.BytesIO())
+        self.assertEqual(downloader.semaphore.priority, PRIORITY_BULK)
+        downloader = self.factory.build('http://example.com/b', priority=PRIORITY_METADATA,
+                                        custom_file_object=io.BytesIO())
+        self.assertEqual(downloader.semaphore.priority, PRIORITY_METADATA)
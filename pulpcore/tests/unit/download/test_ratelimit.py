@@ -0,0 +1,37 @@
+import asynctest
+
+from pulpcore.plugin.download import TokenBucket
+
+
+class TestTokenBucket(asynctest.ClockedTestCase):
+
+    async def consume(self, bucket, amounts):
+        for amount in amounts:
+            await bucket.consume(amount)
+
+    async def test_burst_up_to_capacity(self):
+        bucket = TokenBucket(rate=100)
+        task = self.loop.create_task(self.consume(bucket, [50, 50]))
+        await self.advance(0.01)
+        self.assertTrue(task.done())
+
+    async def test_rate_is_enforced(self):
+        bucket = TokenBucket(rate=100)
+        task = self.loop.create_task(self.consume(bucket, [100] * 4))
+        await self.advance(2.5)
+        self.assertFalse(task.done())
+        await self.advance(0.6)
+        self.assertTrue(task.done())
+
+    async def test_consumers_share_the_rate(self):
+        bucket = TokenBucket(rate=100)
+        first = self.loop.create_task(self.consume(bucket, [100] * 3))
+        second = self.loop.create_task(self.consume(bucket, [100] * 3))
+        await self.advance(4.5)
+        self.assertFalse(first.done() and second.done())
+        await self.advance(0.6)
+        self.assertTrue(first.done() and second.done())
+
+    def test_invalid_rate(self):
+        with self.assertRaises(ValueError):
+            TokenBucket(rate=0)
@@ -0,0 +1,103 @@
+import asyncio
+from email.utils import formatdate
+import time
+from unittest import mock
+
+import aiohttp
+import asynctest
+
+from pulpcore.plugin.download import CircuitBreaker, HttpDownloader
+from pulpcore.plugin.download.retry import MAX_RETRY_DELAY, parse_retry_after
+
+
+class TestParseRetryAfter(asynctest.TestCase):
+
+    def test_seconds(self):
+        self.assertEqual(parse_retry_after('120'), 120)
+
+    def test_http_date(self):
+        delay = parse_retry_after(formatdate(time.time() + 60, usegmt=True))
+        self.assertAlmostEqual(delay, 60, delta=2)
+
+    def test_capped(self):
+        self.assertEqual(parse_retry_after('86400'), MAX_RETRY_DELAY)
+
+    def test_missing_or_malformed(self):
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after('soon'))
+
+
+class TestCircuitBreaker(asynctest.ClockedTestCase):
+
+    async def test_retry_after_pauses_all_waiters(self):
+        breaker = CircuitBreaker('example.com', jitter=0)
+        breaker.record_failure(retry_after=10)
+        waiters = [self.loop.create_task(breaker.wait()) for i in range(3)]
+        await self.advance(9)
+        self.assertFalse(any(waiter.done() for waiter in waiters))
+        await self.advance(2)
+        self.assertTrue(all(waiter.done() for waiter in waiters))
+
+    async def test_opens_after_consecutive_failures(self):
+        breaker = CircuitBreaker('example.com', failure_threshold=3)
+        with mock.patch('pulpcore.plugin.download.retry.random.uniform', lambda a, b: b):
+            breaker.record_failure()
+            breaker.record_failure()
+            self.assertFalse(breaker.is_open)
+            breaker.record_failure()
+            self.assertTrue(breaker.is_open)
+
+    async def test_success_resets_failures(self):
+        breaker = CircuitBreaker('example.com', failure_threshold=2)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        self.assertFalse(breaker.is_open)
+
+
+class TestHttpDownloaderRetry(asynctest.ClockedTestCase):
+
+    def make_downloader(self, responses, **kwargs):
+        downloader = HttpDownloader('http://example.com/repodata', session=mock.Mock(),
+                                    custom_file_object=mock.Mock(), **kwargs)
+        downloader._request = asynctest.CoroutineMock(side_effect=responses)
+        return downloader
+
+    @staticmethod
+    def error(code, retry_after=None):
+        headers = {'Retry-After': retry_after} if retry_after else {}
+        return aiohttp.ClientResponseError(mock.Mock(), (), code=code, headers=headers)
+
+    async def test_honors_retry_after(self):
+        downloader = self.make_downloader([self.error(429, '30'), 'result'])
+        task = self.loop.create_task(downloader._run())
+        await self.advance(29)
+        self.assertFalse(task.done())
+        await self.advance(3)
+        self.assertEqual(task.result(), 'result')
+
+    async def test_gives_up_on_fatal_errors(self):
+        downloader = self.make_downloader([self.error(404)])
+        with self.assertRaises(aiohttp.ClientResponseError):
+            await downloader._run()
+        self.assertEqual(downloader._request.call_count, 1)
+
+    async def test_max_tries(self):
+        downloader = self.make_downloader([self.error(503)] * 3, max_tries=3)
+        task = self.loop.create_task(downloader._run())
+        await self.advance(10)
+        self.assertIsInstance(task.exception(), aiohttp.ClientResponseError)
+        self.assertEqual(downloader._request.call_count, 3)
+
+    async def test_circuit_breaker_is_shared(self):
+        breaker = CircuitBreaker('example.com', jitter=0)
+        first = self.make_downloader([self.error(503, '20'), 'first'], circuit_breaker=breaker)
+        second = self.make_downloader(['second'], circuit_breaker=breaker)
+        first_task = self.loop.create_task(first._run())
+        await asyncio.sleep(0)
+        second_task = self.loop.create_task(second._run())
+        await self.advance(19)
+        self.assertFalse(second_task.done())
+        await self.advance(2)
+        self.assertEqual(first_task.result(), 'first')
+        self.assertEqual(second_task.result(), 'second')
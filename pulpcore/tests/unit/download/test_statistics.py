@@ -0,0 +1,104 @@
+import json
+import os
+import tempfile
+from types import SimpleNamespace
+from unittest import mock
+
+import asynctest
+
+from pulpcore.plugin.download import (
+    DownloadResult,
+    DownloadStatistics,
+    DownloadTiming,
+    FileDownloader,
+)
+
+
+class TestDownloadTiming(asynctest.TestCase):
+
+    def setUp(self):
+        self.working_dir = tempfile.TemporaryDirectory()
+        self.old_cwd = os.getcwd()
+        os.chdir(self.working_dir.name)
+        self.source = os.path.join(self.working_dir.name, 'source')
+        with open(self.source, 'wb') as f:
+            f.write(b'x' * 1000)
+
+    def tearDown(self):
+        os.chdir(self.old_cwd)
+        self.working_dir.cleanup()
+
+    async def test_result_has_timing(self):
+        result = await FileDownloader('file://' + self.source).run()
+        self.assertIsInstance(result.timing, DownloadTiming)
+        self.assertEqual(result.timing.size, 1000)
+        self.assertEqual(result.timing.retries, 0)
+        self.assertGreaterEqual(result.timing.semaphore_wait, 0)
+        self.assertGreaterEqual(result.timing.total, 0)
+        self.assertEqual(result.timing.transfer, result.timing.total)
+
+    def test_result_timing_defaults_to_none(self):
+        result = DownloadResult(url='file:///a', artifact_attributes={}, path='a', headers=None)
+        self.assertIsNone(result.timing)
+
+
+class TestDownloadStatistics(asynctest.TestCase):
+
+    @staticmethod
+    def result(url, size, transfer, retries=0):
+        timing = DownloadTiming()
+        timing.size = size
+        timing.transfer = transfer
+        timing.total = transfer
+        timing.retries = retries
+        return DownloadResult(url=url, artifact_attributes={}, path=None, headers=None,
+                              timing=timing)
+
+    def test_summary_per_remote_and_host(self):
+        remote_a = SimpleNamespace(name='a')
+        remote_b = SimpleNamespace(name='b')
+        statistics = DownloadStatistics()
+        self.assertFalse(statistics)
+        statistics.add(remote_a, self.result('http://one.example.com/1', 100, 1.0))
+        statistics.add(remote_a, self.result('http://one.example.com/2', 300, 3.0, retries=2))
+        statistics.add(remote_a, self.result('http://two.example.com/1', 50, 0.5))
+        statistics.add(remote_b, self.result('http://one.example.com/1', 10, 1.0))
+        statistics.add(remote_b, SimpleNamespace(url='http://one.example.com/3', timing=None))
+
+        summary = statistics.summary()
+        self.assertEqual(set(summary), {'a', 'b'})
+        one = summary['a']['one.example.com']
+        self.assertEqual(one['downloads'], 2)
+        self.assertEqual(one['bytes'], 400)
+        self.assertEqual(one['retries'], 2)
+        self.assertEqual(one['transfer'], 2.0)
+        self.assertEqual(one['throughput'], 100.0)
+        self.assertIsNone(one['connect'])
+        self.assertEqual(summary['a']['two.example.com']['downloads'], 1)
+        self.assertEqual(summary['b']['one.example.com']['downloads'], 1)
+
+    @mock.patch('pulpcore.plugin.download.statistics.ProgressReport')
+    def test_save_with_the_task(self, progress_report):
+        statistics = DownloadStatistics()
+        statistics.add(SimpleNamespace(name='a'), self.result('http://one.example.com/1', 100, 2.0))
+        statistics.add(SimpleNamespace(name='b'), self.result('http://two.example.com/1', 10, 1.0))
+        statistics.save()
+
+        progress_report.assert_called_once()
+        kwargs = progress_report.call_args[1]
+        self.assertEqual(kwargs['state'], 'completed')
+        self.assertEqual((kwargs['total'], kwargs['done']), (2, 2))
+        self.assertEqual(json.loads(kwargs['suffix']), statistics.summary())
+        progress_report.return_value.save.assert_called_once_with()
+
+    def test_log_per_remote_and_host(self):
+        statistics = DownloadStatistics()
+        statistics.add(SimpleNamespace(name='a'), self.result('http://one.example.com/1', 100, 2.0))
+        logger = mock.Mock()
+        statistics.log(logger)
+        logger.info.assert_called_once()
+        message, values = logger.info.call_args[0]
+        self.assertEqual(values['remote'], 'a')
+        self.assertEqual(values['host'], 'one.example.com')
+        self.assertIn('downloads=1, bytes=100, retries=0', values['values'])
+        self.assertIn('throughput=50.000', values['values'])
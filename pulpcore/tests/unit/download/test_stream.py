@@ -0,0 +1,68 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+
+import asynctest
+
+from pulpcore.exceptions import SizeValidationError
+from pulpcore.plugin.download import AdaptiveSemaphore, FileDownloader
+
+
+DATA = os.urandom(3 * 1048576 + 17)
+
+
+class TestDownloadStream(asynctest.TestCase):
+
+    def setUp(self):
+        self.working_dir = tempfile.TemporaryDirectory()
+        self.old_cwd = os.getcwd()
+        os.chdir(self.working_dir.name)
+        self.source = os.path.join(self.working_dir.name, 'source')
+        with open(self.source, 'wb') as f:
+            f.write(DATA)
+
+    def tearDown(self):
+        os.chdir(self.old_cwd)
+        self.working_dir.cleanup()
+
+    async def test_chunks_and_result(self):
+        stream = FileDownloader('file://' + self.source).stream(maxsize=1)
+        chunks = [chunk async for chunk in stream]
+        self.assertEqual(len(chunks), 4)
+        self.assertEqual(b''.join(chunks), DATA)
+        self.assertEqual(stream.result.artifact_attributes['sha256'],
+                         hashlib.sha256(DATA).hexdigest())
+
+    async def test_validation_at_the_end(self):
+        downloader = FileDownloader('file://' + self.source, expected_size=1)
+        chunks = []
+        with self.assertRaises(SizeValidationError):
+            async for chunk in downloader.stream():
+                chunks.append(chunk)
+        self.assertEqual(b''.join(chunks), DATA)
+
+    async def test_early_exit_cancels_download(self):
+        async with FileDownloader('file://' + self.source).stream(maxsize=1) as stream:
+            async for chunk in stream:
+                break
+        self.assertTrue(stream._task.cancelled())
+        self.assertIsNone(stream.result)
+
+    async def test_waiting_for_the_consumer_releases_the_semaphore(self):
+        semaphore = AdaptiveSemaphore(value=1, max_value=1)
+
+        async def consume():
+            outer = FileDownloader('file://' + self.source, semaphore=semaphore)
+            chunks = []
+            async for chunk in outer.stream(maxsize=1):
+                if not chunks:
+                    # the consumer waits for another download while the first one is blocked
+                    inner = FileDownloader('file://' + self.source, semaphore=semaphore)
+                    inner_chunks = [inner_chunk async for inner_chunk in inner.stream(maxsize=1)]
+                    self.assertEqual(b''.join(inner_chunks), DATA)
+                chunks.append(chunk)
+            return b''.join(chunks)
+
+        self.assertEqual(await asyncio.wait_for(consume(), timeout=10), DATA)
+        self.assertEqual(semaphore.in_use, 0)
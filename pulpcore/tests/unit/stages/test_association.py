@@ -0,0 +1,241 @@
+import asyncio
+import uuid
+
+import asynctest
+from django.db import models
+import mock
+
+from pulpcore.plugin.models import Content, RepositoryVersion
+from pulpcore.exceptions import ResourceImmutableError
+from pulpcore.plugin.stages import (
+    ContentAssociation,
+    ContentDeltaAssociation,
+    ContentUnassociation,
+    DeclarativeContent,
+    RemoveDuplicates,
+)
+from pulpcore.plugin.stages.association_stages import PkSet, remove_content
+
+
+class DuplicateTestContent(Content):
+    name = models.TextField()
+    arch = models.TextField()
+    version = models.TextField()
+
+    class Meta:
+        app_label = 'core'
+        unique_together = ('name', 'arch', 'version')
+
+
+def queryset_of(pks):
+    queryset = mock.Mock()
+    queryset.order_by.return_value.values_list.return_value.iterator.return_value = iter(pks)
+    return queryset
+
+
+class TestPkSet(asynctest.TestCase):
+
+    def test_lookup_and_discard(self):
+        pks = [uuid.uuid4() for _ in range(100)]
+        pk_set = PkSet.from_queryset(queryset_of(sorted(pks)))
+        self.assertEqual(len(pk_set), 100)
+        for pk in pks:
+            self.assertIn(pk, pk_set)
+        self.assertNotIn(uuid.uuid4(), pk_set)
+
+        self.assertTrue(pk_set.discard(pks[0]))
+        self.assertFalse(pk_set.discard(pks[0]))
+        self.assertFalse(pk_set.discard(uuid.uuid4()))
+        self.assertNotIn(pks[0], pk_set)
+        self.assertEqual(len(pk_set), 99)
+        self.assertEqual(sorted(pk_set), sorted(pks[1:]))
+
+    def test_unsorted_input(self):
+        pks = [uuid.uuid4() for _ in range(50)]
+        pk_set = PkSet.from_queryset(queryset_of(pks))
+        for pk in pks:
+            self.assertIn(pk, pk_set)
+        self.assertEqual(list(pk_set), sorted(pks))
+
+    def test_keys_are_not_copied(self):
+        data = bytearray(b''.join(pk.bytes for pk in sorted(uuid.uuid4() for _ in range(5))))
+        pk_set = PkSet(data)
+        self.assertIs(pk_set._data, data)
+
+        PkSet._sort(data)
+        self.assertIs(pk_set._data, data)
+
+    def test_empty(self):
+        pk_set = PkSet.from_queryset(queryset_of([]))
+        self.assertEqual(len(pk_set), 0)
+        self.assertNotIn(uuid.uuid4(), pk_set)
+        self.assertEqual(list(pk_set), [])
+
+
+@mock.patch('pulpcore.plugin.stages.association_stages.ProgressBar')
+@mock.patch('pulpcore.plugin.stages.association_stages.Content')
+class TestContentAssociation(asynctest.TestCase):
+
+    async def test_add_and_unassociate(self, content_model, progress_bar):
+        progress_bar.return_value.__enter__.return_value.done = 0
+        present = [uuid.uuid4() for _ in range(5)]
+        new_version = mock.Mock(content=queryset_of(sorted(present)))
+        in_q = asyncio.Queue()
+        out_q = asyncio.Queue()
+        new = mock.Mock(pk=uuid.uuid4())
+        for content in [mock.Mock(pk=present[0]), mock.Mock(pk=present[1]), new]:
+            in_q.put_nowait(DeclarativeContent(content=content))
+        # removed units are neither added nor kept
+        in_q.put_nowait(DeclarativeContent(content=mock.Mock(pk=present[2]), removed=True))
+        in_q.put_nowait(DeclarativeContent(content=mock.Mock(pk=uuid.uuid4()), removed=True))
+        in_q.put_nowait(None)
+
+        stage = ContentAssociation(new_version)
+        stage.UNASSOCIATE_CHUNK_SIZE = 2
+        stage._connect(in_q, out_q)
+        await stage()
+
+        new_version.add_content.assert_called_once()
+        unassociated = [call[1]['pk__in'] for call in content_model.objects.filter.call_args_list]
+        self.assertEqual(unassociated[0], {new.pk})
+        self.assertEqual([len(chunk) for chunk in unassociated[1:]], [2, 1])
+        self.assertCountEqual(sum(unassociated[1:], []), present[2:])
+        self.assertEqual(out_q.qsize(), 3)  # two querysets and None
+        self.assertEqual(progress_bar.return_value.__enter__.return_value.done, 1)
+
+
+@mock.patch('pulpcore.plugin.stages.association_stages.ProgressBar')
+@mock.patch('pulpcore.plugin.stages.association_stages.remove_content')
+@mock.patch('pulpcore.plugin.stages.association_stages.Content')
+class TestContentDeltaAssociation(asynctest.TestCase):
+
+    async def test_applies_declared_changes_only(self, content_model, remove_content, _):
+        new_version = mock.Mock()
+        added = mock.Mock(pk=uuid.uuid4())
+        removed = mock.Mock(pk=uuid.uuid4())
+        unknown = mock.Mock(pk=uuid.uuid4())
+        unknown._state.adding = True
+        removed._state.adding = False
+        in_q = asyncio.Queue()
+        out_q = asyncio.Queue()
+        in_q.put_nowait(DeclarativeContent(content=added))
+        in_q.put_nowait(DeclarativeContent(content=removed, removed=True))
+        in_q.put_nowait(DeclarativeContent(content=unknown, removed=True))
+        in_q.put_nowait(None)
+
+        stage = ContentDeltaAssociation(new_version)
+        stage._connect(in_q, out_q)
+        await stage()
+
+        self.assertEqual([call[1] for call in content_model.objects.filter.call_args_list],
+                         [{'pk__in': {added.pk}}, {'pk__in': {removed.pk}}])
+        new_version.add_content.assert_called_once_with(content_model.objects.filter.return_value)
+        remove_content.assert_called_once_with(new_version,
+                                               content_model.objects.filter.return_value)
+        self.assertEqual(out_q.qsize(), 4)
+
+    def test_removed_without_artifacts(self, *_):
+        with self.assertRaises(ValueError):
+            DeclarativeContent(content=mock.Mock(), d_artifacts=[mock.Mock()], removed=True)
+
+
+@mock.patch('pulpcore.plugin.stages.association_stages.ProgressBar')
+@mock.patch('pulpcore.plugin.stages.association_stages.RepositoryContent')
+class TestContentUnassociation(asynctest.TestCase):
+
+    async def test_counts_updated_rows(self, repository_content, progress_bar):
+        progress_bar.return_value.__enter__.return_value.done = 0
+        repository_content.objects.filter.return_value.update.side_effect = [3, 2]
+        new_version = mock.Mock(complete=False)
+        querysets = [mock.Mock(), mock.Mock()]
+        in_q = asyncio.Queue()
+        out_q = asyncio.Queue()
+        for queryset in querysets + [None]:
+            in_q.put_nowait(queryset)
+
+        stage = ContentUnassociation(new_version)
+        stage._connect(in_q, out_q)
+        await stage()
+
+        self.assertEqual(progress_bar.return_value.__enter__.return_value.done, 5)
+        repository_content.objects.filter.assert_called_with(
+            repository=new_version.repository, content_id__in=querysets[1], version_removed=None)
+        for queryset in querysets:
+            queryset.count.assert_not_called()
+        self.assertEqual(out_q.qsize(), 3)
+
+    def test_same_update_as_core(self, repository_content, _):
+        version = mock.Mock(complete=False)
+        content = mock.Mock()
+        with mock.patch('pulpcore.app.models.repository.RepositoryContent') as core_content:
+            RepositoryVersion.remove_content(version, content)
+        remove_content(version, content)
+        self.assertEqual(len(core_content.mock_calls), 2)
+        self.assertEqual(repository_content.mock_calls, core_content.mock_calls)
+
+    def test_complete_version_is_immutable(self, repository_content, _):
+        with self.assertRaises(ResourceImmutableError):
+            remove_content(mock.Mock(complete=True), mock.Mock())
+        repository_content.objects.filter.assert_not_called()
+
+
+class TestRemoveDuplicates(asynctest.TestCase):
+
+    async def run_stage(self, contents):
+        in_q = asyncio.Queue()
+        out_q = asyncio.Queue()
+        for content in contents + [None]:
+            in_q.put_nowait(DeclarativeContent(content=content) if content else None)
+        self.new_version = mock.Mock()
+        stage = RemoveDuplicates(self.new_version, DuplicateTestContent, ['name', 'arch'])
+        stage._connect(in_q, out_q)
+        await stage()
+        self.assertEqual(out_q.qsize(), len(contents) + 1)
+
+    def version_content(self, objects, duplicates):
+        version_content = objects.filter.return_value.only.return_value
+        version_content.model = DuplicateTestContent
+        version_content.filter.return_value = duplicates
+        return version_content
+
+    async def test_one_query_for_the_batch(self):
+        duplicate = DuplicateTestContent(pk=uuid.uuid4(), name='a', arch='x86_64', version='1')
+        contents = [
+            DuplicateTestContent(pk=uuid.uuid4(), name='a', arch='x86_64', version='2'),
+            DuplicateTestContent(pk=uuid.uuid4(), name='b', arch='noarch', version='1'),
+            mock.Mock(),
+        ]
+        with mock.patch.object(DuplicateTestContent, 'objects') as objects:
+            # the units of the batch are already in the version, too
+            version_content = self.version_content(objects, [duplicate] + contents[:2])
+            await self.run_stage(contents)
+
+        objects.filter.return_value.only.assert_called_once_with('pk', 'name', 'arch')
+        version_content.filter.assert_called_once()
+        (lookup, raw_sql), = version_content.filter.call_args[0][0].children
+        self.assertEqual(lookup, 'pk__in')
+        self.assertCountEqual(zip(raw_sql.params[::2], raw_sql.params[1::2]),
+                              [('a', 'x86_64'), ('b', 'noarch')])
+        objects.filter.assert_called_with(pk__in=[duplicate.pk])
+        self.new_version.remove_content.assert_called_once_with(objects.filter.return_value)
+
+    async def test_units_of_the_batch_with_the_same_values(self):
+        contents = [
+            DuplicateTestContent(pk=uuid.uuid4(), name='a', arch='x86_64', version='2'),
+            DuplicateTestContent(pk=uuid.uuid4(), name='a', arch='x86_64', version='3'),
+        ]
+        with mock.patch.object(DuplicateTestContent, 'objects') as objects:
+            self.version_content(objects, contents)
+            await self.run_stage(contents)
+
+        # like for one unit at a time, each unit removes the other one
+        objects.filter.assert_called_with(pk__in=[content.pk for content in contents])
+        self.new_version.remove_content.assert_called_once_with(objects.filter.return_value)
+
+    async def test_no_duplicates(self):
+        with mock.patch.object(DuplicateTestContent, 'objects') as objects:
+            self.version_content(objects, [])
+            await self.run_stage([
+                DuplicateTestContent(pk=uuid.uuid4(), name='a', arch='x86_64', version='1'),
+            ])
+        self.new_version.remove_content.assert_not_called()
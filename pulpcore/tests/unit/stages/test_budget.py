@@ -0,0 +1,100 @@
+import asyncio
+
+import asynctest
+import mock
+
+from pulpcore.plugin.stages import (
+    BudgetedQueue,
+    create_pipeline,
+    DeclarativeArtifact,
+    DeclarativeContent,
+    EndStage,
+    estimate_size,
+    MemoryBudget,
+    Stage,
+)
+from pulpcore.plugin.stages.budget import ARTIFACT_SIZE, CONTENT_SIZE
+
+
+def d_content(artifacts=0):
+    d_artifacts = [
+        DeclarativeArtifact(artifact=mock.Mock(), url='http://a/b', relative_path='b',
+                            remote=mock.Mock())
+        for i in range(artifacts)
+    ]
+    return DeclarativeContent(content=mock.Mock(), d_artifacts=d_artifacts)
+
+
+class TestEstimateSize(asynctest.TestCase):
+
+    def test_grows_with_artifacts_and_extra_data(self):
+        small = estimate_size(d_content())
+        large = estimate_size(d_content(artifacts=10))
+        self.assertGreaterEqual(small, CONTENT_SIZE)
+        self.assertGreaterEqual(large - small, 10 * ARTIFACT_SIZE)
+
+        with_data = d_content()
+        with_data.extra_data['changelog'] = ['x' * 1000] * 10
+        self.assertGreater(estimate_size(with_data), small + 10000)
+        self.assertEqual(estimate_size(None), 0)
+
+
+class TestBudgetedQueue(asynctest.TestCase):
+
+    async def test_put_waits_for_room(self):
+        item_size = estimate_size(d_content())
+        queue = BudgetedQueue(max_bytes=item_size * 2)
+        await queue.put(d_content())
+        await queue.put(d_content())
+        put = asyncio.ensure_future(queue.put(d_content()))
+        await asyncio.sleep(0)
+        self.assertFalse(put.done())
+
+        await queue.get()
+        await asyncio.sleep(0)
+        self.assertTrue(put.done())
+        self.assertEqual(queue.qsize(), 2)
+
+    async def test_large_item_admitted_into_empty_queue(self):
+        queue = BudgetedQueue(max_bytes=1)
+        await queue.put(d_content(artifacts=100))
+        self.assertEqual(queue.qsize(), 1)
+
+    async def test_pipeline_budget_shared(self):
+        item_size = estimate_size(d_content())
+        budget = MemoryBudget(item_size * 2)
+        queues = [BudgetedQueue(pipeline_budget=budget) for i in range(2)]
+        await queues[0].put(d_content())
+        await queues[0].put(d_content())
+        await queues[1].put(d_content())  # empty queues are always admitted
+        self.assertEqual(budget.used, item_size * 3)
+        put = asyncio.ensure_future(queues[1].put(d_content()))
+        await asyncio.sleep(0)
+        self.assertFalse(put.done())
+
+        await queues[0].get()
+        await queues[0].get()
+        await asyncio.sleep(0)
+        self.assertTrue(put.done())
+
+
+class TestBudgetedPipeline(asynctest.TestCase):
+
+    class FirstStage(Stage):
+        async def run(self):
+            for i in range(50):
+                await self.put(d_content(artifacts=i % 5))
+
+    class PassStage(Stage):
+        async def run(self):
+            async for item in self.items():
+                await self.put(item)
+
+    async def test_runs_to_completion(self):
+        end = EndStage()
+        await asyncio.wait_for(create_pipeline(
+            [self.FirstStage(), self.PassStage(), self.PassStage(), end],
+            max_link_bytes=CONTENT_SIZE * 3, max_pipeline_bytes=CONTENT_SIZE * 4,
+        ), timeout=5)
+        self.assertIsInstance(end._in_q, BudgetedQueue)
+        self.assertEqual(end._in_q.qsize(), 0)
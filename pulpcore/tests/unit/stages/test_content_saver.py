@@ -0,0 +1,126 @@
+import asyncio
+
+import asynctest
+from django.db import IntegrityError, models
+import mock
+
+from pulpcore.plugin.models import Content
+from pulpcore.plugin.stages import ContentSaver, DeclarativeContent
+from pulpcore.plugin.stages.content_stages import bulk_insert, reset_unsaved
+
+
+class SaverTestContent(Content):
+    TYPE = 'saver-test'
+    name = models.TextField()
+
+    class Meta:
+        app_label = 'core'
+        unique_together = ('name',)
+
+
+@mock.patch('pulpcore.plugin.stages.content_stages.ContentArtifact')
+@mock.patch('pulpcore.plugin.stages.content_stages.transaction')
+class TestContentSaver(asynctest.TestCase):
+
+    def setUp(self):
+        self.in_q = asyncio.Queue()
+        self.out_q = asyncio.Queue()
+
+    async def run_stage(self, names):
+        d_contents = [DeclarativeContent(content=SaverTestContent(name=name)) for name in names]
+        for d_content in d_contents + [None]:
+            self.in_q.put_nowait(d_content)
+        stage = ContentSaver()
+        stage._connect(self.in_q, self.out_q)
+        await stage()
+        return d_contents
+
+    @mock.patch('pulpcore.plugin.stages.content_stages.bulk_insert')
+    async def test_bulk_insert_once_per_natural_key(self, bulk_insert_mock, transaction, _):
+        d_contents = await self.run_stage(['a', 'b', 'a'])
+
+        bulk_insert_mock.assert_called_once_with(SaverTestContent,
+                                                 [d_contents[0].content, d_contents[1].content])
+        self.assertIs(d_contents[2].content, d_contents[0].content)
+        self.assertEqual(self.out_q.qsize(), 4)
+
+    @mock.patch('pulpcore.plugin.stages.content_stages.query_by_natural_key')
+    @mock.patch('pulpcore.plugin.stages.content_stages.bulk_insert')
+    async def test_conflicts_resolved_by_natural_key(self, bulk_insert_mock, query, transaction,
+                                                     _):
+        existing = SaverTestContent(name='b')
+        existing._state.adding = False
+        query.return_value = [existing]
+        bulk_insert_mock.side_effect = [IntegrityError(), None]
+
+        d_contents = await self.run_stage(['a', 'b', 'b'])
+
+        query.assert_called_once_with(SaverTestContent, [('a',), ('b',)])
+        self.assertEqual(bulk_insert_mock.call_count, 2)
+        bulk_insert_mock.assert_called_with(SaverTestContent, [d_contents[0].content])
+        self.assertIs(d_contents[1].content, existing)
+        self.assertIs(d_contents[2].content, existing)
+
+    def test_bulk_insert_sets_type_and_parent_link(self, transaction, _):
+        contents = [SaverTestContent(name='a'), SaverTestContent(name='b')]
+        with mock.patch('django.db.models.query.QuerySet.bulk_create', autospec=True) as bulk, \
+                mock.patch('django.db.models.query.QuerySet._insert', autospec=True) as insert, \
+                mock.patch.object(SaverTestContent, 'save_base', autospec=True) as save_base:
+            bulk_insert(SaverTestContent, contents)
+
+        # the parent table first, in bulk
+        queryset, rows = bulk.call_args[0]
+        self.assertIs(queryset.model, Content)
+        self.assertEqual([type(row) for row in rows], [Content, Content])
+        self.assertEqual(rows[0]._type, 'core.saver-test')
+        self.assertEqual(rows[0]._id, contents[0]._id)
+        self.assertEqual(contents[0]._type, 'core.saver-test')
+        self.assertEqual(contents[0].content_ptr_id, contents[0]._id)
+        # then the table of the content type, in bulk too
+        queryset, rows = insert.call_args[0]
+        self.assertIs(queryset.model, SaverTestContent)
+        self.assertEqual(rows, contents)
+        self.assertEqual(insert.call_args[1]['fields'],
+                         SaverTestContent._meta.local_concrete_fields)
+        insert.assert_called_once()
+        save_base.assert_not_called()
+        self.assertFalse(contents[0]._state.adding)
+
+    def test_bulk_insert_in_batches(self, transaction, _):
+        contents = [SaverTestContent(name=name) for name in 'abc']
+        with mock.patch('django.db.models.query.QuerySet.bulk_create', autospec=True), \
+                mock.patch('django.db.models.query.QuerySet._insert', autospec=True) as insert:
+            bulk_insert(SaverTestContent, contents, batch_size=2)
+
+        self.assertEqual([call[0][1] for call in insert.call_args_list],
+                         [contents[:2], contents[2:]])
+
+    def test_failed_bulk_insert_leaves_units_unsaved(self, transaction, _):
+        content = SaverTestContent(name='a')
+        with mock.patch('django.db.models.query.QuerySet.bulk_create', autospec=True), \
+                mock.patch('django.db.models.query.QuerySet._insert', autospec=True) as insert:
+            insert.side_effect = IntegrityError()
+            with self.assertRaises(IntegrityError):
+                bulk_insert(SaverTestContent, [content])
+
+        self.assertTrue(content._state.adding)
+        self.assertEqual(content.content_ptr_id, content._id)
+        reset_unsaved(SaverTestContent, [content])
+        self.assertIsNone(content.content_ptr_id)
+        self.assertTrue(content._state.adding)
+
+    @mock.patch('pulpcore.plugin.stages.content_stages.reset_unsaved')
+    @mock.patch('pulpcore.plugin.stages.content_stages.query_by_natural_key')
+    @mock.patch('pulpcore.plugin.stages.content_stages.bulk_insert')
+    async def test_conflicting_units_are_reset(self, bulk_insert_mock, query, reset, transaction,
+                                               _):
+        query.return_value = []
+        bulk_insert_mock.side_effect = [IntegrityError(), None]
+
+        d_contents = await self.run_stage(['a'])
+
+        reset.assert_called_once_with(SaverTestContent, [d_contents[0].content])
+
+    def test_bulk_insert_needs_one_parent_table(self, transaction, _):
+        with self.assertRaises(ValueError):
+            bulk_insert(Content, [Content()])
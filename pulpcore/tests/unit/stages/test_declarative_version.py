@@ -0,0 +1,299 @@
+import asyncio
+from contextlib import contextmanager
+
+import asynctest
+from django.core.exceptions import FieldDoesNotExist
+import mock
+
+from pulpcore.plugin.stages import (
+    ContentAssociation,
+    ContentUnassociation,
+    DeclarativeVersion,
+    EndStage,
+    FanOut,
+    MultiDeclarativeVersion,
+    RepositoryTarget,
+    Stage,
+)
+from pulpcore.plugin.stages import create_pipeline as run_pipeline
+
+
+class FingerprintedStage(Stage):
+
+    def __init__(self, fingerprint):
+        super().__init__()
+        self.fingerprint = fingerprint
+
+    async def upstream_fingerprint(self):
+        return self.fingerprint
+
+    async def run(self):
+        await self.put(None)
+
+
+@mock.patch('pulpcore.plugin.stages.declarative_version.create_pipeline',
+            mock.Mock(side_effect=lambda stages: asynctest.CoroutineMock()()))
+@mock.patch('pulpcore.plugin.stages.declarative_version.WorkingDirectory', mock.MagicMock())
+@mock.patch('pulpcore.plugin.stages.declarative_version.RepositoryVersion')
+class TestUpstreamFingerprint(asynctest.TestCase):
+
+    forbid_get_event_loop = False
+
+    def setUp(self):
+        self.remote = mock.Mock(pk=1, url='http://a/', policy='on_demand')
+        # a Mock has a class of its own
+        self.remotes = type(self.remote).objects = mock.Mock()
+        self.repository = mock.Mock()
+
+    def test_unchanged_upstream_is_skipped(self, repository_version):
+        self.remotes.filter.return_value.exists.return_value = True
+        latest = repository_version.latest.return_value
+        declarative_version = DeclarativeVersion(FingerprintedStage((self.remote, 'r1')),
+                                                 self.repository)
+        declarative_version.create()
+
+        repository_version.create.assert_not_called()
+        self.remotes.filter.assert_called_once_with(
+            pk=1,
+            last_sync_fingerprint=declarative_version._fingerprint_key((self.remote, 'r1'), latest),
+        )
+
+    def test_changed_upstream_is_synced_and_stored(self, repository_version):
+        self.remotes.filter.return_value.exists.return_value = False
+        new_version = repository_version.create.return_value.__enter__.return_value
+        declarative_version = DeclarativeVersion(FingerprintedStage((self.remote, 'r2')),
+                                                 self.repository)
+        declarative_version.create()
+
+        repository_version.create.assert_called_once_with(self.repository)
+        self.remotes.filter.assert_called_with(pk=1)
+        self.remotes.filter.return_value.update.assert_called_once_with(
+            last_sync_fingerprint=declarative_version._fingerprint_key((self.remote, 'r2'),
+                                                                       new_version),
+        )
+
+    def test_remote_without_field(self, repository_version):
+        self.remote._meta.get_field.side_effect = FieldDoesNotExist()
+        DeclarativeVersion(FingerprintedStage((self.remote, 'r1')), self.repository).create()
+
+        self.remotes.filter.assert_not_called()
+        repository_version.create.assert_called_once_with(self.repository)
+
+    def test_no_fingerprint(self, repository_version):
+        DeclarativeVersion(FingerprintedStage(None), self.repository).create()
+
+        repository_version.create.assert_called_once_with(self.repository)
+
+    def test_delta_applies_declared_changes(self, repository_version):
+        with mock.patch('pulpcore.plugin.stages.declarative_version.create_pipeline') as pipeline:
+            pipeline.side_effect = lambda stages: asynctest.CoroutineMock()()
+            DeclarativeVersion(FingerprintedStage(None), self.repository, delta=True).create()
+
+        stages = pipeline.call_args[0][0]
+        self.assertEqual([type(stage).__name__ for stage in stages[-2:]],
+                         ['ContentDeltaAssociation', 'EndStage'])
+
+    def test_mirror_and_delta_exclusive(self, *_):
+        with self.assertRaises(ValueError):
+            DeclarativeVersion(None, self.repository, mirror=True, delta=True)
+
+    def test_key_depends_on_options(self, *_):
+        version = mock.Mock(pk=2)
+        fingerprint = (self.remote, 'r1')
+        additive = DeclarativeVersion(None, self.repository)
+        mirror = DeclarativeVersion(None, self.repository, mirror=True)
+        delta = DeclarativeVersion(None, self.repository, delta=True)
+        deduplicated = DeclarativeVersion(None, self.repository, remove_duplicates=[
+            {'model': mock.Mock(_meta=mock.Mock(label='file.file')), 'field_names': ['path']},
+        ])
+        keys = {d_version._fingerprint_key(fingerprint, version)
+                for d_version in (additive, mirror, delta, deduplicated)}
+        self.assertEqual(len(keys), 4)
+        self.assertNotEqual(additive._fingerprint_key((self.remote, 'r2'), version),
+                            additive._fingerprint_key(fingerprint, version))
+
+    def test_key_depends_on_remote_url_and_policy(self, *_):
+        version = mock.Mock(pk=2)
+        d_version = DeclarativeVersion(None, self.repository)
+        on_demand = d_version._fingerprint_key((self.remote, 'r1'), version)
+        self.remote.policy = 'immediate'
+        immediate = d_version._fingerprint_key((self.remote, 'r1'), version)
+        self.remote.url = 'http://mirror/'
+        mirrored = d_version._fingerprint_key((self.remote, 'r1'), version)
+
+        self.assertEqual(len({on_demand, immediate, mirrored}), 3)
+
+    def test_policy_switch_is_synced(self, repository_version):
+        # the stored key is the one of the last sync, with the on_demand policy
+        stored = DeclarativeVersion(None, self.repository)._fingerprint_key(
+            (self.remote, 'r1'), repository_version.latest.return_value
+        )
+        self.remotes.filter.side_effect = lambda **kwargs: mock.Mock(**{
+            'exists.return_value': kwargs.get('last_sync_fingerprint') == stored,
+        })
+        self.remote.policy = 'immediate'
+        DeclarativeVersion(FingerprintedStage((self.remote, 'r1')), self.repository).create()
+
+        repository_version.create.assert_called_once_with(self.repository)
+
+
+@mock.patch('pulpcore.plugin.stages.declarative_version.create_pipeline')
+@mock.patch('pulpcore.plugin.stages.declarative_version.transaction', mock.MagicMock())
+@mock.patch('pulpcore.plugin.stages.declarative_version.WorkingDirectory', mock.MagicMock())
+@mock.patch('pulpcore.plugin.stages.declarative_version.RepositoryVersion')
+class TestMultiDeclarativeVersion(asynctest.TestCase):
+
+    forbid_get_event_loop = False
+
+    class FirstStage(Stage):
+        declared = 0
+
+        async def run(self):
+            for i in range(1000):
+                await self.put(mock.Mock(number=i))
+                self.declared += 1
+
+    class FailingStage(Stage):
+        async def run(self):
+            async for item in self.items():
+                raise ValueError(item.number)
+
+    class WaitingStage(Stage):
+        cancelled = False
+
+        async def run(self):
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                self.cancelled = True
+                raise
+
+    def setUp(self):
+        self.new_versions = []
+
+    @contextmanager
+    def version_context(self, repository, error=None, delete_error=None):
+        """
+        Mock `RepositoryVersion.create`, deleting the version on errors.
+        """
+        new_version = mock.Mock(repository=repository, pk=len(self.new_versions) + 1,
+                                **{'complete.side_effect': error})
+
+        def delete():
+            if delete_error:
+                raise delete_error
+            new_version.pk = None
+
+        new_version.delete.side_effect = delete
+        self.new_versions.append(new_version)
+        try:
+            yield new_version
+        except Exception:
+            new_version.delete()
+            raise
+        new_version.complete()
+
+    def test_failing_branch_cancels_the_others_and_deletes_all_versions(
+            self, repository_version, create_pipeline):
+        create_pipeline.side_effect = run_pipeline
+        repository_version.create.side_effect = self.version_context
+        waiting = self.WaitingStage()
+        targets = [
+            mock.Mock(repository=mock.Mock(pk=1), filter=None,
+                      **{'association_stages.return_value': [self.FailingStage(), EndStage()]}),
+            mock.Mock(repository=mock.Mock(pk=2), filter=None,
+                      **{'association_stages.return_value': [waiting, EndStage()]}),
+        ]
+        first_stage = self.FirstStage()
+        d_version = MultiDeclarativeVersion(first_stage, targets)
+        d_version.pipeline_stages = lambda: [first_stage]
+
+        with self.assertRaises(ValueError):
+            d_version.create()
+
+        self.assertLess(first_stage.declared, 1000)
+        self.assertTrue(waiting.cancelled)
+        self.assertEqual(len(self.new_versions), 2)
+        for new_version in self.new_versions:
+            new_version.delete.assert_called_once_with()
+            new_version.complete.assert_not_called()
+
+    def test_failing_completion_deletes_all_versions(self, repository_version, create_pipeline):
+        create_pipeline.side_effect = lambda stages: asynctest.CoroutineMock()()
+        stable, everything = mock.Mock(pk=1), mock.Mock(pk=2)
+        # the versions are completed in reverse order, the first one deletes itself when the
+        # second one fails
+        repository_version.create.side_effect = [
+            self.version_context(stable),
+            self.version_context(everything, error=RuntimeError('counts')),
+        ]
+        d_version = MultiDeclarativeVersion(
+            Stage(), [RepositoryTarget(stable), RepositoryTarget(everything)]
+        )
+
+        with self.assertRaisesRegex(RuntimeError, 'counts'):
+            d_version.create()
+
+        deleted, failed = self.new_versions
+        deleted.delete.assert_called_once_with()
+        deleted.refresh_from_db.assert_not_called()
+        # the failed version is deleted as the incomplete version it is in the db
+        self.assertEqual(failed.mock_calls[-2:], [mock.call.refresh_from_db(),
+                                                  mock.call.delete()])
+
+    def test_failing_deletion_keeps_the_completion_error(self, repository_version,
+                                                         create_pipeline):
+        create_pipeline.side_effect = lambda stages: asynctest.CoroutineMock()()
+        stable, everything = mock.Mock(pk=1), mock.Mock(pk=2)
+        repository_version.create.side_effect = [
+            self.version_context(stable),
+            self.version_context(everything, error=RuntimeError('counts'),
+                                 delete_error=RuntimeError('deleting')),
+        ]
+        d_version = MultiDeclarativeVersion(
+            Stage(), [RepositoryTarget(stable), RepositoryTarget(everything)]
+        )
+
+        with mock.patch('pulpcore.plugin.stages.declarative_version.log') as log, \
+                self.assertRaisesRegex(RuntimeError, 'counts'):
+            d_version.create()
+
+        log.exception.assert_called_once()
+        self.assertIsNotNone(self.new_versions[1].pk)
+
+    def test_shared_stages_fan_out_to_each_version(self, repository_version, create_pipeline):
+        create_pipeline.side_effect = lambda stages: asynctest.CoroutineMock()()
+        repository_version.create.side_effect = lambda repository: mock.MagicMock(
+            **{'__enter__.return_value': mock.Mock(repository=repository)}
+        )
+        stable, everything = mock.Mock(pk=1), mock.Mock(pk=2)
+
+        def is_stable(d_content):
+            return d_content.content.stable
+
+        targets = [
+            RepositoryTarget(stable, filter=is_stable),
+            RepositoryTarget(everything, mirror=True),
+        ]
+        first_stage = Stage()
+        new_versions = MultiDeclarativeVersion(first_stage, targets).create()
+
+        self.assertEqual([version.repository for version in new_versions], [stable, everything])
+        stages = create_pipeline.call_args[0][0]
+        self.assertIs(stages[0], first_stage)
+        self.assertIsInstance(stages[-1], EndStage)
+        fan_out = stages[-2]
+        self.assertIsInstance(fan_out, FanOut)
+        (stable_filter, stable_stages), (all_filter, all_stages) = fan_out.branches
+        self.assertIs(stable_filter, is_stable)
+        self.assertIsNone(all_filter)
+        self.assertEqual([type(stage) for stage in stable_stages], [ContentAssociation, EndStage])
+        self.assertEqual([type(stage) for stage in all_stages],
+                         [ContentAssociation, ContentUnassociation, EndStage])
+        self.assertIs(all_stages[0].new_version, new_versions[1])
+
+    def test_repository_targeted_twice(self, repository_version, create_pipeline):
+        repository = mock.Mock(pk=1)
+        with self.assertRaises(ValueError):
+            MultiDeclarativeVersion(Stage(), [RepositoryTarget(repository),
+                                              RepositoryTarget(repository)])
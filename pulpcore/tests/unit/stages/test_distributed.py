@@ -0,0 +1,291 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+import asynctest
+from unittest import mock
+from uuid import uuid4
+
+from pulpcore.constants import TASK_STATES
+from pulpcore.plugin.models import Artifact
+from pulpcore.plugin.stages import (
+    DeclarativeArtifact,
+    DeclarativeContent,
+    DistributedArtifactDownloader,
+    download_artifacts,
+)
+from pulpcore.plugin.stages.distributed import _release_resources
+
+
+def save_in_process(remote_pk, downloads):
+    """
+    Run in a worker process, saving an Artifact for each download described.
+    """
+    return os.getpid(), [(download['digests']['sha256'], str(uuid4())) for download in downloads]
+
+
+@asynctest.patch('pulpcore.plugin.stages.distributed.ProgressBar', mock.MagicMock())
+@asynctest.patch('pulpcore.plugin.stages.distributed.cancel')
+@asynctest.patch('pulpcore.plugin.stages.distributed.Artifact.objects')
+@asynctest.patch.object(DistributedArtifactDownloader, '_enqueue')
+class TestDistributedArtifactDownloader(asynctest.TestCase):
+
+    def setUp(self):
+        self.in_q = asyncio.Queue()
+        self.out_q = asyncio.Queue()
+        self.remotes = [mock.Mock(pk=uuid4()), mock.Mock(pk=uuid4())]
+        self.saved = {}
+
+    def enqueue(self, remote_pk, downloads):
+        """
+        Run the task by saving an Artifact for each download described.
+        """
+        for download in downloads:
+            artifact = Artifact(pk=uuid4(), **download['digests'])
+            self.saved[artifact.sha256] = artifact
+        return str(uuid4())
+
+    def filter_saved(self, sha256__in):
+        return [self.saved[sha256] for sha256 in sha256__in if sha256 in self.saved]
+
+    def queue_dc(self, remote, count=1, awaited=False, sha256=True):
+        d_artifacts = [
+            DeclarativeArtifact(Artifact(sha256=str(uuid4()) if sha256 else None, md5='12'),
+                                'http://a/b', 'b', remote)
+            for i in range(count)
+        ]
+        d_content = DeclarativeContent(content=mock.Mock(), d_artifacts=d_artifacts)
+        if awaited:
+            d_content.get_or_create_future()
+        self.in_q.put_nowait(d_content)
+        return d_content
+
+    async def run_stage(self, state=TASK_STATES.COMPLETED, task_state=None, **kwargs):
+        self.in_q.put_nowait(None)
+        stage = DistributedArtifactDownloader(poll_interval=0, **kwargs)
+        stage._connect(self.in_q, self.out_q)
+        if task_state is None:
+            task_state = mock.Mock(return_value=(state, {'description': 'boom'}))
+        with mock.patch.object(DistributedArtifactDownloader, '_task_state', task_state):
+            await stage()
+        handled = []
+        while True:
+            item = self.out_q.get_nowait()
+            if item is None:
+                return handled
+            handled.append(item)
+
+    async def test_shards_by_remote_and_size(self, enqueue, artifacts, cancel):
+        enqueue.side_effect = self.enqueue
+        artifacts.filter.side_effect = self.filter_saved
+        d_contents = [self.queue_dc(self.remotes[0], count=2) for i in range(3)]
+        d_contents.append(self.queue_dc(self.remotes[1]))
+
+        handled = await self.run_stage(shard_size=4)
+
+        self.assertCountEqual(handled, d_contents)
+        shards = [
+            (call[0][0], len(call[0][1])) for call in enqueue.call_args_list
+        ]
+        self.assertCountEqual(shards, [
+            (str(self.remotes[0].pk), 4),
+            (str(self.remotes[0].pk), 2),
+            (str(self.remotes[1].pk), 1),
+        ])
+        for d_content in d_contents:
+            for d_artifact in d_content.d_artifacts:
+                self.assertIs(d_artifact.artifact, self.saved[d_artifact.artifact.sha256])
+                self.assertIsNotNone(d_artifact.artifact.pk)
+
+    async def test_awaited_content_is_downloaded_here(self, enqueue, artifacts, cancel):
+        d_content = self.queue_dc(self.remotes[0], awaited=True)
+        with mock.patch.object(DeclarativeArtifact, 'download',
+                               asynctest.CoroutineMock()) as download:
+            handled = await self.run_stage()
+
+        self.assertEqual(handled, [d_content])
+        download.assert_called_once()
+        enqueue.assert_not_called()
+
+    async def test_content_without_reliable_digest_is_downloaded_here(self, enqueue, artifacts,
+                                                                      cancel):
+        d_content = self.queue_dc(self.remotes[0], sha256=False)
+        with mock.patch.object(DeclarativeArtifact, 'download',
+                               asynctest.CoroutineMock()) as download:
+            handled = await self.run_stage()
+
+        self.assertEqual(handled, [d_content])
+        download.assert_called_once()
+        enqueue.assert_not_called()
+
+    async def test_shards_are_downloaded_here_without_idle_workers(self, enqueue, artifacts,
+                                                                   cancel):
+        enqueue.return_value = None
+        d_contents = [self.queue_dc(self.remotes[0], count=2) for i in range(2)]
+        with mock.patch.object(DeclarativeArtifact, 'download',
+                               asynctest.CoroutineMock()) as download:
+            handled = await self.run_stage(shard_size=2)
+
+        self.assertCountEqual(handled, d_contents)
+        self.assertEqual(download.call_count, 4)
+        self.assertEqual(enqueue.call_count, 2)
+        cancel.assert_not_called()
+
+    async def test_task_not_started_is_canceled_and_downloaded_here(self, enqueue, artifacts,
+                                                                    cancel):
+        enqueue.return_value = '1234'
+        d_content = self.queue_dc(self.remotes[0])
+        with mock.patch.object(DeclarativeArtifact, 'download',
+                               asynctest.CoroutineMock()) as download:
+            handled = await self.run_stage(state=TASK_STATES.WAITING, start_timeout=0)
+
+        self.assertEqual(handled, [d_content])
+        download.assert_called_once()
+        cancel.assert_called_once_with('1234')
+
+    async def test_timed_out_task_is_canceled_and_downloaded_here(self, enqueue, artifacts,
+                                                                  cancel):
+        enqueue.return_value = '1234'
+        d_content = self.queue_dc(self.remotes[0], count=2)
+        unsaved = [d_artifact.artifact for d_artifact in d_content.d_artifacts]
+        with mock.patch.object(DeclarativeArtifact, 'download',
+                               asynctest.CoroutineMock()) as download:
+            handled = await self.run_stage(state=TASK_STATES.RUNNING, task_timeout=0)
+
+        self.assertEqual(handled, [d_content])
+        self.assertEqual(download.call_count, 2)
+        cancel.assert_called_once_with('1234')
+        artifacts.filter.assert_not_called()
+        self.assertEqual([d_artifact.artifact for d_artifact in d_content.d_artifacts], unsaved)
+
+    async def test_artifacts_missing_after_the_task_fail_the_stage(self, enqueue, artifacts,
+                                                                   cancel):
+        enqueue.return_value = '1234'
+        artifacts.filter.side_effect = self.filter_saved
+        self.queue_dc(self.remotes[0])
+
+        with self.assertRaisesRegex(RuntimeError, 'did not save'):
+            await self.run_stage()
+
+    async def test_failed_task_fails_the_stage(self, enqueue, artifacts, cancel):
+        enqueue.side_effect = self.enqueue
+        self.queue_dc(self.remotes[0])
+
+        with self.assertRaisesRegex(RuntimeError, 'boom'):
+            await self.run_stage(state=TASK_STATES.FAILED)
+        cancel.assert_not_called()
+
+    async def test_shards_run_in_worker_processes(self, enqueue, artifacts, cancel):
+        futures = {}
+        pids = set()
+
+        def task_state(task_id):
+            future = futures[task_id]
+            if not future.done():
+                return TASK_STATES.RUNNING, None
+            pid, saved = future.result()
+            pids.add(pid)
+            for sha256, pk in saved:
+                self.saved[sha256] = Artifact(pk=pk, sha256=sha256)
+            return TASK_STATES.COMPLETED, None
+
+        artifacts.filter.side_effect = self.filter_saved
+        d_contents = [self.queue_dc(remote, count=3) for remote in self.remotes]
+        with ProcessPoolExecutor(max_workers=2) as workers:
+            def submit(remote_pk, downloads):
+                task_id = str(uuid4())
+                futures[task_id] = workers.submit(save_in_process, remote_pk, downloads)
+                return task_id
+
+            enqueue.side_effect = submit
+            handled = await self.run_stage(task_state=mock.Mock(side_effect=task_state),
+                                           shard_size=2)
+
+        self.assertCountEqual(handled, d_contents)
+        self.assertEqual(len(futures), 4)
+        self.assertNotIn(os.getpid(), pids)
+        for d_content in d_contents:
+            for d_artifact in d_content.d_artifacts:
+                self.assertIs(d_artifact.artifact, self.saved[d_artifact.artifact.sha256])
+        cancel.assert_not_called()
+
+
+@mock.patch('pulpcore.plugin.stages.distributed.connection', mock.Mock())
+@mock.patch('pulpcore.plugin.stages.distributed.Queue')
+@mock.patch('pulpcore.plugin.stages.distributed.ReservedResource')
+@mock.patch('pulpcore.plugin.stages.distributed.Task')
+@mock.patch('pulpcore.plugin.stages.distributed.Worker')
+class TestEnqueue(asynctest.TestCase):
+
+    def test_enqueues_on_the_queue_of_an_idle_worker(self, worker_model, task_model, reserved,
+                                                     queue):
+        worker = worker_model.objects.get_unreserved_worker.return_value
+        reserved.objects.filter.return_value.count.return_value = 1
+
+        task_id = DistributedArtifactDownloader._enqueue('1234', ['download'])
+
+        task_model.objects.create.assert_called_once_with(
+            pk=task_id, state=TASK_STATES.WAITING, worker=worker,
+            name='pulpcore.plugin.stages.distributed.download_artifacts',
+            parent=task_model.current.return_value,
+        )
+        worker.lock_resources.assert_called_once_with(
+            task_model.objects.create.return_value, ['download-artifacts:' + task_id]
+        )
+        queue.assert_called_once_with(worker.name, connection=mock.ANY)
+        self.assertEqual(queue.return_value.enqueue.call_args_list, [
+            mock.call(download_artifacts, args=('1234', ['download']), job_id=task_id,
+                      timeout=mock.ANY),
+            mock.call(_release_resources, args=(task_id,)),
+        ])
+
+    def test_nothing_is_enqueued_without_idle_workers(self, worker_model, task_model, reserved,
+                                                      queue):
+        worker_model.DoesNotExist = Exception
+        worker_model.objects.get_unreserved_worker.side_effect = Exception
+
+        self.assertIsNone(DistributedArtifactDownloader._enqueue('1234', ['download']))
+        task_model.objects.create.assert_not_called()
+        queue.assert_not_called()
+
+    def test_nothing_is_enqueued_on_a_worker_reserved_meanwhile(self, worker_model, task_model,
+                                                                reserved, queue):
+        reserved.objects.filter.return_value.count.return_value = 2
+
+        self.assertIsNone(DistributedArtifactDownloader._enqueue('1234', ['download']))
+        task = task_model.objects.create.return_value
+        task.release_resources.assert_called_once_with()
+        task.delete.assert_called_once_with()
+        queue.assert_not_called()
+
+
+class TestDownloadArtifacts(asynctest.TestCase):
+
+    forbid_get_event_loop = False
+
+    @mock.patch('pulpcore.plugin.stages.distributed.WorkingDirectory', mock.MagicMock())
+    @mock.patch('pulpcore.plugin.stages.distributed.Remote')
+    @mock.patch('pulpcore.plugin.stages.distributed.Artifact.objects')
+    def test_downloads_and_saves_in_order(self, artifacts, remote_model):
+        downloaded = []
+        saved = []
+        artifacts.bulk_get_or_create.side_effect = lambda objs: saved.extend(objs) or saved
+
+        async def download(self, priority=None):
+            downloaded.append((self.url, self.artifact.sha256, self.artifact.size))
+            self.artifact = Artifact(pk=uuid4(), file='/tmp/' + self.url[-1])
+
+        downloads = [
+            {'url': 'http://a/b', 'extra_data': {}, 'size': 4, 'digests': {'sha256': '12'}},
+            {'url': 'http://a/c', 'extra_data': {}, 'size': None, 'digests': {}},
+        ]
+        with mock.patch.object(DeclarativeArtifact, 'download', download):
+            pks = download_artifacts('1234', downloads)
+
+        remote_model.objects.get.assert_called_once_with(pk='1234')
+        self.assertEqual(downloaded, [
+            ('http://a/b', '12', 4),
+            ('http://a/c', Artifact().sha256, None),
+        ])
+        self.assertEqual([artifact.file for artifact in saved], ['/tmp/b', '/tmp/c'])
+        self.assertEqual(pks, [artifact.pk for artifact in saved])
@@ -0,0 +1,75 @@
+import asyncio
+import uuid
+
+import asynctest
+import mock
+
+from pulpcore.plugin.models import Artifact
+from pulpcore.plugin.stages import DeclarativeArtifact, DeclarativeContent, SyncPlanner
+
+
+def saved(pk):
+    content = mock.Mock(pk=pk)
+    content._state.adding = False
+    return content
+
+
+class TestSyncPlanner(asynctest.TestCase):
+
+    def setUp(self):
+        self.present = [uuid.uuid4() for _ in range(3)]
+        self.version = mock.Mock()
+        self.version.content.filter.return_value.values_list.return_value = self.present[:2]
+        self.version.content.count.return_value = 3
+
+    def d_artifact(self, url, deferred_download=False, **attributes):
+        return DeclarativeArtifact(artifact=Artifact(**attributes), url=url, relative_path='a',
+                                   remote=mock.Mock(), deferred_download=deferred_download)
+
+    async def run_stage(self, d_contents, **kwargs):
+        in_q = asyncio.Queue()
+        out_q = asyncio.Queue()
+        for d_content in d_contents + [None]:
+            in_q.put_nowait(d_content)
+        stage = SyncPlanner(self.version, **kwargs)
+        stage._connect(in_q, out_q)
+        await stage()
+        self.assertEqual(out_q.qsize(), len(d_contents) + 1)
+        return stage.plan
+
+    @mock.patch('pulpcore.plugin.stages.plan.natural_key_values', lambda content: content.key)
+    async def test_counts_changes(self):
+        new = mock.Mock(key=('a',))
+        new._state.adding = True
+        unknown_size = self.d_artifact('http://x/2', sha256='b' * 64)
+        plan = await self.run_stage([
+            DeclarativeContent(content=new, d_artifacts=[
+                self.d_artifact('http://x/1', sha256='a' * 64, size=10), unknown_size,
+            ]),
+            DeclarativeContent(content=new, d_artifacts=[
+                self.d_artifact('http://y/1', sha256='a' * 64, size=10),
+                self.d_artifact('http://x/3', size=5, deferred_download=True),
+            ]),
+            DeclarativeContent(content=saved(self.present[0])),
+            DeclarativeContent(content=saved(uuid.uuid4())),
+        ], mirror=True)
+
+        self.assertEqual(plan.as_dict(), {
+            'units_to_add': 2,
+            'units_to_remove': 2,
+            'new_units': 1,
+            'artifacts_to_download': 2,
+            'download_bytes': 10,
+            'artifacts_of_unknown_size': 1,
+        })
+
+    async def test_delta_removals(self):
+        plan = await self.run_stage([
+            DeclarativeContent(content=saved(self.present[0]), removed=True),
+            DeclarativeContent(content=saved(self.present[0]), removed=True),
+            DeclarativeContent(content=saved(uuid.uuid4()), removed=True),
+        ], delta=True)
+
+        self.assertEqual(plan.units_to_remove, 1)
+        self.assertEqual(plan.units_to_add, 0)
+        self.version.content.count.assert_not_called()
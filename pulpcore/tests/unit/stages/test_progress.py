@@ -0,0 +1,36 @@
+from unittest import mock, TestCase
+
+from pulpcore.plugin.stages import ProgressReporter
+
+
+class TestProgressReporter(TestCase):
+
+    def setUp(self):
+        self.progress_bar = mock.MagicMock()
+        self.entered = self.progress_bar.__enter__.return_value
+        self.entered.done = 0
+        patcher = mock.patch('pulpcore.plugin.stages.progress.time.monotonic', return_value=0)
+        self.monotonic = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_saves_by_interval(self):
+        with ProgressReporter(self.progress_bar, interval=5) as progress:
+            for now in range(1, 11):
+                self.monotonic.return_value = now
+                progress.increment()
+            self.assertEqual(progress.done, 10)
+            self.assertEqual(self.entered.save.call_count, 2)  # at 5 and 10 seconds
+        self.progress_bar.__exit__.assert_called_once_with(None, None, None)
+
+    def test_saves_by_items(self):
+        with ProgressReporter(self.progress_bar, max_items=3) as progress:
+            for _ in range(10):
+                progress.increment()
+            progress.increment(0)
+        self.assertEqual(self.entered.done, 10)
+        self.assertEqual(self.entered.save.call_count, 3)
+
+    def test_flush_without_pending_does_not_save(self):
+        with ProgressReporter(self.progress_bar) as progress:
+            progress.flush()
+        self.entered.save.assert_not_called()
@@ -0,0 +1,51 @@
+import asyncio
+
+import asynctest
+import mock
+
+from pulpcore.plugin.models import Artifact
+from pulpcore.plugin.stages import DeclarativeArtifact, DeclarativeContent, QueryExistingArtifacts
+
+
+class TestQueryExistingArtifacts(asynctest.TestCase):
+
+    def setUp(self):
+        self.in_q = asyncio.Queue()
+        self.out_q = asyncio.Queue()
+
+    def d_content(self, **digests):
+        d_artifact = DeclarativeArtifact(artifact=Artifact(**digests), url='http://a/b',
+                                         relative_path='b', remote=mock.Mock())
+        return DeclarativeContent(content=mock.Mock(), d_artifacts=[d_artifact])
+
+    async def test_matches_by_strongest_digest(self):
+        by_sha256 = self.d_content(sha256='a' * 64, md5='1' * 32)
+        by_md5 = self.d_content(md5='2' * 32)
+        duplicate = self.d_content(sha256='a' * 64)
+        missing = self.d_content(sha256='b' * 64)
+        for d_content in (by_sha256, by_md5, duplicate, missing, None):
+            self.in_q.put_nowait(d_content)
+
+        saved_sha256 = Artifact(sha256='a' * 64)
+        saved_md5 = Artifact(md5='2' * 32)
+
+        def filter_(**kwargs):
+            self.assertEqual(len(kwargs), 1)
+            if 'sha256__in' in kwargs:
+                self.assertCountEqual(kwargs['sha256__in'], ['a' * 64, 'b' * 64])
+                return [saved_sha256]
+            self.assertEqual(kwargs['md5__in'], ['2' * 32])
+            return [saved_md5]
+
+        with mock.patch('pulpcore.plugin.stages.artifact_stages.Artifact.objects') as objects:
+            objects.filter.side_effect = filter_
+            stage = QueryExistingArtifacts()
+            stage._connect(self.in_q, self.out_q)
+            await stage()
+
+        self.assertEqual(objects.filter.call_count, 2)
+        self.assertIs(by_sha256.d_artifacts[0].artifact, saved_sha256)
+        self.assertIs(duplicate.d_artifacts[0].artifact, saved_sha256)
+        self.assertIs(by_md5.d_artifacts[0].artifact, saved_md5)
+        self.assertIsNot(missing.d_artifacts[0].artifact, saved_sha256)
+        self.assertEqual(self.out_q.qsize(), 5)
@@ -0,0 +1,110 @@
+import asyncio
+
+import asynctest
+from django.db import models
+from django.db.models import Q
+import mock
+
+from pulpcore.plugin.models import Content
+from pulpcore.plugin.stages import DeclarativeContent, QueryExistingContents
+from pulpcore.plugin.stages.content_stages import query_by_field_values
+
+
+class QueryTestContent(Content):
+    name = models.TextField()
+    version = models.TextField(null=True)
+
+    class Meta:
+        app_label = 'core'
+        unique_together = ('name', 'version')
+
+
+class TestQueryExistingContents(asynctest.TestCase):
+
+    def setUp(self):
+        self.in_q = asyncio.Queue()
+        self.out_q = asyncio.Queue()
+
+    async def run_stage(self, contents, chunk_size=1000):
+        d_contents = [DeclarativeContent(content=content) for content in contents]
+        for d_content in d_contents + [None]:
+            self.in_q.put_nowait(d_content)
+        stage = QueryExistingContents()
+        stage.QUERY_CHUNK_SIZE = chunk_size
+        stage._connect(self.in_q, self.out_q)
+        await stage()
+        return d_contents
+
+    async def test_queries_in_chunks(self):
+        saved = QueryTestContent(pk=1, name='a', version='1')
+        saved._state.adding = False
+        with mock.patch.object(QueryTestContent, 'objects') as objects:
+            objects.model = QueryTestContent
+            objects.filter.side_effect = [[saved], []]
+            d_contents = await self.run_stage([
+                QueryTestContent(name='a', version='1'),
+                QueryTestContent(name='a', version='1'),
+                QueryTestContent(name='b', version='1'),
+                QueryTestContent(name='c', version='1'),
+            ], chunk_size=2)
+
+        self.assertEqual(objects.filter.call_count, 2)
+        params = []
+        for call in objects.filter.call_args_list:
+            (lookup, raw_sql), = call[0][0].children
+            self.assertEqual(lookup, 'pk__in')
+            self.assertIn('("core_querytestcontent"."name", "core_querytestcontent"."version") '
+                          'IN (VALUES (%s::text, %s::text)', raw_sql.sql)
+            params.append(raw_sql.params)
+        self.assertEqual(params, [['a', '1', 'b', '1'], ['c', '1']])
+        self.assertIs(d_contents[0].content, saved)
+        self.assertIs(d_contents[1].content, saved)
+        self.assertIsNot(d_contents[2].content, saved)
+        self.assertEqual(self.out_q.qsize(), 5)
+
+    async def test_null_key_values(self):
+        saved = QueryTestContent(pk=1, name='a', version=None)
+        with mock.patch.object(QueryTestContent, 'objects') as objects:
+            objects.model = QueryTestContent
+            objects.filter.return_value = [saved]
+            d_contents = await self.run_stage([QueryTestContent(name='a', version=None)])
+
+        objects.filter.assert_called_once_with(Q(name='a', version=None))
+        self.assertIs(d_contents[0].content, saved)
+
+
+class TestQueryByFieldValues(asynctest.TestCase):
+
+    def query(self, field_names, keys):
+        with mock.patch.object(QueryTestContent, 'objects') as objects:
+            objects.model = QueryTestContent
+            objects.filter.return_value = []
+            list(query_by_field_values(objects, field_names, keys))
+        return objects.filter.call_args[0][0]
+
+    def test_single_field(self):
+        condition = self.query(['name'], [('a',), ('b',), (None,)])
+
+        self.assertEqual(condition, Q(name__in=['a', 'b']) | Q(name=None))
+
+    def test_row_values_and_null_keys(self):
+        condition = self.query(['name', 'version'], [('a', '1'), ('b', None)])
+
+        (lookup, raw_sql), null_key = condition.children
+        self.assertEqual(lookup, 'pk__in')
+        self.assertEqual(raw_sql.params, ['a', '1'])
+        self.assertEqual(null_key, Q(name='b', version=None))
+        self.assertEqual(condition.connector, Q.OR)
+
+    def test_or_conditions_for_parent_table_fields(self):
+        condition = self.query(['name', '_type'], [('a', 'core.query'), ('b', 'core.query')])
+
+        self.assertEqual(condition,
+                         Q(name='a', _type='core.query') | Q(name='b', _type='core.query'))
+
+    @mock.patch('pulpcore.plugin.stages.content_stages.connections',
+                {'default': mock.Mock(vendor='sqlite')})
+    def test_or_conditions_on_other_databases(self):
+        condition = self.query(['name', 'version'], [('a', '1'), ('b', '1')])
+
+        self.assertEqual(condition, Q(name='a', version='1') | Q(name='b', version='1'))
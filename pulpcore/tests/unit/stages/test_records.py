@@ -0,0 +1,110 @@
+import asyncio
+
+import asynctest
+from django.db import models
+import mock
+
+from pulpcore.plugin.models import Artifact, Content
+from pulpcore.plugin.stages import (
+    ContentSaver,
+    DeclarativeArtifact,
+    DeclarativeContent,
+    materialize,
+    model_of,
+    QueryExistingContents,
+    Record,
+)
+from pulpcore.plugin.stages.content_stages import natural_key_values
+
+
+class RecordTestContent(Content):
+    TYPE = 'record-test'
+    name = models.TextField()
+    version = models.TextField(default='1')
+    artifact = models.ForeignKey(Artifact, null=True, on_delete=models.CASCADE)
+
+    class Meta:
+        app_label = 'core'
+        unique_together = ('name', 'version', 'artifact')
+
+
+class TestRecord(asynctest.TestCase):
+
+    def test_behaves_like_unsaved_instance(self):
+        artifact = Artifact(sha256='a' * 64)
+        record = Record(RecordTestContent, name='a', artifact=artifact)
+
+        self.assertTrue(record._state.adding)
+        self.assertIs(model_of(record), RecordTestContent)
+        self.assertEqual(record.name, 'a')
+        self.assertEqual(record.version, '1')
+        self.assertEqual(record.artifact_id, artifact.pk)
+        self.assertEqual(record.TYPE, 'record-test')
+        self.assertEqual(natural_key_values(record),
+                         natural_key_values(RecordTestContent(name='a', artifact=artifact)))
+        with self.assertRaises(AttributeError):
+            record.missing
+
+    def test_only_class_constants_and_class_methods(self):
+        record = Record(RecordTestContent, name='a')
+        self.assertEqual(record.natural_key_fields(), RecordTestContent.natural_key_fields())
+        self.assertIs(record._meta, RecordTestContent._meta)
+        for name in ('q', 'save', 'artifact', 'objects'):
+            with self.assertRaises(AttributeError):
+                getattr(record, name)
+
+    def test_pk(self):
+        record = Record(Artifact, sha256='a' * 64)
+        self.assertIsNotNone(record.pk)
+        self.assertEqual(record.pk, record.pk)
+        self.assertEqual(materialize(record).pk, record.pk)
+        self.assertIsNone(Record(RecordTestContent, name='a').pk)
+        self.assertEqual(RecordTestContent(name='a').pk, None)
+
+    def test_materialize(self):
+        record = Record(Artifact, sha256='a' * 64, size=3)
+        self.assertEqual(record.md5, Artifact().md5)
+        self.assertEqual(record.DIGEST_FIELDS, Artifact.DIGEST_FIELDS)
+
+        artifact = materialize(record)
+        self.assertIsInstance(artifact, Artifact)
+        self.assertEqual((artifact.sha256, artifact.size), ('a' * 64, 3))
+        self.assertIs(materialize(artifact), artifact)
+        self.assertIs(model_of(artifact), Artifact)
+
+
+class TestRecordsInStages(asynctest.TestCase):
+
+    async def run_stage(self, stage, d_contents):
+        in_q = asyncio.Queue()
+        out_q = asyncio.Queue()
+        for d_content in d_contents + [None]:
+            in_q.put_nowait(d_content)
+        stage._connect(in_q, out_q)
+        await stage()
+
+    async def test_found_records_are_replaced(self):
+        saved = RecordTestContent(name='a')
+        saved._state.adding = False
+        found = DeclarativeContent(content=Record(RecordTestContent, name='a'))
+        new = DeclarativeContent(content=Record(RecordTestContent, name='b'))
+        with mock.patch.object(RecordTestContent, 'objects') as objects:
+            objects.model = RecordTestContent
+            objects.filter.return_value = [saved]
+            await self.run_stage(QueryExistingContents(), [found, new])
+
+        self.assertIs(found.content, saved)
+        self.assertIsInstance(new.content, Record)
+
+    @mock.patch('pulpcore.plugin.stages.content_stages.ContentArtifact')
+    @mock.patch('pulpcore.plugin.stages.content_stages.transaction')
+    @mock.patch('pulpcore.plugin.stages.content_stages.bulk_insert')
+    async def test_saved_records_are_materialized(self, bulk_insert, *_):
+        d_artifact = DeclarativeArtifact(Record(Artifact, sha256='a' * 64), 'http://a/b', 'b',
+                                         mock.Mock(), deferred_download=True)
+        new = DeclarativeContent(content=Record(RecordTestContent, name='b'),
+                                 d_artifacts=[d_artifact])
+        await self.run_stage(ContentSaver(), [new])
+
+        self.assertIsInstance(new.content, RecordTestContent)
+        bulk_insert.assert_called_once_with(RecordTestContent, [new.content])
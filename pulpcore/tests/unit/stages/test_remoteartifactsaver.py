@@ -0,0 +1,84 @@
+import asyncio
+
+import asynctest
+import mock
+
+from pulpcore.plugin.models import Artifact
+from pulpcore.plugin.stages import DeclarativeArtifact, DeclarativeContent, RemoteArtifactSaver
+
+
+@mock.patch('pulpcore.plugin.stages.artifact_stages.ContentArtifact', mock.Mock())
+@mock.patch('pulpcore.plugin.stages.artifact_stages.Prefetch', mock.Mock())
+@mock.patch('pulpcore.plugin.stages.artifact_stages.prefetch_related_objects')
+@mock.patch('pulpcore.plugin.stages.artifact_stages.RemoteArtifact')
+class TestRemoteArtifactSaver(asynctest.TestCase):
+
+    def setUp(self):
+        self.remote = mock.Mock(pk=1)
+        self.other_remote = mock.Mock(pk=2)
+        self.content_artifacts = [mock.Mock(relative_path='a'), mock.Mock(relative_path='b')]
+        self.d_content = DeclarativeContent(
+            content=mock.Mock(_remote_artifact_saver_cas=self.content_artifacts),
+            d_artifacts=[
+                DeclarativeArtifact(Artifact(), 'http://x/b', 'b', self.remote),
+                DeclarativeArtifact(Artifact(), 'http://x/a', 'a', self.remote),
+                DeclarativeArtifact(Artifact(), 'http://y/a', 'a', self.other_remote),
+            ]
+        )
+
+    async def run_stage(self, ignore_conflicts, d_contents=None):
+        d_contents = d_contents or [self.d_content]
+        in_q = asyncio.Queue()
+        out_q = asyncio.Queue()
+        for d_content in d_contents + [None]:
+            in_q.put_nowait(d_content)
+        stage = RemoteArtifactSaver()
+        stage.IGNORE_CONFLICTS = ignore_conflicts
+        stage._connect(in_q, out_q)
+        await stage()
+        self.assertEqual(out_q.qsize(), len(d_contents) + 1)
+
+    def created_for(self, remote_artifact_model):
+        return [
+            (kwargs['content_artifact'], kwargs['url'])
+            for _, kwargs in remote_artifact_model.call_args_list
+        ]
+
+    async def test_insert_ignoring_conflicts(self, remote_artifact_model, _):
+        await self.run_stage(ignore_conflicts=True)
+        self.assertEqual(self.created_for(remote_artifact_model), [
+            (self.content_artifacts[0], 'http://x/a'),
+            (self.content_artifacts[1], 'http://x/b'),
+        ])
+        remote_artifact_model.objects.bulk_create.assert_called_once_with(
+            [remote_artifact_model.return_value] * 2, ignore_conflicts=True)
+
+    async def test_only_missing_remote_artifacts(self, remote_artifact_model, _):
+        self.content_artifacts[0]._remote_artifact_saver_ras = [mock.Mock(remote_id=1)]
+        self.content_artifacts[1]._remote_artifact_saver_ras = [mock.Mock(remote_id=2)]
+        await self.run_stage(ignore_conflicts=False)
+        self.assertEqual(self.created_for(remote_artifact_model), [
+            (self.content_artifacts[1], 'http://x/b'),
+        ])
+        remote_artifact_model.objects.bulk_get_or_create.assert_called_once()
+
+    async def test_missing_declared_artifact(self, remote_artifact_model, _):
+        self.content_artifacts.append(mock.Mock(relative_path='c'))
+        with self.assertRaises(ValueError):
+            await self.run_stage(ignore_conflicts=True)
+
+    async def test_delta_removal_of_unit_with_artifacts(self, remote_artifact_model, prefetch):
+        # the saved unit has ContentArtifacts, but a removed unit declares no artifacts
+        removed = DeclarativeContent(
+            content=mock.Mock(_remote_artifact_saver_cas=[mock.Mock(relative_path='c')]),
+            removed=True,
+        )
+        await self.run_stage(ignore_conflicts=True, d_contents=[self.d_content, removed])
+        self.assertEqual(prefetch.call_args[0][0], [self.d_content.content])
+        self.assertEqual(len(self.created_for(remote_artifact_model)), 2)
+
+    async def test_only_removed_units(self, remote_artifact_model, prefetch):
+        removed = DeclarativeContent(content=mock.Mock(), removed=True)
+        await self.run_stage(ignore_conflicts=True, d_contents=[removed])
+        prefetch.assert_not_called()
+        remote_artifact_model.objects.bulk_create.assert_not_called()
@@ -0,0 +1,128 @@
+import asyncio
+import os
+import tempfile
+
+import asynctest
+from unittest import mock
+
+from pulpcore.plugin.models import Artifact, Remote
+from pulpcore.plugin.stages import (
+    create_pipeline,
+    DeclarativeArtifact,
+    DeclarativeContent,
+    EndStage,
+    FanOut,
+    Record,
+    SpillQueue,
+    Stage,
+)
+
+
+class TestSpillQueue(asynctest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    async def test_order_is_kept_across_spill(self):
+        queue = SpillQueue(memory_items=3, directory=self.tmpdir.name)
+        for i in range(10):
+            await queue.put(i)
+        self.assertEqual(queue.qsize(), 10)
+        self.assertEqual(queue.spilled, 7)
+        self.assertFalse(queue.full())
+
+        items = [await queue.get() for i in range(5)]
+        # items put while others are on disk go to disk too, behind them
+        await queue.put(10)
+        items.extend([queue.get_nowait() for i in range(6)])
+        self.assertEqual(items, list(range(11)))
+        self.assertTrue(queue.empty())
+        queue.close()
+
+    async def test_file_is_emptied_once_read(self):
+        queue = SpillQueue(memory_items=1, directory=self.tmpdir.name)
+        for i in range(5):
+            await queue.put(i)
+        self.assertGreater(queue._write_position, 0)
+        while not queue.empty():
+            await queue.get()
+        self.assertEqual(queue._write_position, 0)
+        self.assertEqual(queue._shared, {})
+        queue.close()
+        self.assertIsNone(queue._file)
+
+    async def test_puts_wait_once_the_file_is_full(self):
+        queue = SpillQueue(memory_items=1, max_bytes=1, directory=self.tmpdir.name)
+        await queue.put(0)
+        await queue.put(1)
+        self.assertTrue(queue.full())
+
+        put = asyncio.ensure_future(queue.put(2))
+        await asyncio.sleep(0)
+        self.assertFalse(put.done())
+        self.assertEqual(await queue.get(), 0)
+        await asyncio.sleep(0)
+        self.assertFalse(put.done())
+        self.assertEqual(await queue.get(), 1)
+        await put
+        self.assertEqual(await queue.get(), 2)
+        queue.close()
+
+    def test_directory_defaults_to_the_working_directory(self):
+        with mock.patch('pulpcore.plugin.stages.spill.WorkingDirectory') as working_directory:
+            working_directory.return_value.path = self.tmpdir.name
+            queue = SpillQueue()
+        self.assertEqual(queue.directory, self.tmpdir.name)
+
+    async def test_remotes_and_futures_are_not_copied(self):
+        remote = Remote(name='remote')
+        queue = SpillQueue(memory_items=0, directory=self.tmpdir.name)
+        artifact = Record(Artifact, sha256='1234', size=4)
+        d_artifact = DeclarativeArtifact(artifact, 'http://a/b', 'b', remote)
+        d_content = DeclarativeContent(content=Artifact(sha256='abcd'), d_artifacts=[d_artifact])
+        future = d_content.get_or_create_future()
+        await queue.put(d_content)
+        self.assertEqual(queue.spilled, 1)
+
+        spilled = await queue.get()
+        self.assertIsNot(spilled, d_content)
+        self.assertIs(spilled.d_artifacts[0].remote, remote)
+        self.assertIs(spilled.get_or_create_future(), future)
+        self.assertEqual(spilled.content.sha256, 'abcd')
+        self.assertEqual(spilled.d_artifacts[0].artifact.sha256, '1234')
+        self.assertIs(spilled.d_artifacts[0].artifact._model, Artifact)
+        queue.close()
+
+    async def test_pipeline_spills_first_link(self):
+
+        class Source(Stage):
+            async def run(self):
+                for i in range(20):
+                    await self.put(DeclarativeContent(content=Artifact(size=i)))
+
+        class Sink(Stage):
+            def __init__(self):
+                super().__init__()
+                self.sizes = []
+
+            async def run(self):
+                await asyncio.sleep(0.01)
+                async for d_content in self.items():
+                    self.sizes.append(d_content.content.size)
+
+        sink = Sink()
+        branch_sink = Sink()
+        stages = [Source(), FanOut([(None, [branch_sink, EndStage()])]), sink, EndStage()]
+        with mock.patch('pulpcore.plugin.stages.spill.WorkingDirectory') as working_directory, \
+                mock.patch('pulpcore.plugin.stages.api.SpillQueue', wraps=SpillQueue) as queues:
+            working_directory.return_value.path = self.tmpdir.name
+            queues.MAX_BYTES = SpillQueue.MAX_BYTES
+            await create_pipeline(stages, maxsize=1, spill_after=2)
+        self.assertEqual(sink.sizes, list(range(20)))
+        self.assertEqual(branch_sink.sizes, list(range(20)))
+        # only the first link of the outer pipeline spills
+        queues.assert_called_once()
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
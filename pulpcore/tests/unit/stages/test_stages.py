@@ -3,7 +3,16 @@ import asyncio
 import asynctest
 import mock
 
-from pulpcore.plugin.stages import Stage, EndStage
+from pulpcore.plugin.stages import (
+    BatchStage,
+    create_pipeline,
+    EndStage,
+    FanOut,
+    fuse_stages,
+    FusedStage,
+    MemoryBudget,
+    Stage,
+)
 
 
 class TestStage(asynctest.TestCase):
@@ -122,3 +131,108 @@ class TestMultipleStages(asynctest.TestCase):
                         first_stage(),
                         end_stage(),
                     )
+
+
+class TestFusedStages(asynctest.TestCase):
+
+    class FirstStage(Stage):
+        async def run(self):
+            for i in range(5):
+                await self.put(mock.Mock(does_batch=True, handled_by=[]))
+
+    class RecordingStage(BatchStage):
+        async def handle_batch(self, batch):
+            for d_content in batch:
+                d_content.handled_by.append(self)
+
+    class CustomRunStage(RecordingStage):
+        async def run(self):
+            async for d_content in self.items():
+                d_content.handled_by.append(self)
+                await self.put(d_content)
+
+    class CollectingStage(EndStage):
+        async def __call__(self):
+            self.items_seen = [d_content async for d_content in self.items()]
+
+    def test_fuses_consecutive_batch_stages(self):
+        first = self.FirstStage()
+        batch_stages = [self.RecordingStage() for i in range(3)]
+        custom = self.CustomRunStage()
+        last = self.RecordingStage()
+        end = EndStage()
+
+        stages = fuse_stages([first] + batch_stages + [custom, last, end])
+
+        self.assertIs(stages[0], first)
+        self.assertIsInstance(stages[1], FusedStage)
+        self.assertEqual(stages[1].stages, batch_stages)
+        self.assertEqual(stages[2:], [custom, last, end])
+
+    def test_smallest_batch_minsize_is_used(self):
+        eager = self.RecordingStage()
+        eager.BATCH_MINSIZE = 1
+        fused = FusedStage([self.RecordingStage(), eager])
+
+        self.assertEqual(fused.BATCH_MINSIZE, 1)
+
+    async def test_fused_pipeline_runs_each_stage_in_order(self):
+        batch_stages = [self.RecordingStage() for i in range(3)]
+        end = self.CollectingStage()
+        await create_pipeline([self.FirstStage()] + batch_stages + [end])
+
+        self.assertEqual(len(end.items_seen), 5)
+        for d_content in end.items_seen:
+            self.assertEqual(d_content.handled_by, batch_stages)
+
+
+class TestFanOut(asynctest.TestCase):
+
+    class FirstStage(Stage):
+        async def run(self):
+            for i in range(10):
+                await self.put(mock.Mock(number=i))
+
+    class CollectingStage(EndStage):
+        async def __call__(self):
+            self.items_seen = [item.number async for item in self.items()]
+
+    class FailingStage(Stage):
+        async def run(self):
+            async for item in self.items():
+                raise ValueError(item.number)
+
+    async def test_branches_receive_accepted_items_in_order(self):
+        evens = self.CollectingStage()
+        everything = self.CollectingStage()
+        end = self.CollectingStage()
+        fan_out = FanOut([
+            (lambda item: item.number % 2 == 0, [evens]),
+            (None, [everything]),
+        ], maxsize=1)
+        await create_pipeline([self.FirstStage(), fan_out, end], maxsize=1)
+
+        self.assertEqual(evens.items_seen, [0, 2, 4, 6, 8])
+        self.assertEqual(everything.items_seen, list(range(10)))
+        self.assertEqual(end.items_seen, list(range(10)))
+
+    async def test_branches_share_the_memory_budget(self):
+        branches = [self.CollectingStage(), self.CollectingStage()]
+        fan_out = FanOut([(None, [branch]) for branch in branches], maxsize=1)
+        await create_pipeline([self.FirstStage(), fan_out, EndStage()], maxsize=1,
+                              max_pipeline_bytes=10 ** 6)
+
+        budget = fan_out._pipeline_limits['budget']
+        self.assertIsInstance(budget, MemoryBudget)
+        for branch in branches:
+            self.assertEqual(branch.items_seen, list(range(10)))
+            self.assertIs(branch._pipeline_limits['budget'], budget)
+        self.assertEqual(budget.used, 0)
+
+    async def test_failing_branch_fails_the_pipeline(self):
+        fan_out = FanOut([
+            (None, [self.FailingStage(), EndStage()]),
+            (None, [self.CollectingStage()]),
+        ], maxsize=1)
+        with self.assertRaises(ValueError):
+            await create_pipeline([self.FirstStage(), fan_out, EndStage()], maxsize=1)